@@ -13,14 +13,43 @@ Features:
 """
 
 import os
+import bisect
+import fcntl
+import math
+import shutil
+import random
+import numpy as np
 import pandas as pd
 import google.generativeai as genai
+try:
+    from google.generativeai import caching as genai_caching
+except ImportError:  # google-generativeai releases without context caching
+    genai_caching = None
+try:
+    import pyinstrument
+except ImportError:  # optional; request profiling falls back to cProfile
+    pyinstrument = None
 import mysql.connector
-from flask import Flask, request, jsonify, render_template, redirect, url_for
-from sqlalchemy import create_engine
+from flask import (Flask, Response, request, jsonify, render_template, redirect, url_for, stream_with_context, g,
+                   has_request_context)
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import DBAPIError, InterfaceError, TimeoutError as PoolTimeoutError
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import cProfile
+import hashlib
+import hmac
 import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+import types
+import uuid
 
 # Load environment variables
 load_dotenv()
@@ -55,10 +84,160 @@ COMPANY_CONFIG = {
 
 # Load configuration from environment variables
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
 MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
 INSTANCE_CONNECTION_NAME = os.getenv("INSTANCE_CONNECTION_NAME")
 
+# SQLAlchemy URL used instead of Cloud SQL, with {database} replaced by the company's
+# database name (e.g. sqlite:////tmp/bench/{database}.db for local benchmarks)
+DATABASE_URL_TEMPLATE = os.getenv("DATABASE_URL_TEMPLATE")
+
+# Database connection pool configuration (one pooled engine per company)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "15"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Database health: failed connections are cached and retried in the background with backoff
+DB_HEALTH_BACKOFF_BASE = float(os.getenv("DB_HEALTH_BACKOFF_BASE", "2"))
+DB_HEALTH_BACKOFF_MAX = float(os.getenv("DB_HEALTH_BACKOFF_MAX", "300"))
+
+# Seconds a request waits on an identical in-flight Gemini call
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv("SINGLE_FLIGHT_TIMEOUT", "120"))
+
+# Asynchronous job queue configuration
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "20"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "600"))
+
+# Scans loading configuration (max rows 0 keeps every row in memory)
+SCANS_COLUMNS = [col.strip() for col in os.getenv("SCANS_COLUMNS", "").split(",") if col.strip()]
+SCANS_CHUNK_SIZE = int(os.getenv("SCANS_CHUNK_SIZE", "20000"))
+SCANS_MAX_ROWS = int(os.getenv("SCANS_MAX_ROWS", "0"))
+SCANS_SAMPLE_SIZE = int(os.getenv("SCANS_SAMPLE_SIZE", "500"))
+SCANS_SAMPLE_STRATIFY = os.getenv("SCANS_SAMPLE_STRATIFY")
+SCANS_PROMPT_SAMPLE_ROWS = int(os.getenv("SCANS_PROMPT_SAMPLE_ROWS", "20"))
+SCANS_FIRST_DATA_WAIT = int(os.getenv("SCANS_FIRST_DATA_WAIT", "30"))
+
+# Shared dataset snapshots for multi-worker deployments (unset SNAPSHOT_DIR disables)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", "3600"))
+SNAPSHOT_KEEP_VERSIONS = int(os.getenv("SNAPSHOT_KEEP_VERSIONS", "2"))
+
+# Scans refresh configuration (interval 0 disables the background refresher)
+SCANS_WATERMARK_COLUMN = os.getenv("SCANS_WATERMARK_COLUMN")
+SCANS_KEY_COLUMN = os.getenv("SCANS_KEY_COLUMN")
+DATA_REFRESH_INTERVAL = int(os.getenv("DATA_REFRESH_INTERVAL", "0"))
+DATA_REFRESH_JITTER = float(os.getenv("DATA_REFRESH_JITTER", "0.2"))
+DATA_REFRESH_MIN_INTERVAL = int(os.getenv("DATA_REFRESH_MIN_INTERVAL", "30"))
+
+# Startup warm-up configuration
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "true").lower() in ("1", "true", "yes")
+WARMUP_WORKERS = int(os.getenv("WARMUP_WORKERS", "4"))
+
+# Conversation history configuration
+CONVERSATION_MAX_HISTORY = int(os.getenv("CONVERSATION_MAX_HISTORY", "200"))
+# Turns older than the most recent CONVERSATION_RECENT_TURNS are compacted in the background
+CONVERSATION_RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "3"))
+# How old turns are compacted: extractive (local), model (cheapest Gemini tier) or off
+CONVERSATION_SUMMARY_MODE = os.getenv("CONVERSATION_SUMMARY_MODE", "extractive").lower()
+# Size of each compacted answer and of the running summary of evicted turns
+CONVERSATION_TURN_SUMMARY_CHARS = int(os.getenv("CONVERSATION_TURN_SUMMARY_CHARS", "300"))
+CONVERSATION_SUMMARY_CHARS = int(os.getenv("CONVERSATION_SUMMARY_CHARS", "1500"))
+
+# Data digest configuration (statistical summary sent to the AI model)
+DIGEST_TOP_K = int(os.getenv("DIGEST_TOP_K", "8"))
+DIGEST_MAX_TIME_BUCKETS = int(os.getenv("DIGEST_MAX_TIME_BUCKETS", "12"))
+DIGEST_MAX_CROSSTABS = int(os.getenv("DIGEST_MAX_CROSSTABS", "3"))
+
+# Prompt token budget (0 uses the per-model default in PromptPacker.MODEL_BUDGETS)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "0"))
+# JSON overrides of per-section packing policy, e.g. {"data": {"max_share": 0.9}}
+PROMPT_SECTION_POLICY = json.loads(os.getenv("PROMPT_SECTION_POLICY", "{}") or "{}")
+
+# Stable prompt prefix memoization and Gemini context caching
+# GEMINI_CONTEXT_CACHE: off (memoize only), local (offline stub) or gemini (context caching API)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "off").lower()
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# Gemini rejects cached contents below a model-specific minimum size
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "32768"))
+
+# Question-aware retrieval (only matching rows/columns are sent to the AI model)
+DATA_RETRIEVAL = os.getenv("DATA_RETRIEVAL", "true").lower() in ("1", "true", "yes")
+DATA_RETRIEVAL_MAX_ROWS = int(os.getenv("DATA_RETRIEVAL_MAX_ROWS", "200"))
+DATA_INDEX_MAX_DISTINCT = int(os.getenv("DATA_INDEX_MAX_DISTINCT", "10000"))
+
+# KPI cube: aggregates precomputed after each load, served by /kpis and summarized in prompts
+KPI_CUBE = os.getenv("KPI_CUBE", "true").lower() in ("1", "true", "yes")
+KPI_CUBE_MAX_CARDINALITY = int(os.getenv("KPI_CUBE_MAX_CARDINALITY", "50"))
+KPI_CUBE_MAX_CELLS = int(os.getenv("KPI_CUBE_MAX_CELLS", "200000"))
+
+# SQL tool mode: Gemini answers /ask by calling read-only aggregate queries on the scans table
+SQL_TOOL = os.getenv("SQL_TOOL", "false").lower() in ("1", "true", "yes")
+SQL_TOOL_MAX_ROWS = int(os.getenv("SQL_TOOL_MAX_ROWS", "200"))
+SQL_TOOL_TIMEOUT_MS = int(os.getenv("SQL_TOOL_TIMEOUT_MS", "5000"))
+SQL_TOOL_MAX_QUERIES = int(os.getenv("SQL_TOOL_MAX_QUERIES", "4"))
+SQL_TOOL_CACHE_SIZE = int(os.getenv("SQL_TOOL_CACHE_SIZE", "256"))
+
+# Response cache configuration (size 0 disables caching)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB")
+
+# Gemini client: backend (genai or fake), per-call deadline, retries, hedging and circuit breaker
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "genai").lower()
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "0.5"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "8"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "false").lower() in ("1", "true", "yes")
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "1.0"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+GEMINI_CALL_WORKERS = int(os.getenv("GEMINI_CALL_WORKERS", "16"))
+
+# Model routing across Gemini tiers (cheapest tier first in MODEL_TIERS)
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "true").lower() in ("1", "true", "yes")
+MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS", "") or "{}") or {
+    "flash": {"model": os.getenv("GEMINI_FLASH_MODEL", "gemini-1.5-flash"), "concurrency": 8},
+    "pro": {"model": GEMINI_MODEL, "concurrency": 4}
+}
+# Prompts at or above this many tokens always go to the most capable tier
+ROUTER_LARGE_PROMPT_TOKENS = int(os.getenv("ROUTER_LARGE_PROMPT_TOKENS", "12000"))
+# Seconds to wait for a tier's concurrency slot before trying another tier
+ROUTER_TIER_WAIT = float(os.getenv("ROUTER_TIER_WAIT", "2"))
+
+# Admission control in front of Gemini, shared by every company (0 disables a limit)
+ADMISSION_RPM = float(os.getenv("ADMISSION_RPM", "0"))
+ADMISSION_TPM = float(os.getenv("ADMISSION_TPM", "0"))
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "0"))
+# Seconds a question may wait for admission before the caller gets a 429
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "50"))
+# Estimated response tokens counted against ADMISSION_TPM on top of the prompt
+ADMISSION_OUTPUT_TOKENS = int(os.getenv("ADMISSION_OUTPUT_TOKENS", "800"))
+# JSON fair-share weights per company, e.g. {"company1": 2}; unlisted companies weigh 1
+ADMISSION_WEIGHTS = json.loads(os.getenv("ADMISSION_WEIGHTS", "") or "{}")
+
+# Fake Gemini backend (GEMINI_BACKEND=fake) for offline runs and load tests
+FAKE_GEMINI_LATENCY = float(os.getenv("FAKE_GEMINI_LATENCY", "0.2"))
+# Shape of the injected latency around its mean: uniform, fixed, exponential or lognormal
+FAKE_GEMINI_LATENCY_DISTRIBUTION = os.getenv("FAKE_GEMINI_LATENCY_DISTRIBUTION", "uniform").lower()
+FAKE_GEMINI_ERROR_RATE = float(os.getenv("FAKE_GEMINI_ERROR_RATE", "0"))
+FAKE_GEMINI_HANG_RATE = float(os.getenv("FAKE_GEMINI_HANG_RATE", "0"))
+
+# Request profiling: requests sending X-Profile, plus this fraction of all requests, are profiled
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/marketing-insights-profiles")
+# X-Profile must carry this value; the header is ignored while it is unset
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+# Oldest profiles beyond this many are deleted from PROFILE_DIR
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+# cprofile (.prof files for pstats/snakeviz) or pyinstrument (.html, needs the package)
+PROFILER = os.getenv("PROFILER", "cprofile").lower()
+
 # Configure Gemini API if key is available
 if GEMINI_API_KEY:
     try:
@@ -69,6 +248,38 @@ if GEMINI_API_KEY:
 # Global dictionary to store company managers
 company_managers = {}
 
+# Per-company locks so each manager is created exactly once
+company_manager_locks = {company_id: threading.Lock() for company_id in COMPANY_CONFIG}
+
+# Set once every company has finished its warm-up
+app_ready = threading.Event()
+warm_up_lock = threading.Lock()
+warm_up_thread = None
+
+
+class InsightsError(Exception):
+    """Raised when insights cannot be generated; the message is user-facing"""
+
+
+class GeminiTimeoutError(Exception):
+    """Raised when a Gemini call does not finish within its deadline"""
+
+
+class GeminiUnavailableError(Exception):
+    """Raised without calling Gemini while the circuit breaker is open"""
+
+
+class AdmissionTimeoutError(Exception):
+    """Raised when a question is not admitted to Gemini in time; retry_after is in seconds"""
+    
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SqlToolError(ValueError):
+    """Raised when a query from the model is not an allowed aggregate; the message goes back to the model"""
+
 
 class CompanyDataManager:
     """
@@ -78,6 +289,7 @@ class CompanyDataManager:
         company_id: Unique identifier for the company
         company_config: Configuration dictionary for the company
         mysql_db: Database name from environment variables
+        engine: Pooled SQLAlchemy engine shared by all database access
         background_manager: Manages company background information
         conversation_manager: Manages conversation history
         data_manager: Handles data loading and processing
@@ -87,13 +299,239 @@ class CompanyDataManager:
         self.company_id = company_id
         self.company_config = COMPANY_CONFIG.get(company_id, {})
         self.mysql_db = os.getenv(self.company_config.get('db_env', ''))
-        self.background_manager = BackgroundManager(self)
+        self.engine = None
+        self.engine_lock = threading.Lock()
+        self.sql_tool = AggregateQueryTool(self)
+        self.db_health = DatabaseHealth(company_id, self.ping_database,
+                                        DB_HEALTH_BACKOFF_BASE, DB_HEALTH_BACKOFF_MAX)
+        with trace_span("background-load"):
+            self.background_manager = BackgroundManager(self)
         self.conversation_manager = ConversationManager()
-        self.data_manager = DataManager(self)
+        with trace_span("data-manager-init"):
+            self.data_manager = DataManager(self)
     
     def get_company_name(self):
         """Returns the display name of the company"""
         return self.company_config.get('name', 'Unknown Company')
+    
+    def get_engine(self):
+        """
+        Returns the company's pooled SQLAlchemy engine, creating it on first use.
+        
+        Connections are pre-pinged on checkout and recycled periodically, so
+        callers can borrow them without a fresh socket handshake.
+        
+        Returns:
+            Engine: SQLAlchemy engine instance
+        """
+        with self.engine_lock:
+            if self.engine is None and DATABASE_URL_TEMPLATE:
+                self.engine = create_engine(
+                    DATABASE_URL_TEMPLATE.format(database=self.mysql_db),
+                    pool_size=DB_POOL_SIZE,
+                    max_overflow=DB_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT,
+                    pool_recycle=DB_POOL_RECYCLE,
+                    pool_pre_ping=True
+                )
+            elif self.engine is None:
+                def get_conn():
+                    started = time.perf_counter()
+                    outcome = "error"
+                    try:
+                        conn = mysql.connector.connect(
+                            user=MYSQL_USER,
+                            password=MYSQL_PASSWORD,
+                            database=self.mysql_db,
+                            unix_socket=f"/cloudsql/{INSTANCE_CONNECTION_NAME}",
+                            connect_timeout=DB_CONNECT_TIMEOUT,
+                            autocommit=True
+                        )
+                        outcome = "success"
+                        return conn
+                    finally:
+                        DB_CONNECTS.inc(company=self.company_id, outcome=outcome)
+                        DB_CONNECT_SECONDS.observe(time.perf_counter() - started, company=self.company_id)
+                self.engine = create_engine(
+                    "mysql+mysqlconnector://",
+                    creator=get_conn,
+                    pool_size=DB_POOL_SIZE,
+                    max_overflow=DB_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT,
+                    pool_recycle=DB_POOL_RECYCLE,
+                    pool_pre_ping=True
+                )
+            return self.engine
+    
+    def ping_database(self):
+        """
+        Runs a trivial query on a pooled connection.
+        
+        Raises:
+            Exception: If the database cannot be reached
+        """
+        with self.get_engine().connect() as conn:
+            conn.exec_driver_sql("SELECT 1").fetchone()
+
+
+class DatabaseHealth:
+    """
+    Tracks whether a company's database is reachable.
+    
+    States:
+    - unknown: not checked yet; database calls go through
+    - healthy: the last call succeeded; database calls go through
+    - unhealthy: a connection failed; calls fail fast (the negative result
+      is cached) until the backoff expires, then a single background probe
+      retries. Each failed probe doubles the backoff up to max_backoff.
+    
+    Callbacks registered with on_recovery run when a probe succeeds.
+    """
+    
+    CONNECTION_ERRNOS = {2002, 2003, 2005, 2006, 2013, 2055}
+    
+    def __init__(self, name, probe, base_backoff=2, max_backoff=300):
+        self.name = name
+        self.probe = probe
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = "unknown"
+        self.failures = 0
+        self.last_error = None
+        self.last_failure = None
+        self.last_success = None
+        self.retry_at = 0.0
+        self.probing = False
+        self.listeners = []
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def is_connection_error(cls, error):
+        """
+        Checks whether an error means the database could not be reached.
+        
+        Query errors (missing tables, bad SQL, unknown functions, execution
+        time limits) do not count, even though drivers raise many of them as
+        OperationalError; only connection errnos and SQLSTATE class 08 do.
+        
+        Args:
+            error: Exception raised by a database call
+            
+        Returns:
+            bool: True for connection, socket and pool timeout failures
+        """
+        if isinstance(error, (InterfaceError, PoolTimeoutError, ConnectionError, TimeoutError)):
+            return True
+        if isinstance(error, DBAPIError) and error.connection_invalidated:
+            return True
+        original = getattr(error, 'orig', error)
+        if isinstance(original, mysql.connector.errors.InterfaceError):
+            return True
+        if str(getattr(original, 'sqlstate', None) or "").startswith("08"):
+            return True
+        return getattr(original, 'errno', None) in cls.CONNECTION_ERRNOS
+    
+    def is_available(self):
+        """
+        Checks whether database calls should be attempted, without blocking.
+        
+        Once the backoff of an unhealthy database expires, a background probe
+        is started; callers keep failing fast until it succeeds.
+        
+        Returns:
+            bool: False while the database is considered unreachable
+        """
+        with self.lock:
+            if self.state != "unhealthy":
+                return True
+            if self.probing or time.time() < self.retry_at:
+                return False
+            self.probing = True
+        
+        threading.Thread(target=self._run_probe, name=f"db-probe-{self.name}", daemon=True).start()
+        return False
+    
+    def record_success(self):
+        """Marks the database healthy, notifying listeners after an outage"""
+        with self.lock:
+            recovered = self.state == "unhealthy"
+            self.state = "healthy"
+            self.failures = 0
+            self.last_error = None
+            self.last_success = time.time()
+        
+        if recovered:
+            for callback in list(self.listeners):
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Database recovery callback failed for {self.name}: {e}")
+    
+    def record_failure(self, error):
+        """
+        Marks the database unhealthy and schedules the next retry.
+        
+        Args:
+            error: Exception or message describing the failure
+        """
+        with self.lock:
+            self.failures += 1
+            self.state = "unhealthy"
+            self.last_error = str(getattr(error, 'orig', error))[:300]
+            self.last_failure = time.time()
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+            self.retry_at = self.last_failure + backoff
+    
+    def on_recovery(self, callback):
+        """
+        Registers a callback run when the database becomes reachable again.
+        
+        Args:
+            callback: Callable without arguments
+        """
+        self.listeners.append(callback)
+    
+    def describe(self):
+        """
+        Returns a user-facing description of an outage.
+        
+        Returns:
+            str: Last error and time until the next retry
+        """
+        retry_in = max(0, round(self.retry_at - time.time()))
+        return f"Database unavailable (last error: {self.last_error}); retrying in {retry_in}s"
+    
+    def _run_probe(self):
+        """Retries the connection in the background"""
+        try:
+            self.probe()
+        except Exception as e:
+            with self.lock:
+                self.probing = False
+            self.record_failure(e)
+            return
+        
+        with self.lock:
+            self.probing = False
+        self.record_success()
+    
+    def get_status(self):
+        """
+        Returns the health state.
+        
+        Returns:
+            dict: State, consecutive failures, last error and retry timing
+        """
+        with self.lock:
+            status = {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "last_error": self.last_error,
+                "probing": self.probing
+            }
+            if self.state == "unhealthy":
+                status["retry_in_seconds"] = max(0, round(self.retry_at - time.time(), 1))
+            return status
 
 
 class BackgroundManager:
@@ -108,40 +546,54 @@ class BackgroundManager:
     
     def __init__(self, company_manager):
         self.company_manager = company_manager
+        self.loaded_from_database = False
         self.original_background = self.load_background_from_database()
         self.current_background = self.original_background
         self.is_edited = False
+        company_manager.db_health.on_recovery(self._on_database_recovered)
     
     def load_background_from_database(self):
         """
         Loads company background information from the database.
         
+        Returns immediately with the default message while the database is
+        known to be unreachable.
+        
         Returns:
             str: Background text or default message if not found
         """
+        default = f"No background information available for {self.company_manager.get_company_name()}"
+        db_health = self.company_manager.db_health
+        if not db_health.is_available():
+            return default
+        
         try:
-            conn = mysql.connector.connect(
-                user=MYSQL_USER,
-                password=MYSQL_PASSWORD,
-                database=self.company_manager.mysql_db,
-                unix_socket=f"/cloudsql/{INSTANCE_CONNECTION_NAME}",
-                connect_timeout=15,
-                autocommit=True
-            )
-            
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM `company-background`")
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
+            with self.company_manager.get_engine().connect() as conn:
+                result = conn.exec_driver_sql("SELECT * FROM `company-background`").fetchone()
             
+            db_health.record_success()
+            self.loaded_from_database = True
             if result and result[0]:
                 return result[0]
             else:
-                return f"No background information available for {self.company_manager.get_company_name()}"
+                return default
         
         except Exception as e:
-            return f"No background information available for {self.company_manager.get_company_name()}"
+            if DatabaseHealth.is_connection_error(e):
+                db_health.record_failure(e)
+            return default
+    
+    def _on_database_recovered(self):
+        """Loads the background that could not be read during an outage"""
+        if self.loaded_from_database:
+            return
+        background = self.load_background_from_database()
+        if not self.loaded_from_database:
+            return
+        self.original_background = background
+        if not self.is_edited and self.current_background != background:
+            self.current_background = background
+            response_cache.invalidate_company(self.company_manager.company_id)
     
     def update_background(self, new_background):
         """
@@ -154,6 +606,8 @@ class BackgroundManager:
             bool: True if update successful, False otherwise
         """
         if new_background and new_background.strip():
+            if new_background.strip() != self.current_background:
+                response_cache.invalidate_company(self.company_manager.company_id)
             self.current_background = new_background.strip()
             self.is_edited = True
             return True
@@ -161,6 +615,8 @@ class BackgroundManager:
     
     def reset_background(self):
         """Resets background to original version from database"""
+        if self.current_background != self.original_background:
+            response_cache.invalidate_company(self.company_manager.company_id)
         self.current_background = self.original_background
         self.is_edited = False
     
@@ -189,15 +645,29 @@ class ConversationManager:
     
     Features:
     - Maintains conversation history with size limits
-    - Provides relevant history based on current question
+    - Provides relevant history based on current question (BM25 ranking)
+    - Compacts turns older than the most recent few in the background
+    - Folds evicted turns into a bounded running summary
     - Tracks data context establishment
     """
     
-    def __init__(self, max_history=8, max_tokens_per_turn=3000):
+    def __init__(self, max_history=CONVERSATION_MAX_HISTORY, max_tokens_per_turn=3000,
+                 recent_turns=CONVERSATION_RECENT_TURNS, summarizer=None):
         self.history = []
         self.max_history = max_history
         self.max_tokens_per_turn = max_tokens_per_turn
+        self.recent_turns = recent_turns
+        self.summarizer = summarizer or conversation_summarizer
         self.data_context_established = False
+        self.index = ConversationIndex()
+        self.lock = threading.Lock()
+        # history[:compacted] hold compacted answers
+        self.compacted = 0
+        self.summary_lines = deque()
+        self.earlier_topics = deque(maxlen=12)
+        self.generation = 0
+        self.compaction_scheduled = False
+        self.stats = {"compacted_turns": 0, "evicted_turns": 0, "compaction_errors": 0}
     
     def add_turn(self, question, answer):
         """
@@ -211,12 +681,103 @@ class ConversationManager:
         truncated_answer = (answer[:self.max_tokens_per_turn] + "..."
                           if len(answer) > self.max_tokens_per_turn else answer)
         
-        self.history.append((clean_question, truncated_answer))
-        self.data_context_established = True
+        with self.lock:
+            # Index first, so a failure cannot leave history and index out of step
+            self.index.add(clean_question)
+            self.history.append((clean_question, truncated_answer))
+            self.data_context_established = True
+            
+            # Remove oldest entry if history exceeds limit
+            if len(self.history) > self.max_history:
+                evicted_question, evicted_answer = self.history.pop(0)
+                self.index.remove_oldest()
+                if self.compacted:
+                    self.compacted -= 1
+                elif self.summarizer.enabled:
+                    # Not compacted yet; the local summarizer is cheap enough to run inline
+                    evicted_answer = self.summarizer.extract(evicted_answer, self.summarizer.turn_chars,
+                                                             evicted_question)
+                if self.summarizer.enabled:
+                    self._fold_into_summary(evicted_question, evicted_answer)
+                self.stats["evicted_turns"] += 1
+            
+            schedule = (self.summarizer.enabled and not self.compaction_scheduled
+                        and len(self.history) - self.compacted > self.recent_turns)
+            if schedule:
+                self.compaction_scheduled = True
+        
+        if schedule:
+            summary_executor.submit(self._compact)
+    
+    def _compact(self):
+        """
+        Replaces the answers of turns older than the recent window with
+        compact summaries, oldest first.
+        
+        Summaries are computed outside the lock; a result is dropped if the
+        turn was evicted or the history cleared in the meantime.
+        """
+        while True:
+            with self.lock:
+                if len(self.history) - self.compacted <= self.recent_turns:
+                    self.compaction_scheduled = False
+                    return
+                position, generation = self.compacted, self.generation
+                turn = self.history[position]
+            
+            failed = False
+            try:
+                summary = self.summarizer.summarize(*turn)
+            except Exception as e:
+                print(f"Conversation compaction failed: {e}")
+                summary = self.summarizer.extract(turn[1], self.summarizer.turn_chars, turn[0])
+                failed = True
+            
+            with self.lock:
+                self.stats["compaction_errors"] += failed
+                # Evictions shift positions; the turn is still next if it is at compacted
+                if (generation == self.generation and self.compacted < len(self.history)
+                        and self.history[self.compacted] is turn):
+                    self.history[self.compacted] = (turn[0], summary)
+                    self.compacted += 1
+                    self.stats["compacted_turns"] += 1
+    
+    def _fold_into_summary(self, question, answer):
+        """
+        Adds an evicted turn to the running summary (caller holds the lock).
+        
+        Once the summary outgrows CONVERSATION_SUMMARY_CHARS, the oldest
+        entries are reduced to their questions in the earlier topics list.
+        """
+        self.summary_lines.append((question, answer))
+        while len(self.summary_lines) > 1 and len(self._render_summary()) > self.summarizer.summary_chars:
+            self.earlier_topics.append(self.summary_lines.popleft()[0])
+    
+    def _render_summary(self):
+        """Formats the running summary (caller holds the lock)"""
+        lines = [f"- {question} -> {answer}" for question, answer in self.summary_lines]
+        if self.earlier_topics:
+            topics = "; ".join(topic[:80] for topic in self.earlier_topics)
+            lines.insert(0, f"- Earlier topics: {topics}")
+        return "\n".join(lines)
+    
+    def get_summary(self):
+        """
+        Returns the running summary of turns no longer in history.
         
-        # Remove oldest entry if history exceeds limit
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
+        Returns:
+            str: Summary text, empty if no turn was evicted
+        """
+        with self.lock:
+            return self._render_summary()
+    
+    def get_stats(self):
+        """Returns history size and compaction counters"""
+        with self.lock:
+            return dict(self.stats, turns=len(self.history), compacted=self.compacted,
+                        pending=len(self.history) - self.compacted,
+                        summary_chars=len(self._render_summary()),
+                        mode=self.summarizer.mode)
     
     def _clean_question_from_data(self, question):
         """
@@ -249,321 +810,5244 @@ class ConversationManager:
             max_relevant: Maximum number of relevant entries to return
             
         Returns:
-            list: Relevant (question, answer) pairs
+            list: Relevant (question, answer) pairs in conversation order
         """
-        if not self.history:
-            return []
-        
-        # Extract keywords from current question
-        keywords = set(word.lower() for word in current_question.split()
-                      if len(word) > 3)
-        
-        # Score each history entry based on keyword matches
-        scored_history = []
-        for q, a in self.history:
-            q_words = set(word.lower() for word in q.split() if len(word) > 3)
-            score = len(keywords.intersection(q_words))
-            scored_history.append((score, q, a))
-        
-        # Sort by relevance score
-        scored_history.sort(key=lambda x: x[0], reverse=True)
-        
-        # Return most relevant entries
-        relevant_history = []
-        for score, q, a in scored_history[:max_relevant]:
-            if score > 0 or len(relevant_history) < 1:
-                relevant_history.append((q, a))
-        
-        return relevant_history
+        with self.lock:
+            if not self.history:
+                return []
+            
+            scores = self.index.search(current_question)
+            
+            # Highest score first, most recent first among ties
+            ranked = np.lexsort((-np.arange(len(scores)), -scores))[:max_relevant]
+            selected = [i for i in ranked if scores[i] > 0]
+            if not selected:
+                # Fall back to the latest exchange for continuity
+                selected = [len(self.history) - 1]
+            
+            return [self.history[i] for i in sorted(selected)]
     
     def get_data_context_note(self):
         """Returns a note about data context if established"""
         if self.data_context_established:
-            return "Note: The same complete dataset was provided in all previous exchanges."
+            return "Note: The same dataset summary was provided in all previous exchanges."
         return ""
     
     def clear_history(self):
         """Clears all conversation history"""
-        self.history = []
-        self.data_context_established = False
+        with self.lock:
+            self.history = []
+            self.index.clear()
+            self.data_context_established = False
+            self.compacted = 0
+            self.summary_lines.clear()
+            self.earlier_topics.clear()
+            self.generation += 1
 
 
-class DataManager:
+class ConversationIndex:
     """
-    Manages data loading and processing for a company.
+    Incremental BM25 index over conversation questions.
     
-    Features:
-    - Database connection testing
-    - Data loading from MySQL
-    - Error handling and reporting
+    Each turn is stored once as a sparse term vector (term ids and counts)
+    and as a row of a dense NumPy term-frequency matrix. Queries score all
+    turns with a single matrix-vector product over the query's terms, so
+    ranking stays fast for hundreds of turns.
     """
     
-    def __init__(self, company_manager):
-        self.company_manager = company_manager
-        self.data = "Data unavailable - not yet loaded."
-        self.raw_data_df = None
-        self.initialization_attempted = False
-        self.connection_error = None
+    STOPWORDS = frozenset(
+        "a an and are as at be but by can could did do does for from had has have how i if in "
+        "into is it its me my of on or our should so than that the their them then there these "
+        "they this to was we were what when where which who why will with would you your".split()
+    )
+    SUFFIXES = ('ations', 'ation', 'ments', 'ment', 'ness', 'ings', 'ing', 'ies', 'ied',
+                'ers', 'er', 'ed', 'es', 'ly', 's')
     
-    def test_database_connection(self):
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.clear()
+    
+    def clear(self):
+        """Removes every document from the index"""
+        self.vocabulary = {}
+        self.doc_vectors = []
+        self.term_freq = np.zeros((16, 64), dtype=np.float32)
+        self.doc_lengths = np.zeros(16, dtype=np.float32)
+        self.doc_freq = np.zeros(64, dtype=np.float32)
+        self.start = 0
+    
+    @classmethod
+    def tokenize(cls, text):
         """
-        Tests database connection and validates configuration.
+        Splits text into lowercase, lightly stemmed terms without stopwords.
         
+        Args:
+            text: Text to tokenize
+            
         Returns:
-            bool: True if connection successful, False otherwise
+            list: Terms
         """
-        try:
-            # Check for required environment variables
-            if not all([MYSQL_USER, MYSQL_PASSWORD, self.company_manager.mysql_db, INSTANCE_CONNECTION_NAME]):
-                missing = []
-                if not MYSQL_USER: missing.append("MYSQL_USER")
-                if not MYSQL_PASSWORD: missing.append("MYSQL_PASSWORD")
-                if not self.company_manager.mysql_db: missing.append(f"MYSQL_DB for {self.company_manager.company_id}")
-                if not INSTANCE_CONNECTION_NAME: missing.append("INSTANCE_CONNECTION_NAME")
-                error_msg = f"Missing environment variables: {', '.join(missing)}"
-                self.connection_error = error_msg
-                return False
+        terms = []
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            if len(word) < 2 or word in cls.STOPWORDS:
+                continue
+            for suffix in cls.SUFFIXES:
+                if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                    word = word[:-len(suffix)] + ('y' if suffix in ('ies', 'ied') else '')
+                    break
+            terms.append(word)
+        return terms
+    
+    def add(self, text):
+        """
+        Indexes a document at the end of the index.
+        
+        Args:
+            text: Document text
+        """
+        terms = self.tokenize(text)
+        for term in terms:
+            if term not in self.vocabulary:
+                self.vocabulary[term] = len(self.vocabulary)
+        term_ids, counts = np.unique(np.array([self.vocabulary[t] for t in terms], dtype=np.int64),
+                                     return_counts=True)
+        
+        self._ensure_capacity(self.start + len(self.doc_vectors) + 1, len(self.vocabulary))
+        # Compaction may have moved the live rows, so the row is computed afterwards
+        row = self.start + len(self.doc_vectors)
+        self.term_freq[row, term_ids] = counts
+        self.doc_lengths[row] = len(terms)
+        self.doc_freq[term_ids] += 1
+        self.doc_vectors.append((term_ids, counts))
+    
+    def remove_oldest(self):
+        """Removes the oldest document from the index"""
+        if not self.doc_vectors:
+            return
+        term_ids, _ = self.doc_vectors.pop(0)
+        self.doc_freq[term_ids] -= 1
+        self.term_freq[self.start] = 0
+        self.doc_lengths[self.start] = 0
+        self.start += 1
+    
+    def search(self, text):
+        """
+        Scores every indexed document against a query with BM25.
+        
+        Args:
+            text: Query text
             
-            # Attempt connection
-            conn = mysql.connector.connect(
-                user=MYSQL_USER,
-                password=MYSQL_PASSWORD,
-                database=self.company_manager.mysql_db,
-                unix_socket=f"/cloudsql/{INSTANCE_CONNECTION_NAME}",
-                connect_timeout=15,
-                autocommit=True
-            )
+        Returns:
+            ndarray: One score per document, oldest first
+        """
+        count = len(self.doc_vectors)
+        query_ids = sorted({self.vocabulary[t] for t in self.tokenize(text) if t in self.vocabulary})
+        if not count or not query_ids:
+            return np.zeros(count, dtype=np.float32)
+        
+        rows = slice(self.start, self.start + count)
+        doc_freq = self.doc_freq[query_ids]
+        idf = np.log1p((count - doc_freq + 0.5) / (doc_freq + 0.5))
+        
+        lengths = self.doc_lengths[rows]
+        avg_length = max(lengths.mean(), 1.0)
+        tf = self.term_freq[rows][:, query_ids]
+        norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+        weights = tf * (self.k1 + 1) / (tf + norm[:, None])
+        return weights @ idf
+    
+    def _ensure_capacity(self, rows, terms):
+        """Grows (or compacts) the dense matrix to fit the given rows and terms"""
+        height, width = self.term_freq.shape
+        count = len(self.doc_vectors)
+        if rows <= height and terms <= width:
+            return
+        
+        new_height = max(height, 16)
+        while count + 1 > new_height // 2 and rows > height:
+            new_height *= 2
+        new_width = width
+        while terms > new_width:
+            new_width *= 2
+        
+        # Copy live rows to the top, dropping rows freed by remove_oldest
+        term_freq = np.zeros((new_height, new_width), dtype=np.float32)
+        term_freq[:count, :width] = self.term_freq[self.start:self.start + count]
+        doc_lengths = np.zeros(new_height, dtype=np.float32)
+        doc_lengths[:count] = self.doc_lengths[self.start:self.start + count]
+        doc_freq = np.zeros(new_width, dtype=np.float32)
+        doc_freq[:width] = self.doc_freq
+        
+        self.term_freq, self.doc_lengths, self.doc_freq = term_freq, doc_lengths, doc_freq
+        self.start = 0
+
+
+class ConversationSummarizer:
+    """
+    Condenses conversation answers for the compacted part of the history.
+    
+    The extractive mode keeps the answer's most informative sentences
+    (frequent terms, figures) in their original order, without any API
+    call. The model mode asks the cheapest Gemini tier for a summary and
+    falls back to the extractive one if the call fails.
+    """
+    
+    MODES = ("extractive", "model", "off")
+    SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+    
+    def __init__(self, mode=CONVERSATION_SUMMARY_MODE, turn_chars=CONVERSATION_TURN_SUMMARY_CHARS,
+                 summary_chars=CONVERSATION_SUMMARY_CHARS):
+        if mode not in self.MODES:
+            raise ValueError(f"CONVERSATION_SUMMARY_MODE must be one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.turn_chars = turn_chars
+        self.summary_chars = summary_chars
+    
+    @property
+    def enabled(self):
+        return self.mode != "off"
+    
+    def summarize(self, question, answer):
+        """
+        Summarizes one answer.
+        
+        Args:
+            question: Question the answer responds to
+            answer: Answer text
             
-            # Test with simple query
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
+        Returns:
+            str: Summary of at most turn_chars characters
+        """
+        if len(answer) <= self.turn_chars:
+            return answer
+        if self.mode == "model":
+            summary = self._model_summary(question, answer)
+            if summary:
+                return summary[:self.turn_chars]
+        return self.extract(answer, self.turn_chars, question)
+    
+    @classmethod
+    def extract(cls, text, max_chars, query=""):
+        """
+        Picks the highest-scoring sentences that fit in max_chars.
+        
+        Sentences score by how common their terms are across the text, with
+        bonuses for terms from the query and for quoted figures. Sentences
+        that mostly repeat an already selected one are skipped.
+        
+        Args:
+            text: Text to condense
+            max_chars: Character budget
+            query: Question the text answers, if any
             
-            self.connection_error = None
-            return True
+        Returns:
+            str: Selected sentences in their original order
+        """
+        if len(text) <= max_chars:
+            return text
+        
+        sentences = [sentence.strip(" -*#\t") for sentence in cls.SENTENCE_PATTERN.split(text)]
+        sentences = [sentence for sentence in sentences if len(sentence) > 3]
+        sentence_terms = [set(ConversationIndex.tokenize(sentence)) for sentence in sentences]
+        term_counts = {}
+        for terms in sentence_terms:
+            for term in terms:
+                term_counts[term] = term_counts.get(term, 0) + 1
+        query_terms = set(ConversationIndex.tokenize(query))
+        
+        scores = []
+        for position, (sentence, terms) in enumerate(zip(sentences, sentence_terms)):
+            score = sum(term_counts[term] for term in terms) / (len(terms) + 1) ** 0.5
+            score *= 1 + len(terms & query_terms)
+            if re.search(r"\d", sentence):
+                score *= 1.5
+            scores.append((score, -position))
+        
+        selected, used = [], 0
+        for _, negative_position in sorted(scores, reverse=True):
+            position = -negative_position
+            sentence, terms = sentences[position], sentence_terms[position]
+            if used + len(sentence) + 1 > max_chars:
+                continue
+            if any(len(terms & sentence_terms[other]) > 0.6 * len(terms | sentence_terms[other])
+                   for other in selected):
+                continue
+            selected.append(position)
+            used += len(sentence) + 1
+        
+        if not selected:
+            return text[:max_chars - 3].rstrip() + "..."
+        return " ".join(sentences[position] for position in sorted(selected))
+    
+    def _model_summary(self, question, answer):
+        """Asks the cheapest model tier for a summary; returns None on failure"""
+        model = next(iter(MODEL_TIERS.values()))["model"]
+        prompt = (f"Summarize this answer to a marketing question in at most {self.turn_chars} characters. "
+                  f"Keep figures, names and recommendations; no preamble.\n\n"
+                  f"Question: {question}\nAnswer: {answer}")
+        try:
+            response = gemini_client.generate(model, prompt)
+            if response.parts and response.text:
+                return response.text.strip()
+        except Exception as e:
+            print(f"Model summary failed, using extractive summary: {e}")
+        return None
+
+
+conversation_summarizer = ConversationSummarizer()
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+
+class DataDigestBuilder:
+    """
+    Builds a compact statistical digest of a company's dataset.
+
+    The digest is sent to the AI model instead of raw CSV rows. Every
+    statistic is computed over the whole DataFrame with vectorized
+    pandas/NumPy operations, so answers reflect all records.
+
+    Sections:
+    - Per-column profiles (type, completeness, distinct values, ranges)
+    - Top-k value counts for categorical columns
+    - Time-bucketed record counts and numeric totals
+    - Group-by aggregates and cross-tabs between low-cardinality columns
+    """
+
+    DATE_PATTERN = r'\d{4}-\d{1,2}-\d{1,2}|\d{1,2}/\d{1,2}/\d{2,4}'
+    MAX_GROUP_CARDINALITY = 12
+    MAX_MEASURES = 3
+    TIME_BUCKETS = (('D', 'day', 1), ('W', 'week', 7), ('M', 'month', 31),
+                    ('Q', 'quarter', 92), ('Y', 'year', 366))
+
+    def __init__(self, data_df, top_k=DIGEST_TOP_K, max_time_buckets=DIGEST_MAX_TIME_BUCKETS,
+                 max_crosstabs=DIGEST_MAX_CROSSTABS, scope=None):
+        self.df = data_df
+        self.scope = scope
+        self.top_k = top_k
+        self.max_time_buckets = max_time_buckets
+        self.max_crosstabs = max_crosstabs
+
+    def build(self):
+        """
+        Builds the digest text.
+
+        Returns:
+            str: Multi-section statistical summary of the dataset
+        """
+        if self.df is None or self.df.empty:
+            return "No data available."
+
+        numeric, datetimes, categorical, identifiers = self.classify_columns()
+        measures = numeric[:self.MAX_MEASURES]
+        group_columns = [col for col in categorical
+                         if 2 <= self.df[col].nunique() <= self.MAX_GROUP_CARDINALITY]
+
+        scope = self.scope or f"all {len(self.df):,} loaded records"
+        sections = [
+            f"Statistical digest of {scope} "
+            f"({len(self.df.columns)} columns, computed over every row):",
+            self._column_profiles(numeric, datetimes, categorical, identifiers),
+            self._top_values(categorical),
+            self._time_buckets(datetimes, measures),
+            self._group_aggregates(group_columns, measures),
+            self._crosstabs(group_columns)
+        ]
+        return "\n\n".join(section for section in sections if section)
+
+    def classify_columns(self):
+        """
+        Splits columns into numeric, datetime, categorical and identifier groups.
+
+        Text columns that look like dates are parsed once and kept on the
+        builder so later sections can bucket them.
+        """
+        numeric, datetimes, categorical, identifiers = [], [], [], []
+        self.parsed_dates = {}
+
+        for col in self.df.columns:
+            series = self.df[col]
+            name = str(col).lower()
+
+            if pd.api.types.is_bool_dtype(series):
+                categorical.append(col)
+            elif pd.api.types.is_numeric_dtype(series):
+                if name == 'id' or name.endswith('_id'):
+                    identifiers.append(col)
+                else:
+                    numeric.append(col)
+            elif pd.api.types.is_datetime64_any_dtype(series):
+                self.parsed_dates[col] = series
+                datetimes.append(col)
+            elif self._looks_like_dates(series):
+                self.parsed_dates[col] = pd.to_datetime(series.astype(object), errors='coerce')
+                datetimes.append(col)
+            else:
+                non_null = series.count()
+                distinct = series.nunique()
+                if non_null and distinct > 50 and distinct / non_null > 0.9:
+                    identifiers.append(col)
+                else:
+                    categorical.append(col)
+
+        return numeric, datetimes, categorical, identifiers
+
+    def _looks_like_dates(self, series):
+        """Checks whether a text column holds date strings, using a small sample"""
+        sample = series.dropna().head(200).astype(str)
+        if sample.empty:
+            return False
+        return sample.str.contains(self.DATE_PATTERN, regex=True).mean() >= 0.9
+
+    def _column_profiles(self, numeric, datetimes, categorical, identifiers):
+        """Returns one profile line per column"""
+        total = len(self.df)
+        non_null = self.df.count()
+        lines = ["Column profiles:"]
+
+        if numeric:
+            stats = self.df[numeric].agg(['min', 'mean', 'max', 'sum'])
+            quantiles = self.df[numeric].quantile([0.25, 0.5, 0.75])
+
+        for col in self.df.columns:
+            prefix = f"- {col}: {non_null[col]:,}/{total:,} non-null"
+            if col in numeric:
+                lines.append(
+                    f"{prefix}, numeric, min {_format_number(stats.at['min', col])}, "
+                    f"p25 {_format_number(quantiles.at[0.25, col])}, "
+                    f"median {_format_number(quantiles.at[0.5, col])}, "
+                    f"p75 {_format_number(quantiles.at[0.75, col])}, "
+                    f"max {_format_number(stats.at['max', col])}, "
+                    f"mean {_format_number(stats.at['mean', col])}, "
+                    f"sum {_format_number(stats.at['sum', col])}"
+                )
+            elif col in datetimes:
+                dates = self.parsed_dates[col]
+                lines.append(f"{prefix}, date, from {dates.min()} to {dates.max()}")
+            elif col in identifiers:
+                lines.append(f"{prefix}, identifier, {self.df[col].nunique():,} distinct")
+            else:
+                lines.append(f"{prefix}, categorical, {self.df[col].nunique():,} distinct")
+
+        return "\n".join(lines)
+
+    def _top_values(self, categorical):
+        """Returns the most frequent values of each categorical column"""
+        if not categorical:
+            return ""
+
+        lines = [f"Top {self.top_k} values per categorical column (count, share):"]
+        for col in categorical:
+            counts = self.df[col].value_counts(dropna=True)
+            if counts.empty:
+                continue
+            total = counts.sum()
+            top = counts.head(self.top_k)
+            parts = [f"{value} {count:,} ({count / total:.1%})" for value, count in top.items()]
+            remainder = total - top.sum()
+            if remainder:
+                parts.append(f"other {remainder:,} ({remainder / total:.1%})")
+            lines.append(f"- {col}: " + "; ".join(parts))
+
+        return "\n".join(lines)
+
+    def _time_buckets(self, datetimes, measures):
+        """Returns record counts and numeric totals per time bucket"""
+        if not datetimes:
+            return ""
+
+        col = datetimes[0]
+        dates = self.parsed_dates[col]
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        valid = dates.notna()
+        if not valid.any():
+            return ""
+
+        span_days = (dates[valid].max() - dates[valid].min()).days
+        freq, label = next(((freq, label) for freq, label, days in self.TIME_BUCKETS
+                            if span_days / days <= self.max_time_buckets), ('Y', 'year'))
+
+        periods = dates[valid].dt.to_period(freq)
+        grouped = self.df.loc[valid, measures].groupby(periods)
+        summary = grouped.sum()
+        summary.insert(0, 'records', grouped.size())
+
+        lines = [f"Records per {label} by '{col}' (most recent {self.max_time_buckets}):"]
+        hidden = len(summary) - self.max_time_buckets
+        if hidden > 0:
+            lines.append(f"({hidden} earlier {label} buckets omitted, "
+                         f"{summary['records'].iloc[:hidden].sum():,} records)")
+        for period, row in summary.tail(self.max_time_buckets).iterrows():
+            values = ", ".join(f"{name} {_format_number(value)}" for name, value in row.items())
+            lines.append(f"- {period}: {values}")
+
+        return "\n".join(lines)
+
+    def _group_aggregates(self, group_columns, measures):
+        """Returns numeric totals and means per group of low-cardinality columns"""
+        if not group_columns or not measures:
+            return ""
+
+        lines = ["Group-by aggregates (records, sum/mean of numeric columns):"]
+        for col in group_columns[:self.max_crosstabs]:
+            grouped = self.df.groupby(col, observed=True)[measures]
+            sums = grouped.sum()
+            means = grouped.mean()
+            sizes = grouped.size().sort_values(ascending=False).head(self.top_k)
+            lines.append(f"- by {col}:")
+            for value, size in sizes.items():
+                values = ", ".join(
+                    f"{measure} sum {_format_number(sums.at[value, measure])} "
+                    f"mean {_format_number(means.at[value, measure])}"
+                    for measure in measures
+                )
+                lines.append(f"  {value}: {size:,} records, {values}")
+
+        return "\n".join(lines)
+
+    def _crosstabs(self, group_columns):
+        """Returns record counts for pairs of low-cardinality columns"""
+        if len(group_columns) < 2:
+            return ""
+
+        pairs = [(a, b) for i, a in enumerate(group_columns) for b in group_columns[i + 1:]]
+        lines = ["Cross-tabs (record counts):"]
+        for row_col, col_col in pairs[:self.max_crosstabs]:
+            table = pd.crosstab(self.df[row_col], self.df[col_col])
+            lines.append(f"- {row_col} x {col_col}: columns " +
+                         " | ".join(str(value) for value in table.columns))
+            for value, counts in table.iterrows():
+                lines.append(f"  {value}: " + " | ".join(f"{count:,}" for count in counts))
+
+        return "\n".join(lines)
+
+
+def _format_number(value):
+    """Formats a statistic compactly for the digest"""
+    if pd.isna(value):
+        return "n/a"
+    if float(value).is_integer():
+        return f"{value:,.0f}"
+    if abs(value) >= 1000:
+        return f"{value:,.1f}"
+    return f"{value:.4g}"
+
+
+class DatasetIndex:
+    """
+    In-memory inverted index over a loaded dataset for question-aware retrieval.
+    
+    Indexes categorical values (value phrase -> row positions), column names
+    (stemmed name terms -> columns) and the primary date column (sorted
+    timestamps -> row positions). A question is matched against all three to
+    select only the rows and columns it is about; questions that match
+    nothing fall back to the full digest.
+    """
+    
+    MAX_PHRASE_WORDS = 4
+    MAX_CACHED = 64
+    MONTHS = {name: number for number, names in enumerate(
+        (('january', 'jan'), ('february', 'feb'), ('march', 'mar'), ('april', 'apr'),
+         ('may',), ('june', 'jun'), ('july', 'jul'), ('august', 'aug'),
+         ('september', 'sep', 'sept'), ('october', 'oct'), ('november', 'nov'),
+         ('december', 'dec')), start=1) for name in names}
+    
+    def __init__(self, data_df, max_distinct=DATA_INDEX_MAX_DISTINCT):
+        self.df = data_df
+        self.values = {}
+        self.postings = {}
+        self.column_terms = {}
+        self.date_column = None
+        self.summaries = OrderedDict()
+        self.lock = threading.Lock()
+        
+        builder = DataDigestBuilder(data_df)
+        _, datetimes, categorical, _ = builder.classify_columns()
+        for col in categorical:
+            self._index_values(col, max_distinct)
+        for col in data_df.columns:
+            for term in ConversationIndex.tokenize(str(col).replace('_', ' ')):
+                self.column_terms.setdefault(term, []).append(col)
+        if datetimes:
+            self._index_dates(datetimes[0], builder.parsed_dates[datetimes[0]])
+    
+    def _index_values(self, col, max_distinct):
+        """Builds phrase -> (column, value code) entries and per-value row postings"""
+        codes, uniques = pd.factorize(self.df[col])
+        if len(uniques) > max_distinct:
+            return
+        
+        codes = np.asarray(codes)
+        valid = np.flatnonzero(codes >= 0)
+        order = valid[np.argsort(codes[valid], kind='stable')]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(codes[valid], minlength=len(uniques)))))
+        self.postings[col] = (order, offsets, uniques)
+        
+        for code, value in enumerate(uniques):
+            words = re.findall(r"[a-z0-9]+", str(value).lower())
+            if not words or len(words) > self.MAX_PHRASE_WORDS:
+                continue
+            phrase = " ".join(words)
+            if phrase.isdigit() or len(phrase) < 2 or phrase in ConversationIndex.STOPWORDS:
+                continue
+            self.values.setdefault(phrase, []).append((col, code))
+    
+    def _index_dates(self, col, dates):
+        """Keeps row positions of the date column sorted by timestamp"""
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        values = dates.to_numpy(dtype='datetime64[ns]')
+        valid = np.flatnonzero(~np.isnat(values))
+        if not len(valid):
+            return
+        order = valid[np.argsort(values[valid], kind='stable')]
+        self.date_column = col
+        self.date_order = order
+        self.date_values = values[order]
+    
+    def search(self, question):
+        """
+        Matches a question against the index.
+        
+        Args:
+            question: User's question
+            
+        Returns:
+            tuple: (row positions or None for all rows, relevant columns,
+                filter descriptions), or None if nothing matched
+        """
+        words = re.findall(r"[a-z0-9]+", question.lower())
+        
+        # Value matches, longest phrase first: union within a column, intersection across columns
+        matched = {}
+        covered = set()
+        for size in range(self.MAX_PHRASE_WORDS, 0, -1):
+            for start in range(len(words) - size + 1):
+                span = range(start, start + size)
+                if covered.intersection(span):
+                    continue
+                phrase = " ".join(words[start:start + size])
+                entries = self.values.get(phrase)
+                if entries is None and size == 1 and phrase.endswith('s'):
+                    entries = self.values.get(phrase[:-1])
+                for col, code in entries or ():
+                    matched.setdefault(col, set()).add(code)
+                if entries:
+                    covered.update(span)
+        
+        rows = None
+        filters = []
+        for col, codes in matched.items():
+            order, offsets, uniques = self.postings[col]
+            positions = np.concatenate([order[offsets[code]:offsets[code + 1]] for code in sorted(codes)])
+            rows = np.sort(positions) if rows is None else np.intersect1d(rows, positions, assume_unique=True)
+            filters.append(f"{col} in ({', '.join(str(uniques[code]) for code in sorted(codes))})"
+                           if len(codes) > 1 else f"{col} = {uniques[next(iter(codes))]}")
+        
+        date_range = self._parse_date_range(question, words)
+        if date_range is not None:
+            start, end = date_range
+            lo, hi = np.searchsorted(self.date_values, [np.datetime64(start), np.datetime64(end)])
+            positions = np.sort(self.date_order[lo:hi])
+            rows = positions if rows is None else np.intersect1d(rows, positions, assume_unique=True)
+            filters.append(f"{self.date_column} from {start.date()} to {(end - pd.Timedelta(days=1)).date()}")
+        
+        terms = set(ConversationIndex.tokenize(question))
+        named = {col for term in terms for col in self.column_terms.get(term, ())}
+        if rows is None and not named:
+            return None
+        
+        columns = []
+        if named:
+            keep = named | set(matched)
+            if self.date_column is not None:
+                keep.add(self.date_column)
+            columns = [col for col in self.df.columns if col in keep]
+        return rows, columns, filters
+    
+    def _parse_date_range(self, question, words):
+        """
+        Extracts a [start, end) date range from the question.
+        
+        Understands ISO dates, month names with an optional year, bare years
+        and relative phrases (today, yesterday, this/last week|month|year,
+        last N days|weeks|months). Relative phrases are anchored at the latest
+        record when the data ends before today, and month names without a
+        year resolve to the latest such month in the data.
+        """
+        if self.date_column is None:
+            return None
+        
+        latest = pd.Timestamp(self.date_values[-1])
+        today = min(pd.Timestamp.now(), latest).normalize()
+        
+        # Impossible dates such as 2024-13-01 are ignored rather than failing the question
+        iso = pd.to_datetime(pd.Series(re.findall(r"\b(\d{4}-\d{1,2}-\d{1,2})\b", question), dtype=object),
+                             format="%Y-%m-%d", errors="coerce").dropna()
+        if not iso.empty:
+            return iso.min(), iso.max() + pd.Timedelta(days=1)
+        
+        text_lower = " ".join(words)
+        relative = re.search(r"\b(last|past|previous) (\d+) (day|week|month)s?\b", text_lower)
+        if relative:
+            count, unit = int(relative.group(2)), relative.group(3)
+            offset = pd.DateOffset(**{unit + 's': count})
+            return today + pd.Timedelta(days=1) - offset, today + pd.Timedelta(days=1)
+        if re.search(r"\btoday\b", text_lower):
+            return today, today + pd.Timedelta(days=1)
+        if re.search(r"\byesterday\b", text_lower):
+            return today - pd.Timedelta(days=1), today
+        
+        period = re.search(r"\b(this|last|previous) (week|month|year)\b", text_lower)
+        if period:
+            freq = {'week': 'W', 'month': 'M', 'year': 'Y'}[period.group(2)]
+            current = today.to_period(freq)
+            if period.group(1) != 'this':
+                current -= 1
+            return current.start_time, (current + 1).start_time
+        
+        for index, word in enumerate(words):
+            month = self.MONTHS.get(word)
+            if month is None or (word == 'may' and index + 1 < len(words) and not words[index + 1].isdigit()):
+                continue
+            following = words[index + 1] if index + 1 < len(words) else ""
+            if re.fullmatch(r"(19|20)\d{2}", following):
+                year = int(following)
+            else:
+                year = latest.year if month <= latest.month else latest.year - 1
+            start = pd.Timestamp(year=year, month=month, day=1)
+            return start, start + pd.DateOffset(months=1)
+        
+        years = [int(word) for word in words if re.fullmatch(r"(19|20)\d{2}", word)]
+        if years:
+            return pd.Timestamp(year=min(years), month=1, day=1), pd.Timestamp(year=max(years) + 1, month=1, day=1)
+        return None
+    
+    def retrieve(self, question, max_rows=DATA_RETRIEVAL_MAX_ROWS):
+        """
+        Returns the dataset text relevant to a question.
+        
+        Small matching subsets are sent as CSV rows; larger ones are
+        summarized with a digest of just the matching rows and columns.
+        
+        Args:
+            question: User's question
+            max_rows: Largest subset sent as raw rows
+            
+        Returns:
+            str: Retrieved data text, or None if nothing in the question
+                matched the data (the caller falls back to the full digest)
+        """
+        match = self.search(question)
+        if match is None:
+            return None
+        rows, columns, filters = match
+        if rows is not None and not len(rows):
+            return None
+        
+        key = (tuple(filters), tuple(columns))
+        with self.lock:
+            if key in self.summaries:
+                self.summaries.move_to_end(key)
+                return self.summaries[key]
+        
+        subset = self.df if rows is None else self.df.iloc[rows]
+        if columns:
+            subset = subset[columns]
+        total = len(self.df)
+        scope = (f"{len(subset):,} of {total:,} loaded records matching "
+                 f"{'; '.join(filters)}" if filters else f"all {total:,} loaded records")
+        header = (f"Data retrieved for this question: {scope}.\n"
+                  f"Columns shown: {', '.join(map(str, subset.columns))} "
+                  f"(dataset has {len(self.df.columns)} columns: {', '.join(map(str, self.df.columns))})")
+        
+        if len(subset) <= max_rows:
+            text_data = f"{header}\n\n{subset.to_csv(index=False)}"
+        else:
+            text_data = f"{header}\n\n{DataDigestBuilder(subset, scope=scope).build()}"
+        
+        with self.lock:
+            self.summaries[key] = text_data
+            if len(self.summaries) > self.MAX_CACHED:
+                self.summaries.popitem(last=False)
+        return text_data
+
+
+class KpiCube:
+    """
+    Precomputed aggregates of a dataset over its low-cardinality dimensions.
+    
+    Categorical columns with at most KPI_CUBE_MAX_CARDINALITY values, plus
+    week and month buckets of the primary date column, are dictionary-encoded
+    with pd.factorize. Each combination of dimension values present in the
+    data is one cell. Cells are stored as columnar NumPy arrays: one code
+    array per dimension, the record count, and per numeric measure the sum
+    and non-null count (np.bincount over the cell ids). Queries filter and
+    regroup the cells, never the raw rows.
+    
+    At most MAX_DIMENSIONS categorical dimensions are used, narrowest
+    first. If the cells would exceed KPI_CUBE_MAX_CELLS, the
+    highest-cardinality categorical dimensions are dropped until they fit.
+    """
+    
+    MAX_MEASURES = 8
+    MAX_DIMENSIONS = 8
+    MISSING = "(missing)"
+    
+    def __init__(self, data_df, max_cardinality=KPI_CUBE_MAX_CARDINALITY, max_cells=KPI_CUBE_MAX_CELLS):
+        started = time.perf_counter()
+        self.records = len(data_df)
+        self.labels = {}
+        
+        builder = DataDigestBuilder(data_df)
+        numeric, datetimes, categorical, _ = builder.classify_columns()
+        self.measures = [str(col) for col in numeric[:self.MAX_MEASURES]]
+        
+        cardinality = {col: data_df[col].nunique(dropna=False) for col in categorical}
+        eligible = [col for col in categorical if cardinality[col] <= max_cardinality]
+        eligible = sorted(eligible, key=lambda col: cardinality[col])[:self.MAX_DIMENSIONS]
+        codes = {}
+        for col in categorical:
+            if col in eligible:
+                codes[str(col)], self.labels[str(col)] = self._encode(data_df[col])
+        self.date_column = datetimes[0] if datetimes else None
+        if self.date_column is not None:
+            dates = builder.parsed_dates[self.date_column]
+            for name, freq in (("week", "W"), ("month", "M")):
+                if name not in codes:
+                    buckets = dates.dt.to_period(freq).dt.start_time.dt.strftime("%Y-%m-%d")
+                    codes[name], self.labels[name] = self._encode(buckets)
+        
+        # Drop the widest categorical dimensions until the cell count is bounded
+        while codes:
+            cell_ids, first_rows = self._combine(list(codes.values()))
+            if len(first_rows) <= max_cells:
+                break
+            droppable = [name for name in codes if name not in ("week", "month")] or list(codes)
+            widest = max(droppable, key=lambda name: len(self.labels[name]))
+            del codes[widest], self.labels[widest]
+        
+        self.dimensions = list(codes)
+        if codes:
+            self.cell_codes = {name: codes[name][first_rows] for name in self.dimensions}
+        else:
+            cell_ids, self.cell_codes = np.zeros(self.records, dtype=np.int64), {}
+        
+        cells = int(cell_ids.max()) + 1 if self.records else 0
+        self.cell_count = cells
+        self.counts = np.bincount(cell_ids, minlength=cells)
+        self.sums, self.non_null = {}, {}
+        for measure in self.measures:
+            values = pd.to_numeric(data_df[measure], errors='coerce').to_numpy(dtype=float)
+            present = ~np.isnan(values)
+            self.sums[measure] = np.bincount(cell_ids, weights=np.where(present, values, 0.0), minlength=cells)
+            self.non_null[measure] = np.bincount(cell_ids, weights=present, minlength=cells)
+        
+        self.lookup = {name: {label: code for code, label in enumerate(labels)}
+                       for name, labels in self.labels.items()}
+        self.build_seconds = time.perf_counter() - started
+    
+    @classmethod
+    def _encode(cls, series):
+        """Dictionary-encodes a column, returning (int codes, labels)"""
+        codes, uniques = pd.factorize(series, use_na_sentinel=False)
+        labels = [cls.MISSING if pd.isna(value) else str(value) for value in uniques]
+        return codes.astype(np.int64), labels
+    
+    @staticmethod
+    def _combine(code_arrays):
+        """
+        Combines per-dimension codes into dense group ids.
+        
+        Dimensions are folded in one at a time and the ids re-densified after
+        each, so intermediate keys stay below rows x cardinality however many
+        dimensions there are (a single mixed-radix key would overflow int64).
+        
+        Args:
+            code_arrays: Equal-length non-negative int arrays, one per dimension
+            
+        Returns:
+            tuple: (group id per position, index of the first position of each group)
+        """
+        ids = np.zeros(len(code_arrays[0]), dtype=np.int64)
+        for codes in code_arrays:
+            keys = ids * (int(codes.max()) + 1 if len(codes) else 1) + codes
+            ids = np.unique(keys, return_inverse=True)[1].ravel()
+        _, first_rows = np.unique(ids, return_index=True)
+        return ids, first_rows
+    
+    def query(self, dims=(), filters=None, limit=100):
+        """
+        Aggregates the cube.
+        
+        Args:
+            dims: Dimensions to group by (none for grand totals)
+            filters: Mapping of dimension to the list of values to keep
+            limit: Maximum number of groups returned, largest first
+            
+        Returns:
+            dict: Groups with record counts and measure sums/means, plus
+                the number of groups and records matched
+            
+        Raises:
+            ValueError: If a dimension is unknown or repeated, or limit is below 1
+        """
+        filters = filters or {}
+        unknown = [name for name in list(dims) + list(filters) if name not in self.cell_codes]
+        if unknown:
+            raise ValueError(f"Unknown dimension(s): {', '.join(unknown)}. "
+                             f"Available: {', '.join(self.dimensions) or 'none'}")
+        repeated = sorted({name for name in dims if list(dims).count(name) > 1})
+        if repeated:
+            raise ValueError(f"Repeated dimension(s): {', '.join(repeated)}")
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, got {limit}")
+        
+        mask = np.ones(self.cell_count, dtype=bool)
+        for name, values in filters.items():
+            wanted = [self.lookup[name][value] for value in values if value in self.lookup[name]]
+            mask &= np.isin(self.cell_codes[name], wanted)
+        cells = np.flatnonzero(mask)
+        
+        if dims and len(cells):
+            dim_codes = [self.cell_codes[name][cells] for name in dims]
+            group_ids, first_cells = self._combine(dim_codes)
+            group_codes = [codes[first_cells] for codes in dim_codes]
+        elif dims:
+            group_ids = np.zeros(0, dtype=np.int64)
+            group_codes = [np.zeros(0, dtype=np.int64) for _ in dims]
+        else:
+            group_ids = np.zeros(len(cells), dtype=np.int64)
+            group_codes = []
+        groups = len(group_codes[0]) if dims else 1
+        
+        counts = np.bincount(group_ids, weights=self.counts[cells], minlength=groups)
+        sums = {m: np.bincount(group_ids, weights=self.sums[m][cells], minlength=groups) for m in self.measures}
+        non_null = {m: np.bincount(group_ids, weights=self.non_null[m][cells], minlength=groups)
+                    for m in self.measures}
+        
+        order = np.argsort(-counts, kind='stable')[:limit]
+        rows = []
+        for group in order:
+            row = {name: self.labels[name][group_codes[i][group]] for i, name in enumerate(dims)}
+            row["records"] = int(counts[group])
+            for measure in self.measures:
+                row[f"{measure}_sum"] = round(float(sums[measure][group]), 4)
+                row[f"{measure}_mean"] = (round(float(sums[measure][group] / non_null[measure][group]), 4)
+                                          if non_null[measure][group] else None)
+            rows.append(row)
+        
+        return {"dimensions": list(dims), "filters": filters, "groups": groups,
+                "records": int(counts.sum()), "rows": rows}
+    
+    def describe(self):
+        """Returns the cube's shape for status reporting"""
+        return {"dimensions": {name: len(self.labels[name]) for name in self.dimensions},
+                "measures": self.measures, "cells": self.cell_count, "records": self.records,
+                "date_column": None if self.date_column is None else str(self.date_column),
+                "build_ms": round(self.build_seconds * 1000, 2)}
+    
+    def prompt_section(self, max_rows):
+        """
+        Returns a compact KPI table for the AI prompt.
+        
+        Lists record counts and measure totals for the largest combinations
+        of the two lowest-cardinality dimensions, so the prompt carries exact
+        aggregates over every row instead of raw sample rows.
+        
+        Args:
+            max_rows: Maximum table rows
+            
+        Returns:
+            str: Section text, or None if the cube has no dimensions or max_rows is 0
+        """
+        dims = sorted((name for name in self.dimensions if name not in ("week", "month")),
+                      key=lambda name: len(self.labels[name]))[:2]
+        if not dims or max_rows < 1:
+            return None
+        result = self.query(dims, limit=max_rows)
+        columns = dims + ["records"] + [f"{m}_sum" for m in self.measures[:DataDigestBuilder.MAX_MEASURES]]
+        table = pd.DataFrame(result["rows"], columns=columns)
+        return (f"Precomputed KPIs by {' x '.join(dims)} (top {len(table)} of {result['groups']:,} "
+                f"combinations, exact over all {self.records:,} records):\n{table.to_csv(index=False)}")
+
+
+class AggregateQueryTool:
+    """
+    Read-only aggregate queries over a company's scans table, for Gemini function calling.
+    
+    Queries from the model are parsed into clauses and rebuilt: a single
+    SELECT from `scans` using at least one aggregate function, with only
+    known columns, declared aliases, allowed functions and keywords (joins,
+    unions, INTO/FOR clauses, subqueries, comments and multiple statements
+    are rejected). The LIMIT is clamped to
+    SQL_TOOL_MAX_ROWS and execution is capped at SQL_TOOL_TIMEOUT_MS
+    (MAX_EXECUTION_TIME hint on MySQL, a progress handler on SQLite).
+    Results are cached by normalized query and data version.
+    """
+    
+    NAME = "query_scans"
+    TABLE = "scans"
+    DECLARATION = {
+        "name": NAME,
+        "description": (
+            "Runs one read-only aggregate SQL query on the `scans` table and returns the result rows. "
+            "Use SELECT with COUNT/SUM/AVG/MIN/MAX, optional WHERE, GROUP BY, HAVING, ORDER BY and LIMIT. "
+            "Joins, subqueries and writes are not allowed."
+        ),
+        "parameters": {
+            "type": "OBJECT",
+            "properties": {"sql": {"type": "STRING", "description": "A single aggregate SELECT on scans"}},
+            "required": ["sql"]
+        }
+    }
+    
+    AGGREGATES = {"COUNT", "SUM", "AVG", "MIN", "MAX"}
+    FUNCTIONS = AGGREGATES | {
+        "ROUND", "ABS", "COALESCE", "IFNULL", "LOWER", "UPPER", "TRIM", "LENGTH",
+        "DATE", "YEAR", "MONTH", "DAY", "WEEK", "YEARWEEK", "QUARTER", "DAYOFWEEK", "HOUR",
+        "DATE_FORMAT", "DATE_SUB", "DATE_ADD", "CURDATE", "NOW", "STRFTIME", "DATETIME"
+    }
+    # Words allowed inside expressions
+    EXPRESSION_KEYWORDS = {
+        "AND", "OR", "NOT", "IN", "IS", "NULL", "BETWEEN", "LIKE", "DISTINCT", "CASE", "WHEN", "THEN",
+        "ELSE", "END", "INTERVAL", "TRUE", "FALSE", "DAY", "WEEK", "MONTH", "QUARTER", "YEAR", "HOUR"
+    }
+    CLAUSES = ("SELECT", "FROM", "WHERE", "GROUP BY", "HAVING", "ORDER BY", "LIMIT")
+    # Rejected anywhere in a query, before any other check
+    FORBIDDEN = {
+        "JOIN", "INNER", "LEFT", "RIGHT", "OUTER", "CROSS", "NATURAL", "STRAIGHT_JOIN", "ON", "USING",
+        "UNION", "EXCEPT", "INTERSECT", "INTO", "OUTFILE", "DUMPFILE", "FOR", "UPDATE", "SHARE", "LOCK",
+        "INSERT", "DELETE", "REPLACE", "DROP", "ALTER", "CREATE", "TRUNCATE", "GRANT", "SET", "CALL",
+        "LOAD", "HANDLER", "WITH", "OFFSET", "PROCEDURE", "WINDOW", "OVER", "PARTITION"
+    }
+    RESERVED = EXPRESSION_KEYWORDS | FORBIDDEN | {
+        "SELECT", "FROM", "WHERE", "GROUP", "BY", "HAVING", "ORDER", "LIMIT", "AS", "ASC", "DESC"
+    }
+    IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+    TOKEN_PATTERN = re.compile(r"""\s*(?:
+        (?P<string>'(?:[^'\\]|\\.|'')*')
+        | (?P<quoted>`[^`]+`)
+        | (?P<number>\d+(?:\.\d+)?)
+        | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+        | (?P<operator><=|>=|<>|!=|[(),*=<>+\-/%])
+        | (?P<other>\S)
+    )""", re.VERBOSE)
+    
+    def __init__(self, company_manager, max_rows=SQL_TOOL_MAX_ROWS, timeout_ms=SQL_TOOL_TIMEOUT_MS,
+                 cache_size=SQL_TOOL_CACHE_SIZE):
+        self.company_manager = company_manager
+        self.max_rows = max_rows
+        self.timeout_ms = timeout_ms
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.columns = None
+        self.schema = None
+        self.stats = {"queries": 0, "cache_hits": 0, "rejected": 0, "errors": 0}
+    
+    def get_columns(self):
+        """Returns the scans table's columns as (name, type) pairs, read once from the database"""
+        if self.columns is None:
+            engine = self.company_manager.get_engine()
+            self.columns = [(column["name"], str(column["type"]))
+                            for column in inspect(engine).get_columns(self.TABLE)]
+        return self.columns
+    
+    def validate(self, sql):
+        """
+        Parses a query against the allowed grammar and rebuilds it.
+        
+        The query is split into SELECT / FROM / WHERE / GROUP BY / HAVING /
+        ORDER BY / LIMIT clauses at the top level; each clause is checked
+        and the statement sent to the database is rebuilt from the parts,
+        so nothing outside the grammar reaches it. Aliases exist only once
+        declared with AS in the select list and are usable only after it.
+        
+        Args:
+            sql: Query text from the model
+            
+        Returns:
+            str: Normalized query with the LIMIT clamped
+            
+        Raises:
+            SqlToolError: If the query is not an allowed aggregate
+        """
+        sql = (sql or "").strip().rstrip(";").strip()
+        if not sql:
+            raise SqlToolError("Empty query.")
+        
+        tokens = self._tokenize(sql)
+        clauses = self._split_clauses(tokens)
+        columns = {name.lower() for name, _ in self.get_columns()}
+        
+        source = clauses.get("FROM", [])
+        if len(source) != 1 or source[0][1].strip('`').lower() != self.TABLE:
+            raise SqlToolError(f"Queries must read FROM {self.TABLE} only, without joins.")
+        
+        select_items, aliases = [], set()
+        for item in self._split_items(clauses["SELECT"], "SELECT"):
+            alias = None
+            if len(item) >= 3 and item[-2][1].upper() == "AS":
+                alias = self._check_alias(item[-1], columns)
+                item = item[:-2]
+            expression = self._check_expression(item, columns)
+            select_items.append(expression + (f" AS {alias}" if alias else ""))
+            if alias:
+                aliases.add(alias.strip('`').lower())
+        select_tokens = clauses["SELECT"]
+        if not any(value.upper() in self.AGGREGATES and following[1] == "("
+                   for (_, value), following in zip(select_tokens, select_tokens[1:])):
+            raise SqlToolError("Queries must aggregate with COUNT, SUM, AVG, MIN or MAX.")
+        
+        statement = f"SELECT {', '.join(select_items)} FROM {self.TABLE}"
+        if "WHERE" in clauses:
+            statement += " WHERE " + self._check_expression(clauses["WHERE"], columns)
+        names = columns | aliases
+        if "GROUP BY" in clauses:
+            statement += " GROUP BY " + ", ".join(
+                self._check_expression(item, names) for item in self._split_items(clauses["GROUP BY"], "GROUP BY"))
+        if "HAVING" in clauses:
+            statement += " HAVING " + self._check_expression(clauses["HAVING"], names)
+        if "ORDER BY" in clauses:
+            orderings = []
+            for item in self._split_items(clauses["ORDER BY"], "ORDER BY"):
+                direction = ""
+                if item[-1][1].upper() in ("ASC", "DESC"):
+                    direction, item = " " + item[-1][1].upper(), item[:-1]
+                orderings.append(self._check_expression(item, names) + direction)
+            statement += " ORDER BY " + ", ".join(orderings)
+        
+        limit = self.max_rows
+        if "LIMIT" in clauses:
+            value = clauses["LIMIT"]
+            if len(value) != 1 or value[0][0] != "number" or not value[0][1].isdigit():
+                raise SqlToolError("LIMIT must be a single whole number.")
+            limit = min(int(value[0][1]), self.max_rows)
+        return f"{statement} LIMIT {limit}"
+    
+    def _tokenize(self, sql):
+        """Splits a query into (kind, text) tokens, rejecting comments and forbidden words"""
+        tokens = [(match.lastgroup, match.group(match.lastgroup)) for match in self.TOKEN_PATTERN.finditer(sql)]
+        for position, (kind, value) in enumerate(tokens):
+            previous = tokens[position - 1][1] if position else None
+            if kind == "other":
+                raise SqlToolError(f"Unsupported character {value!r}. Use one statement, no comments, "
+                                   f"and single quotes for strings.")
+            if kind == "operator" and (previous, value) in (("-", "-"), ("/", "*")):
+                raise SqlToolError("Comments are not allowed.")
+            if kind == "word" and value.upper() in self.FORBIDDEN:
+                raise SqlToolError(f"{value.upper()} is not allowed. Use a single aggregate SELECT on "
+                                   f"{self.TABLE} without joins, unions or writes.")
+        return tokens
+    
+    def _split_clauses(self, tokens):
+        """Splits top-level tokens into clauses, checking their order and nesting"""
+        if not tokens or tokens[0][1].upper() != "SELECT":
+            raise SqlToolError("Only a single SELECT statement is allowed.")
+        
+        clauses, current, depth, position = {}, None, 0, 0
+        while position < len(tokens):
+            kind, value = tokens[position]
+            upper = value.upper() if kind == "word" else None
+            name = None
+            if upper in ("GROUP", "ORDER"):
+                if position + 1 >= len(tokens) or tokens[position + 1][1].upper() != "BY":
+                    raise SqlToolError(f"{upper} must be followed by BY.")
+                name = f"{upper} BY"
+            elif upper in self.CLAUSES:
+                name = upper
+            
+            if name is not None:
+                if depth:
+                    raise SqlToolError("Subqueries are not allowed.")
+                if name in clauses or (current and self.CLAUSES.index(name) < self.CLAUSES.index(current)):
+                    raise SqlToolError(f"Clauses must appear once, in the order {', '.join(self.CLAUSES)}.")
+                clauses[name], current = [], name
+                position += 2 if " " in name else 1
+                continue
+            
+            if value == "(":
+                depth += 1
+            elif value == ")":
+                depth -= 1
+                if depth < 0:
+                    raise SqlToolError("Unbalanced parentheses.")
+            clauses[current].append((kind, value))
+            position += 1
+        
+        if depth:
+            raise SqlToolError("Unbalanced parentheses.")
+        empty = [name for name, clause_tokens in clauses.items() if not clause_tokens]
+        if empty:
+            raise SqlToolError(f"Empty {empty[0]} clause.")
+        return clauses
+    
+    @staticmethod
+    def _split_items(tokens, clause):
+        """Splits a clause at its top-level commas"""
+        items, current, depth = [], [], 0
+        for token in tokens:
+            if token[1] == "(":
+                depth += 1
+            elif token[1] == ")":
+                depth -= 1
+            if token[1] == "," and depth == 0:
+                items.append(current)
+                current = []
+            else:
+                current.append(token)
+        items.append(current)
+        if any(not item for item in items):
+            raise SqlToolError(f"Empty item in {clause}.")
+        return items
+    
+    def _check_alias(self, token, columns):
+        """Validates an alias declared with AS and returns it as written"""
+        kind, value = token
+        name = value.strip('`')
+        if kind not in ("word", "quoted") or not self.IDENTIFIER_PATTERN.fullmatch(name) \
+                or name.upper() in self.RESERVED | self.FUNCTIONS or name.lower() == self.TABLE:
+            raise SqlToolError(f"Invalid alias {value}. Use a plain name that is not an SQL keyword.")
+        return f"`{name}`"
+    
+    def _check_expression(self, tokens, names):
+        """
+        Checks an expression's tokens and renders it.
+        
+        Args:
+            tokens: Expression tokens
+            names: Column (and, after the select list, alias) names in scope
+            
+        Returns:
+            str: Rendered expression
+        """
+        if not tokens:
+            raise SqlToolError("Empty expression.")
+        
+        rendered = []
+        for position, (kind, value) in enumerate(tokens):
+            following = tokens[position + 1][1] if position + 1 < len(tokens) else None
+            if kind == "word":
+                upper = value.upper()
+                if following == "(" and upper in self.FUNCTIONS or upper in self.EXPRESSION_KEYWORDS:
+                    value = upper
+                elif following == "(":
+                    raise SqlToolError(f"Function {value} is not allowed. "
+                                       f"Allowed: {', '.join(sorted(self.FUNCTIONS))}")
+                elif value.lower() not in names:
+                    raise SqlToolError(f"Unknown column or unsupported keyword: {value}. "
+                                       f"Columns: {', '.join(name for name, _ in self.get_columns())}")
+            elif kind == "quoted" and value.strip('`').lower() not in names:
+                raise SqlToolError(f"Unknown column: {value}")
+            rendered.append(value)
+        
+        # MySQL needs function names directly followed by their parenthesis
+        parts = []
+        for position, value in enumerate(rendered):
+            if parts and value not in (")", ",") and parts[-1] != "(" \
+                    and not (value == "(" and rendered[position - 1] in self.FUNCTIONS):
+                parts.append(" ")
+            parts.append(value)
+        return "".join(parts)
+    
+    def run(self, sql):
+        """
+        Validates and executes a query from the model.
+        
+        Args:
+            sql: Query text
+            
+        Returns:
+            dict: JSON-safe function response with columns and rows, or an
+                error message the model can correct its query from
+        """
+        try:
+            statement = self.validate(sql)
+        except SqlToolError as e:
+            self._count("rejected")
+            return {"error": str(e)}
+        except Exception as e:
+            self._count("errors")
+            return {"error": f"Could not read the table schema: {e}"}
+        
+        key = (self.company_manager.data_manager.data_version, statement)
+        with self.lock:
+            self.stats["queries"] += 1
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return self.cache[key]
+        
+        db_health = self.company_manager.db_health
+        if not db_health.is_available():
+            return {"error": db_health.describe()}
+        try:
+            result = self._execute(statement)
+            db_health.record_success()
+        except Exception as e:
+            if DatabaseHealth.is_connection_error(e):
+                db_health.record_failure(e)
+            self._count("errors")
+            return {"error": f"Query failed: {str(getattr(e, 'orig', e))[:300]}", "sql": statement}
+        
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+    
+    def _execute(self, statement):
+        """Runs a validated query with the execution time cap"""
+        engine = self.company_manager.get_engine()
+        executed = statement
+        if engine.dialect.name == "mysql":
+            executed = statement.replace("SELECT", f"SELECT /*+ MAX_EXECUTION_TIME({self.timeout_ms}) */", 1)
+        
+        with engine.connect() as conn:
+            if engine.dialect.name == "sqlite":
+                # Abort the query once the deadline passes
+                driver_connection = conn.connection.driver_connection
+                deadline = time.monotonic() + self.timeout_ms / 1000
+                driver_connection.set_progress_handler(lambda: int(time.monotonic() > deadline), 10000)
+            try:
+                # Colons only occur inside literals here; escape them so they are not bind parameters
+                result = conn.execute(text(executed.replace(":", "\\:")))
+                columns = list(result.keys())
+                rows = result.fetchmany(self.max_rows)
+            finally:
+                if engine.dialect.name == "sqlite":
+                    driver_connection.set_progress_handler(None, 0)
+        
+        return {"sql": statement, "columns": columns, "row_count": len(rows),
+                "rows": [[self._json_value(value) for value in row] for row in rows]}
+    
+    @staticmethod
+    def _json_value(value):
+        """Converts a database value into a JSON-safe value for the function response"""
+        if value is None or isinstance(value, (bool, int, str)):
+            return value
+        if isinstance(value, float):
+            return None if math.isnan(value) else value
+        if hasattr(value, "isoformat"):
+            return value.isoformat()
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return str(value)
+    
+    def describe_schema(self):
+        """
+        Describes the scans table for the prompt in place of the data digest.
+        
+        Returns:
+            str: Columns with types, value hints for categorical columns and
+                query rules
+        """
+        data_manager = self.company_manager.data_manager
+        version = data_manager.data_version
+        if self.schema is not None and self.schema[0] == version:
+            return self.schema[1]
+        
+        lines = [f"The `{self.TABLE}` table is in a {self.company_manager.get_engine().dialect.name} database."]
+        data_df = data_manager.raw_data_df
+        if data_df is not None:
+            lines[0] += f" About {len(data_df):,} records are loaded."
+        lines.append("Columns:")
+        for name, column_type in self.get_columns():
+            line = f"- {name} ({column_type})"
+            # Listing the values of categorical columns lets the model write exact filters
+            if data_df is not None and name in data_df.columns and data_df[name].dtype == object \
+                    and data_df[name].nunique() <= 50:
+                line += f", values: {', '.join(map(str, data_df[name].value_counts().head(12).index))}"
+            lines.append(line)
+        lines.append(
+            f"Call the {self.NAME} function with aggregate SELECT queries to get exactly the numbers "
+            f"you need (up to {SQL_TOOL_MAX_QUERIES} queries, {self.max_rows} rows each), then answer "
+            f"from the results. Use the database's own date functions."
+        )
+        self.schema = (version, "\n".join(lines))
+        return self.schema[1]
+    
+    def get_stats(self):
+        """Returns query counters and cache size"""
+        with self.lock:
+            return dict(self.stats, cached=len(self.cache))
+    
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+class DataManager:
+    """
+    Manages data loading and processing for a company.
+    
+    Features:
+    - Database connection testing
+    - Chunked, streaming data loading from MySQL with partial availability
+    - Reservoir sample covering the whole table
+    - Incremental refresh using a high-water mark column
+    - Error handling and reporting
+    """
+    
+    # Columns tried, in order, when no watermark column is configured
+    WATERMARK_CANDIDATES = ('updated_at', 'modified_at', 'last_modified', 'created_at',
+                            'scanned_at', 'scan_time', 'timestamp')
+    
+    def __init__(self, company_manager):
+        self.company_manager = company_manager
+        self.data = "Data unavailable - not yet loaded."
+        self.raw_data_df = None
+        self.data_sample = None
+        self.sampler = None
+        self.snapshot_version = None
+        self.data_digest = None
+        self.data_index = None
+        self.kpi_cube = None
+        self.kpi_cube_error = None
+        self.data_version = 0
+        self.data_fingerprint = None
+        self.data_lock = threading.Lock()
+        self.kpi_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.load_thread = None
+        self.first_data_ready = threading.Event()
+        self.load_progress = {"state": "not_started"}
+        self.key_column = None
+        self.watermark_column = None
+        self.watermark = None
+        self.last_refresh = None
+        self.initialization_attempted = False
+        self.connection_error = None
+        company_manager.db_health.on_recovery(self._on_database_recovered)
+    
+    def test_database_connection(self):
+        """
+        Tests database connection and validates configuration.
+        
+        While the database is known to be unreachable this returns False
+        immediately instead of waiting on a connect timeout.
+        
+        Returns:
+            bool: True if connection successful, False otherwise
+        """
+        db_health = self.company_manager.db_health
+        try:
+            # Check for required environment variables
+            if DATABASE_URL_TEMPLATE and not self.company_manager.mysql_db:
+                self.connection_error = f"Missing environment variables: MYSQL_DB for {self.company_manager.company_id}"
+                return False
+            if not DATABASE_URL_TEMPLATE and not all([MYSQL_USER, MYSQL_PASSWORD, self.company_manager.mysql_db,
+                                                      INSTANCE_CONNECTION_NAME]):
+                missing = []
+                if not MYSQL_USER: missing.append("MYSQL_USER")
+                if not MYSQL_PASSWORD: missing.append("MYSQL_PASSWORD")
+                if not self.company_manager.mysql_db: missing.append(f"MYSQL_DB for {self.company_manager.company_id}")
+                if not INSTANCE_CONNECTION_NAME: missing.append("INSTANCE_CONNECTION_NAME")
+                error_msg = f"Missing environment variables: {', '.join(missing)}"
+                self.connection_error = error_msg
+                return False
+            
+            if not db_health.is_available():
+                self.connection_error = db_health.describe()
+                return False
+            
+            # Borrow a pooled connection and test with simple query
+            self.company_manager.ping_database()
+            
+            db_health.record_success()
+            self.connection_error = None
+            return True
+        
+        except (mysql.connector.Error, DBAPIError) as e:
+            if DatabaseHealth.is_connection_error(e):
+                db_health.record_failure(e)
+            error_msg = f"MySQL connection error for {self.company_manager.get_company_name()}: {getattr(e, 'orig', e)}"
+            self.connection_error = error_msg
+            return False
+        except Exception as e:
+            if DatabaseHealth.is_connection_error(e):
+                db_health.record_failure(e)
+            error_msg = f"Database connection test failed for {self.company_manager.get_company_name()}: {e}"
+            self.connection_error = error_msg
+            return False
+    
+    def get_engine(self):
+        """
+        Returns the company's shared pooled SQLAlchemy engine.
+        
+        Returns:
+            Engine: SQLAlchemy engine instance
+        """
+        return self.company_manager.get_engine()
+    
+    def load_data(self, use_snapshot=True):
+        """
+        Loads data from the database.
+        
+        Rows are read in key-ordered pages (see _read_chunks). The in-memory
+        frame is capped at SCANS_MAX_ROWS (0 for no cap) while a reservoir
+        sample keeps covering the whole table. Partial data is published as
+        it arrives, so questions can be answered before the load finishes.
+        
+        When shared snapshots are enabled, a fresh snapshot published by
+        another worker is mapped instead of querying the database.
+        
+        Args:
+            use_snapshot: Whether to adopt or publish a shared snapshot
+        
+        Returns:
+            bool: True if data loaded successfully, False otherwise
+        """
+        with self.load_lock:
+            started = time.perf_counter()
+            self.initialization_attempted = True
+            self.load_progress = {"state": "loading", "rows_read": 0, "rows_in_memory": 0,
+                                  "chunks": 0, "truncated": False, "started_at": time.time()}
+            try:
+                if snapshot_store is not None and use_snapshot:
+                    loaded = self._load_via_snapshot()
+                else:
+                    loaded = self._stream_data()
+            except Exception as e:
+                if DatabaseHealth.is_connection_error(e):
+                    self.company_manager.db_health.record_failure(e)
+                self.data = f"Data unavailable due to error: {str(e)[:200]}"
+                self.connection_error = str(e)
+                loaded = False
+            
+            LOAD_DATA_SECONDS.observe(time.perf_counter() - started, company=self.company_manager.company_id,
+                                      outcome="success" if loaded else "failure")
+            self.load_progress["state"] = "complete" if loaded else "failed"
+            self.load_progress["elapsed_seconds"] = round(time.time() - self.load_progress["started_at"], 2)
+            self.first_data_ready.set()
+            if loaded:
+                self._materialize_kpi_cube()
+            return loaded
+    
+    def _stream_data(self):
+        """Streams the scans table into memory, publishing partial frames as it goes"""
+        # Test connection first
+        if not self.test_database_connection():
+            return False
+        
+        engine = self.get_engine()
+        
+        # Check if table exists
+        if not inspect(engine).has_table("scans"):
+            error_msg = f"Table 'scans' does not exist in database for {self.company_manager.get_company_name()}"
+            self.data = error_msg
+            return False
+        
+        progress = self.load_progress
+        sampler = ReservoirSampler(SCANS_SAMPLE_SIZE, SCANS_SAMPLE_STRATIFY)
+        chunks, published_rows = [], 0
+        
+        for chunk in self._read_chunks(engine):
+            progress["rows_read"] += len(chunk)
+            progress["chunks"] += 1
+            sampler.add(chunk)
+            
+            room = SCANS_MAX_ROWS - progress["rows_in_memory"] if SCANS_MAX_ROWS else len(chunk)
+            if room < len(chunk):
+                progress["truncated"] = True
+                chunk = chunk.iloc[:max(room, 0)]
+            if not chunk.empty:
+                chunks.append(chunk)
+                progress["rows_in_memory"] += len(chunk)
+            
+            # Publish partial data at geometrically growing sizes to keep copying linear
+            if chunks and progress["rows_in_memory"] >= 2 * max(published_rows, 1):
+                chunks = [pd.concat(chunks, ignore_index=True)]
+                published_rows = progress["rows_in_memory"]
+                self._set_loaded_data(chunks[0], sampler)
+                self.first_data_ready.set()
+        
+        if not chunks:
+            self.data = f"No data available in database table 'scans' for {self.company_manager.get_company_name()}."
+            return False
+        
+        self._set_loaded_data(pd.concat(chunks, ignore_index=True), sampler)
+        self.connection_error = None
+        return True
+    
+    def _read_chunks(self, engine):
+        """
+        Yields the scans table in chunks of SCANS_CHUNK_SIZE rows.
+        
+        Pages by primary key (WHERE key > last ORDER BY key LIMIT n), so only
+        one page is ever held by the driver; mysql-connector has no
+        server-side cursors and buffers a whole result set client-side.
+        Tables without a key column fall back to a single chunked query.
+        
+        Args:
+            engine: Company's SQLAlchemy engine
+            
+        Yields:
+            DataFrame: Next chunk of rows
+        """
+        columns = [column["name"] for column in inspect(engine).get_columns("scans")]
+        key = SCANS_KEY_COLUMN if SCANS_KEY_COLUMN in columns else ('id' if 'id' in columns else None)
+        if key is None:
+            with engine.connect().execution_options(stream_results=True) as conn:
+                yield from pd.read_sql(text(self._scans_query()), conn, chunksize=SCANS_CHUNK_SIZE)
+            return
+        
+        # The key is read for paging even when SCANS_COLUMNS leaves it out
+        extra_key = bool(SCANS_COLUMNS) and key not in SCANS_COLUMNS
+        last = None
+        while True:
+            query = self._scans_query(f"`{key}` > :last" if last is not None else "",
+                                      extra_columns=[key] if extra_key else [])
+            query += f" ORDER BY `{key}` LIMIT {SCANS_CHUNK_SIZE}"
+            with engine.connect() as conn:
+                chunk = pd.read_sql(text(query), conn, params={"last": last} if last is not None else None)
+            if chunk.empty:
+                return
+            last = chunk[key].iloc[-1]
+            last = last.item() if hasattr(last, "item") else last
+            yield chunk.drop(columns=key) if extra_key else chunk
+            if len(chunk) < SCANS_CHUNK_SIZE:
+                return
+    
+    def _load_via_snapshot(self):
+        """Maps a fresh shared snapshot, or loads from the database and publishes one"""
+        company_id = self.company_manager.company_id
+        if self._adopt_snapshot(max_age=SNAPSHOT_MAX_AGE):
+            return True
+        
+        # Only one worker loads from the database; the others wait and map its snapshot
+        with snapshot_store.lock(company_id):
+            if self._adopt_snapshot(max_age=SNAPSHOT_MAX_AGE):
+                return True
+            loaded = self._stream_data()
+            if loaded:
+                self._publish_snapshot()
+            return loaded
+    
+    def _adopt_snapshot(self, max_age=None, only_newer=False):
+        """
+        Swaps in the current shared snapshot.
+        
+        Args:
+            max_age: Ignore snapshots older than this many seconds
+            only_newer: Ignore the snapshot this worker already uses
+            
+        Returns:
+            bool: True if a snapshot was adopted
+        """
+        company_id = self.company_manager.company_id
+        version, manifest = snapshot_store.current_version(company_id)
+        if version is None:
+            return False
+        if only_newer and version == self.snapshot_version:
+            return False
+        if max_age is not None and time.time() - manifest["created_at"] > max_age:
+            return False
+        
+        data_df, sample_df = snapshot_store.load(company_id, version, manifest)
+        sampler = ReservoirSampler.restore(sample_df, manifest["rows_seen"], SCANS_SAMPLE_STRATIFY)
+        self._set_loaded_data(data_df, sampler, fingerprint=manifest["fingerprint"])
+        self.snapshot_version = version
+        self.load_progress.update(manifest["progress"])
+        self.load_progress["source"] = f"snapshot {version}"
+        self.connection_error = None
+        return True
+    
+    def _publish_snapshot(self):
+        """Publishes the loaded data as a new shared snapshot version"""
+        progress = {key: self.load_progress.get(key) for key in ("rows_read", "rows_in_memory", "truncated")}
+        self.snapshot_version = snapshot_store.publish(
+            self.company_manager.company_id,
+            self.raw_data_df,
+            self.data_sample,
+            {"fingerprint": self.data_fingerprint, "rows_seen": self.sampler.rows_seen, "progress": progress}
+        )
+    
+    def _scans_query(self, where="", extra_columns=()):
+        """
+        Builds the SELECT statement for the scans table.
+        
+        Args:
+            where: Optional WHERE clause (without the keyword)
+            extra_columns: Columns selected in addition to SCANS_COLUMNS
+            
+        Returns:
+            str: SQL projecting only SCANS_COLUMNS when configured
+        """
+        columns = ", ".join(f"`{col}`" for col in list(SCANS_COLUMNS) + list(extra_columns)) \
+            if SCANS_COLUMNS else "*"
+        query = f"SELECT {columns} FROM scans"
+        return f"{query} WHERE {where}" if where else query
+    
+    def _on_database_recovered(self):
+        """Retries a load that failed during a database outage"""
+        if self.load_progress["state"] != "failed" or self.load_lock.locked():
+            return
+        threading.Thread(target=self.load_data, name=f"reload-{self.company_manager.company_id}",
+                         daemon=True).start()
+    
+    def start_background_load(self):
+        """Starts load_data on a background thread unless a load was already started"""
+        with self.data_lock:
+            if self.initialization_attempted or self.load_thread is not None:
+                return
+            self.load_thread = threading.Thread(
+                target=self.load_data, name=f"load-{self.company_manager.company_id}", daemon=True
+            )
+            self.load_thread.start()
+    
+    def wait_for_load(self, timeout=None):
+        """
+        Waits for a background load to finish.
+        
+        Args:
+            timeout: Maximum seconds to wait, or None to wait indefinitely
+        """
+        if self.load_thread is not None:
+            self.load_thread.join(timeout)
+    
+    def wait_for_data(self, timeout=SCANS_FIRST_DATA_WAIT):
+        """
+        Waits until partial data is available or the load has finished.
+        
+        Args:
+            timeout: Maximum seconds to wait
+            
+        Returns:
+            bool: True if data (possibly partial) is available
+        """
+        self.first_data_ready.wait(timeout)
+        return self.raw_data_df is not None
+    
+    def _set_loaded_data(self, data_df, sampler=None, fingerprint=None):
+        """
+        Installs a newly loaded DataFrame and bumps the data version.
+        
+        Args:
+            data_df: Loaded scans data
+            sampler: ReservoirSampler holding the sample of the full table
+            fingerprint: Precomputed content fingerprint, if already known
+        """
+        self._detect_refresh_columns(data_df)
+        if fingerprint is None:
+            fingerprint = format(int(pd.util.hash_pandas_object(data_df, index=False).sum()), 'x')
+        
+        with self.data_lock:
+            # The full table is summarized for the AI, so no CSV copy is kept in memory
+            self.data = f"{len(data_df):,} records loaded from 'scans'."
+            self.raw_data_df = data_df
+            if sampler is not None:
+                self.sampler = sampler
+                self.data_sample = sampler.get_sample()
+            self.data_digest = None
+            self.data_index = None
+            self.data_fingerprint = fingerprint
+            self.data_version += 1
+            if self.watermark_column:
+                self.watermark = data_df[self.watermark_column].max()
+            self.last_refresh = time.time()
+        
+        # Cached responses are keyed by data_fingerprint, so answers for older
+        # data simply miss; keeping them lets the disk tier survive restarts
+        
+        # Partial frames published during a load are skipped; load_data materializes the final one
+        if self.load_progress["state"] != "loading":
+            self._materialize_kpi_cube()
+    
+    def _detect_refresh_columns(self, data_df):
+        """
+        Picks the primary key and high-water mark columns used for incremental refresh.
+        
+        Args:
+            data_df: Loaded scans data
+        """
+        columns = list(data_df.columns)
+        
+        if SCANS_KEY_COLUMN in columns:
+            self.key_column = SCANS_KEY_COLUMN
+        elif 'id' in columns:
+            self.key_column = 'id'
+        
+        if SCANS_WATERMARK_COLUMN in columns:
+            self.watermark_column = SCANS_WATERMARK_COLUMN
+        else:
+            candidates = [col for col in self.WATERMARK_CANDIDATES if col in columns]
+            if candidates:
+                self.watermark_column = candidates[0]
+            elif self.key_column and pd.api.types.is_integer_dtype(data_df[self.key_column]):
+                # Auto-increment ids only reveal new rows, not updated ones
+                self.watermark_column = self.key_column
+    
+    def refresh_data(self, full=False):
+        """
+        Fetches rows added or changed since the last load and merges them in.
+        
+        Falls back to a full reload when no data is loaded yet, no watermark
+        column is available, or a full reload is requested. Concurrent
+        refreshes and refreshes within DATA_REFRESH_MIN_INTERVAL are skipped
+        to avoid reload storms.
+        
+        Args:
+            full: Force a full reload instead of an incremental fetch
+            
+        Returns:
+            dict: Refresh status, number of new rows and current data version
+        """
+        if self.load_progress["state"] == "loading" or not self.refresh_lock.acquire(blocking=False):
+            return {"status": "in_progress", "data_version": self.data_version}
+        
+        try:
+            if self.last_refresh and time.time() - self.last_refresh < DATA_REFRESH_MIN_INTERVAL:
+                return {"status": "skipped", "data_version": self.data_version,
+                        "retry_after": round(DATA_REFRESH_MIN_INTERVAL - (time.time() - self.last_refresh))}
+            
+            if snapshot_store is not None:
+                return self._refresh_with_snapshots(full)
+            return self._refresh_from_database(full)
+        finally:
+            self.refresh_lock.release()
+    
+    def _refresh_from_database(self, full):
+        """Runs a full reload or an incremental fetch against the database"""
+        db_health = self.company_manager.db_health
+        if not db_health.is_available():
+            return {"status": "failed", "data_version": self.data_version, "error": db_health.describe()}
+        
+        if full or self.raw_data_df is None or not self.watermark_column or pd.isna(self.watermark):
+            loaded = self.load_data(use_snapshot=False)
+            return {"status": "reloaded" if loaded else "failed", "data_version": self.data_version,
+                    "total_records": len(self.raw_data_df) if self.raw_data_df is not None else 0,
+                    "error": self.connection_error}
+        
+        return self._refresh_incremental()
+    
+    def _refresh_with_snapshots(self, full):
+        """Adopts a newer shared snapshot, or refreshes from the database and publishes one"""
+        with snapshot_store.lock(self.company_manager.company_id, blocking=False) as acquired:
+            if not acquired:
+                # Another worker is refreshing; its snapshot is picked up next time
+                return {"status": "in_progress", "data_version": self.data_version}
+            
+            if not full and self._adopt_snapshot(only_newer=True):
+                return {"status": "snapshot", "data_version": self.data_version,
+                        "snapshot_version": self.snapshot_version,
+                        "total_records": len(self.raw_data_df)}
+            
+            result = self._refresh_from_database(full)
+            if result["status"] in ("reloaded", "updated"):
+                self._publish_snapshot()
+                result["snapshot_version"] = self.snapshot_version
+            return result
+    
+    def _refresh_incremental(self):
+        """Fetches and merges rows at or above the current watermark"""
+        column = self.watermark_column
+        watermark = self.watermark
+        if hasattr(watermark, 'to_pydatetime'):
+            watermark = watermark.to_pydatetime()
+        elif hasattr(watermark, 'item'):
+            watermark = watermark.item()
+        
+        try:
+            # Rows sharing the watermark value are re-fetched and de-duplicated by key
+            operator = ">=" if self.key_column and column != self.key_column else ">"
+            query = text(self._scans_query(f"`{column}` {operator} :watermark"))
+            fetched = pd.read_sql(query, self.get_engine(), params={"watermark": watermark})
+        except Exception as e:
+            if DatabaseHealth.is_connection_error(e):
+                self.company_manager.db_health.record_failure(e)
+            self.connection_error = str(e)
+            return {"status": "failed", "data_version": self.data_version, "error": str(e)}
+        
+        current = self.raw_data_df
+        for col in fetched.columns.intersection(current.columns):
+            # Keep date columns comparable with the loaded frame
+            if (pd.api.types.is_datetime64_any_dtype(current[col])
+                    and not pd.api.types.is_datetime64_any_dtype(fetched[col])):
+                fetched[col] = pd.to_datetime(fetched[col], errors='coerce')
+        
+        if self.key_column and not fetched.empty:
+            # Drop boundary rows that were already loaded
+            known = fetched[self.key_column].isin(current[self.key_column])
+            fetched = fetched[~(known & (fetched[column] == self.watermark))]
+        
+        if fetched.empty:
+            self.last_refresh = time.time()
+            return {"status": "unchanged", "new_rows": 0, "data_version": self.data_version}
+        
+        merged = pd.concat([current, fetched], ignore_index=True)
+        if self.key_column:
+            merged = merged.drop_duplicates(subset=self.key_column, keep='last').reset_index(drop=True)
+        
+        if self.sampler is not None:
+            self.sampler.add(fetched)
+        self._set_loaded_data(merged, self.sampler)
+        self.connection_error = None
+        return {"status": "updated", "new_rows": len(fetched), "data_version": self.data_version,
+                "total_records": len(merged), "watermark": str(self.watermark)}
+    
+    def get_data_digest(self):
+        """
+        Returns the statistical digest of the loaded data, building it on first use.
+        
+        Returns:
+            str: Digest text, or None if no data is loaded
+        """
+        with self.data_lock:
+            data_df, version, digest = self.raw_data_df, self.data_version, self.data_digest
+        
+        if data_df is None:
+            return None
+        
+        if digest is None or digest[0] != version:
+            digest = (version, DataDigestBuilder(data_df).build())
+            with self.data_lock:
+                if self.data_version == version:
+                    self.data_digest = digest
+        return digest[1]
+    
+    def get_data_index(self):
+        """
+        Returns the retrieval index of the loaded data, building it on first use.
+        
+        Returns:
+            DatasetIndex: Index for the current data version, or None if no data is loaded
+        """
+        with self.data_lock:
+            data_df, version, index = self.raw_data_df, self.data_version, self.data_index
+        
+        if data_df is None:
+            return None
+        
+        if index is None or index[0] != version:
+            index = (version, DatasetIndex(data_df))
+            with self.data_lock:
+                if self.data_version == version:
+                    self.data_index = index
+        return index[1]
+    
+    def get_kpi_cube(self):
+        """
+        Returns the KPI cube of the loaded data, building it on first use.
+        
+        Returns:
+            KpiCube: Cube for the current data version, or None if no data is
+                loaded, the cube is disabled or it could not be built
+        """
+        if not KPI_CUBE:
+            return None
+        
+        with self.data_lock:
+            data_df, version, cube = self.raw_data_df, self.data_version, self.kpi_cube
+        if data_df is None:
+            return None
+        if cube is not None and cube[0] == version:
+            return cube[1]
+        
+        # One build per version; concurrent callers wait for it. A failed build
+        # is remembered as None so it is not retried for the same data
+        with self.kpi_lock:
+            with self.data_lock:
+                cube = self.kpi_cube
+            if cube is None or cube[0] != version:
+                try:
+                    cube = (version, KpiCube(data_df))
+                    self.kpi_cube_error = None
+                except Exception as e:
+                    print(f"KPI cube build failed for {self.company_manager.company_id}: {e}")
+                    cube = (version, None)
+                    self.kpi_cube_error = f"KPI cube could not be built: {str(e)[:200]}"
+                with self.data_lock:
+                    if self.data_version == version:
+                        self.kpi_cube = cube
+        return cube[1]
+    
+    def _materialize_kpi_cube(self):
+        """Builds the KPI cube for the current data version on a background thread"""
+        if not KPI_CUBE:
+            return
+        
+        threading.Thread(target=self.get_kpi_cube, name=f"kpis-{self.company_manager.company_id}",
+                         daemon=True).start()
+    
+    def get_prompt_data(self, question=None):
+        """
+        Returns the data text to include in AI prompts.
+        
+        Args:
+            question: User's question; when given, only the rows and columns
+                it refers to are included if any match
+        
+        Returns:
+            str: Retrieved rows/summary for the question, or the statistical
+                digest plus the KPI cube table (or a few sampled rows when
+                there is no cube), or the status message if no data is loaded
+        """
+        retrieved = self.get_question_data(question) if question else None
+        if retrieved is not None:
+            return retrieved
+        
+        digest = self.get_data_digest()
+        if digest is None:
+            return self.data
+        
+        sections = self._load_notes()
+        sections.append(digest)
+        
+        # Exact precomputed aggregates stand in for raw sample rows once loading has finished
+        cube = self.get_kpi_cube() if self.load_progress["state"] != "loading" else None
+        kpis = cube.prompt_section(SCANS_PROMPT_SAMPLE_ROWS) if cube is not None else None
+        if kpis:
+            sections.append(kpis)
+            return "\n\n".join(sections)
+        
+        sample = self.data_sample
+        if sample is not None and not sample.empty and SCANS_PROMPT_SAMPLE_ROWS > 0:
+            rows = ReservoirSampler.take(sample, SCANS_PROMPT_SAMPLE_ROWS, self.sampler.stratify_column)
+            sections.append(f"Representative random sample ({len(rows)} of "
+                            f"{self.sampler.rows_seen:,} records):\n{rows.to_csv(index=False)}")
+        return "\n\n".join(sections)
+    
+    def get_question_data(self, question):
+        """
+        Returns only the rows and columns a question refers to.
+        
+        Args:
+            question: User's question
+            
+        Returns:
+            str: Retrieved rows/summary, or None if retrieval is disabled,
+                no data is loaded or nothing in the question matched
+        """
+        if not DATA_RETRIEVAL or self.raw_data_df is None:
+            return None
+        retrieved = self.get_data_index().retrieve(question)
+        if retrieved is None:
+            return None
+        return "\n\n".join(self._load_notes() + [retrieved])
+    
+    def _load_notes(self):
+        """Returns notes about partial or truncated loads for the prompt"""
+        progress = self.load_progress
+        if progress["state"] == "loading":
+            return [f"[Partial data: load in progress, {progress['rows_read']:,} records read so far]"]
+        if progress.get("truncated"):
+            return [f"[Statistics cover the first {progress['rows_in_memory']:,} of "
+                    f"{progress['rows_read']:,} records; the sample covers all records]"]
+        return []
+    
+    def get_data_info(self):
+        """
+        Returns information about loaded data.
+        
+        Returns:
+            dict: Data statistics and error information
+        """
+        progress = {key: value for key, value in self.load_progress.items() if key != "started_at"}
+        if self.raw_data_df is not None:
+            cube = self.kpi_cube
+            return {
+                "total_records": len(self.raw_data_df),
+                "columns": list(self.raw_data_df.columns),
+                "connection_error": self.connection_error,
+                "load_progress": progress,
+                "kpi_cube": cube[1].describe() if cube is not None and cube[1] is not None
+                    and cube[0] == self.data_version else self.kpi_cube_error
+            }
+        return {
+            "total_records": 0,
+            "columns": [],
+            "connection_error": self.connection_error,
+            "load_progress": progress
+        }
+
+
+class ReservoirSampler:
+    """
+    Maintains a fixed-size uniform random sample over a stream of DataFrame chunks.
+    
+    Each row gets a random key and the rows with the smallest keys are kept,
+    which is equivalent to reservoir sampling and fully vectorized. With a
+    stratify column, up to `size` rows are kept per stratum so small groups
+    stay represented.
+    """
+    
+    KEY_COLUMN = '_reservoir_key'
+    
+    def __init__(self, size, stratify_column=None, seed=None):
+        self.size = size
+        self.stratify_column = stratify_column
+        self.rng = np.random.default_rng(seed)
+        self.reservoir = None
+        self.rows_seen = 0
+    
+    def add(self, chunk):
+        """
+        Offers a chunk of rows to the sample.
+        
+        Args:
+            chunk: DataFrame with the next rows of the stream
+        """
+        self.rows_seen += len(chunk)
+        if self.size <= 0 or chunk.empty:
+            return
+        
+        keys = self.rng.random(len(chunk))
+        stratified = self.stratify_column in chunk.columns
+        if not stratified and self.reservoir is not None and len(self.reservoir) >= self.size:
+            # Only rows beating the current worst key can enter a full reservoir
+            keep = keys < self.reservoir[self.KEY_COLUMN].iloc[-1]
+            chunk, keys = chunk[keep], keys[keep]
+            if chunk.empty:
+                return
+        
+        candidates = chunk.assign(**{self.KEY_COLUMN: keys})
+        combined = candidates if self.reservoir is None else pd.concat([self.reservoir, candidates])
+        combined = combined.sort_values(self.KEY_COLUMN)
+        if stratified:
+            combined = combined.groupby(self.stratify_column, dropna=False, sort=False).head(self.size)
+        else:
+            combined = combined.head(self.size)
+        self.reservoir = combined.reset_index(drop=True)
+    
+    @classmethod
+    def restore(cls, sample, rows_seen, stratify_column=None):
+        """
+        Rebuilds a sampler from a previously taken sample.
+        
+        Fresh keys are drawn from the range the kept rows would occupy, so
+        later chunks keep being sampled in proportion to the rows seen.
+        
+        Args:
+            sample: DataFrame returned by get_sample
+            rows_seen: Number of rows the sample was drawn from
+            stratify_column: Column the sample was stratified on
+            
+        Returns:
+            ReservoirSampler: Sampler continuing from the given sample
+        """
+        sampler = cls(SCANS_SAMPLE_SIZE, stratify_column)
+        sampler.rows_seen = rows_seen
+        if sample is not None and not sample.empty:
+            keys = np.sort(sampler.rng.random(len(sample))) * min(len(sample) / max(rows_seen, 1), 1.0)
+            sampler.reservoir = sample.reset_index(drop=True).assign(**{cls.KEY_COLUMN: keys})
+        return sampler
+    
+    def get_sample(self):
+        """
+        Returns the current sample.
+        
+        Returns:
+            DataFrame: Sampled rows (without the internal key column), or None
+        """
+        if self.reservoir is None:
+            return None
+        return self.reservoir.drop(columns=self.KEY_COLUMN)
+    
+    @staticmethod
+    def take(sample, count, stratify_column=None):
+        """
+        Takes a smaller sample, spreading rows evenly across strata when stratified.
+        
+        Args:
+            sample: DataFrame returned by get_sample
+            count: Number of rows to return
+            stratify_column: Column the sample was stratified on
+            
+        Returns:
+            DataFrame: At most `count` rows
+        """
+        if stratify_column in sample.columns:
+            strata = max(sample[stratify_column].nunique(dropna=False), 1)
+            sample = sample.groupby(stratify_column, dropna=False, sort=False).head(math.ceil(count / strata))
+        return sample.head(count)
+
+
+class DatasetSnapshotStore:
+    """
+    Publishes loaded datasets as immutable, versioned, memory-mappable snapshots.
+    
+    Each version is a directory holding one .npy file per column plus a JSON
+    manifest. Date-like text is stored as datetime64, low-cardinality text is
+    dictionary-encoded and other text is kept as UTF-8 bytes with offsets.
+    Workers map the files read-only, so the operating system keeps a single
+    copy of each dataset for all gunicorn workers. A CURRENT pointer file is replaced
+    atomically when a new version is published, and old versions are
+    garbage-collected.
+    
+    Layout: <root>/<company_id>/<version>/{manifest.json, data/, sample/}
+    """
+    
+    # Text with more distinct values than this share of rows is not dictionary-encoded
+    MAX_CATEGORY_RATIO = 0.5
+    ISO_DATE_PATTERN = r"\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?"
+    
+    def __init__(self, root, keep_versions=2):
+        self.root = root
+        self.keep_versions = max(keep_versions, 1)
+        os.makedirs(root, exist_ok=True)
+    
+    def company_dir(self, company_id):
+        """Returns (and creates) the snapshot directory of a company"""
+        path = os.path.join(self.root, company_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+    
+    @contextmanager
+    def lock(self, company_id, blocking=True):
+        """
+        Holds the company's cross-process loader lock.
+        
+        Args:
+            company_id: Company identifier
+            blocking: Wait for the lock instead of giving up immediately
+            
+        Yields:
+            bool: True if the lock was acquired
+        """
+        with open(os.path.join(self.company_dir(company_id), ".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def current_version(self, company_id):
+        """
+        Returns the current snapshot version of a company.
+        
+        Returns:
+            tuple: (version, manifest), or (None, None) if nothing is published
+        """
+        company_dir = self.company_dir(company_id)
+        try:
+            with open(os.path.join(company_dir, "CURRENT")) as f:
+                version = f.read().strip()
+            with open(os.path.join(company_dir, version, "manifest.json")) as f:
+                return version, json.load(f)
+        except (OSError, ValueError):
+            return None, None
+    
+    def publish(self, company_id, data_df, sample_df, metadata):
+        """
+        Writes a new snapshot version and makes it current.
+        
+        Args:
+            company_id: Company identifier
+            data_df: Loaded scans data
+            sample_df: Reservoir sample of the full table (may be None)
+            metadata: Extra JSON-serializable fields for the manifest
+            
+        Returns:
+            str: New version name
+        """
+        company_dir = self.company_dir(company_id)
+        version = f"{time.time_ns()}-{os.getpid()}"
+        staging = os.path.join(company_dir, f".{version}.tmp")
+        os.makedirs(staging)
+        
+        manifest = dict(metadata, version=version, created_at=time.time(), rows=len(data_df))
+        manifest["data"] = self._write_frame(os.path.join(staging, "data"), data_df)
+        if sample_df is not None:
+            manifest["sample"] = self._write_frame(os.path.join(staging, "sample"), sample_df)
+        with open(os.path.join(staging, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        
+        # Publish the complete directory, then swap the pointer atomically
+        os.rename(staging, os.path.join(company_dir, version))
+        pointer = os.path.join(company_dir, f".CURRENT.{os.getpid()}")
+        with open(pointer, "w") as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(company_dir, "CURRENT"))
+        
+        self.collect_garbage(company_id)
+        return version
+    
+    def load(self, company_id, version, manifest):
+        """
+        Maps a snapshot version into DataFrames without copying column data.
+        
+        Returns:
+            tuple: (data_df, sample_df); sample_df is None if none was stored
+        """
+        version_dir = os.path.join(self.company_dir(company_id), version)
+        data_df = self._read_frame(os.path.join(version_dir, "data"), manifest["data"])
+        sample_df = None
+        if "sample" in manifest:
+            sample_df = self._read_frame(os.path.join(version_dir, "sample"), manifest["sample"])
+        return data_df, sample_df
+    
+    def collect_garbage(self, company_id):
+        """
+        Removes all but the newest versions of a company's snapshots.
+        
+        Workers still mapping a removed version keep working, since unlinked
+        files stay readable until they are unmapped.
+        """
+        company_dir = self.company_dir(company_id)
+        current, _ = self.current_version(company_id)
+        versions = sorted((name for name in os.listdir(company_dir) if not name.startswith(".")
+                           and os.path.isdir(os.path.join(company_dir, name))),
+                          key=lambda name: int(name.split("-")[0]))
+        for name in versions[:-self.keep_versions]:
+            if name != current:
+                shutil.rmtree(os.path.join(company_dir, name), ignore_errors=True)
+    
+    def _write_frame(self, path, data_df):
+        """Writes one .npy file per column and returns the column specs"""
+        os.makedirs(path)
+        columns = []
+        for i, col in enumerate(data_df.columns):
+            spec = {"name": str(col), "file": f"c{i}.npy"}
+            series = data_df[col]
+            inferred = pd.api.types.infer_dtype(series, skipna=True)
+            
+            if pd.api.types.is_datetime64_any_dtype(series):
+                if series.dt.tz is not None:
+                    spec["tz"] = str(series.dt.tz)
+                    series = series.dt.tz_convert(None)
+                values = series.to_numpy(dtype="datetime64[ns]")
+            elif pd.api.types.is_numeric_dtype(series) and not isinstance(series.dtype, pd.CategoricalDtype):
+                values = series.to_numpy(dtype=float, na_value=np.nan) if series.hasnans else series.to_numpy()
+            elif inferred in ("decimal", "integer", "floating", "mixed-integer-float"):
+                values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float)
+            elif inferred in ("date", "datetime"):
+                values = pd.to_datetime(series, errors="coerce").to_numpy(dtype="datetime64[ns]")
+            elif (parsed := self._parse_date_strings(series)) is not None:
+                values = parsed.to_numpy(dtype="datetime64[ns]")
+            else:
+                codes, uniques = pd.factorize(series.astype(object).where(series.notna(), None), sort=True)
+                if len(uniques) <= len(series) * self.MAX_CATEGORY_RATIO:
+                    # Dictionary-encode repetitive text so it can be memory-mapped as integer
+                    # codes; sorted, ordered categories keep min/max and comparisons working
+                    spec["categories"] = [str(value) for value in uniques]
+                    values = codes.astype(self._codes_dtype(len(uniques)))
+                else:
+                    # Categories live in the manifest, so mostly-unique text is stored as
+                    # mapped UTF-8 bytes plus row offsets instead
+                    values = self._write_text(path, spec, series)
+            
+            np.save(os.path.join(path, spec["file"]), values, allow_pickle=False)
+            columns.append(spec)
+        return columns
+    
+    def _read_frame(self, path, columns):
+        """Maps the column files written by _write_frame"""
+        data = {}
+        for spec in columns:
+            values = np.load(os.path.join(path, spec["file"]), mmap_mode="r")
+            if "categories" in spec:
+                dtype = pd.CategoricalDtype(spec["categories"], ordered=True)
+                data[spec["name"]] = pd.Categorical.from_codes(values, dtype=dtype)
+            elif "offsets" in spec:
+                data[spec["name"]] = self._read_text(path, spec, values)
+            elif "tz" in spec:
+                data[spec["name"]] = pd.DatetimeIndex(values).tz_localize("UTC").tz_convert(spec["tz"])
+            else:
+                data[spec["name"]] = values
+        return pd.DataFrame(data, copy=False)
+    
+    @classmethod
+    def _parse_date_strings(cls, series):
+        """Returns ISO date text parsed to datetimes, or None if any value is not one"""
+        present = series.dropna()
+        if present.empty or not present.astype(str).str.fullmatch(cls.ISO_DATE_PATTERN).all():
+            return None
+        parsed = pd.to_datetime(series, format="ISO8601", errors="coerce")
+        return parsed if parsed.notna().sum() == len(present) else None
+    
+    @staticmethod
+    def _write_text(path, spec, series):
+        """Writes the offsets (and null mask) of a text column and returns its UTF-8 bytes"""
+        missing = series.isna().to_numpy()
+        encoded = [b"" if null else str(value).encode("utf-8") for value, null in zip(series, missing)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        
+        spec["offsets"] = spec["file"].replace(".npy", ".offsets.npy")
+        np.save(os.path.join(path, spec["offsets"]), offsets, allow_pickle=False)
+        if missing.any():
+            spec["nulls"] = spec["file"].replace(".npy", ".nulls.npy")
+            np.save(os.path.join(path, spec["nulls"]), missing, allow_pickle=False)
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    
+    @staticmethod
+    def _read_text(path, spec, values):
+        """Decodes a text column written by _write_text"""
+        offsets = np.load(os.path.join(path, spec["offsets"]), mmap_mode="r").tolist()
+        missing = np.load(os.path.join(path, spec["nulls"]), mmap_mode="r") \
+            if "nulls" in spec else np.zeros(len(offsets) - 1, dtype=bool)
+        buffer = memoryview(values)
+        return pd.Series([None if null else str(buffer[start:end], "utf-8")
+                          for start, end, null in zip(offsets[:-1], offsets[1:], missing)])
+    
+    @staticmethod
+    def _codes_dtype(category_count):
+        """Returns the code dtype pandas uses, so mapped codes are not copied"""
+        if category_count < np.iinfo(np.int8).max:
+            return np.int8
+        if category_count < np.iinfo(np.int16).max:
+            return np.int16
+        return np.int32
+
+
+# Shared snapshot store, enabled by SNAPSHOT_DIR
+snapshot_store = DatasetSnapshotStore(SNAPSHOT_DIR, SNAPSHOT_KEEP_VERSIONS) if SNAPSHOT_DIR else None
+
+
+class ResponseCache:
+    """
+    Caches AI responses keyed by a hash of everything that shapes the prompt.
+    
+    Features:
+    - Bounded in-memory LRU with TTL expiry
+    - Optional SQLite disk tier so entries survive restarts
+    - Per-company invalidation when the background changes; data changes
+      alter the fingerprint in the key, so old answers stop matching
+    - Hit/miss statistics
+    """
+    
+    def __init__(self, max_entries=256, ttl_seconds=3600, db_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self.db = self._open_database(db_path) if db_path and max_entries > 0 else None
+    
+    def _open_database(self, db_path):
+        """Opens the SQLite disk tier, returning None if it cannot be used"""
+        try:
+            db = sqlite3.connect(db_path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, company_id TEXT, response TEXT, created_at REAL)"
+            )
+            db.commit()
+            return db
+        except sqlite3.Error as e:
+            print(f"Response cache disk tier disabled: {e}")
+            return None
+    
+    @staticmethod
+    def make_key(company_id, data_version, background, question, history):
+        """
+        Builds a content-addressed cache key.
+        
+        Args:
+            company_id: Company identifier
+            data_version: Fingerprint of the loaded data
+            background: Current company background text
+            question: User's question (normalized before hashing)
+            history: (question, answer) pairs included in the prompt
+            
+        Returns:
+            str: SHA-256 hex digest
+        """
+        normalized_question = re.sub(r'\s+', ' ', question.lower()).strip().rstrip('?.! ')
+        payload = json.dumps([company_id, data_version, background, normalized_question, history])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """
+        Looks up a cached response.
+        
+        Args:
+            key: Cache key from make_key
+            
+        Returns:
+            str: Cached response, or None on a miss
+        """
+        if self.max_entries <= 0:
+            return None
+        
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[2] <= self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            
+            if self.db:
+                row = self.db.execute(
+                    "SELECT company_id, response, created_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[2] <= self.ttl_seconds:
+                    self._store(key, row)
+                    self.stats["disk_hits"] += 1
+                    return row[1]
+                if row:
+                    self.db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self.db.commit()
+            
+            self.stats["misses"] += 1
+            return None
+    
+    def set(self, key, company_id, response):
+        """
+        Stores a response in memory and, if enabled, on disk.
+        
+        Args:
+            key: Cache key from make_key
+            company_id: Company the response belongs to
+            response: AI response text
+        """
+        if self.max_entries <= 0:
+            return
+        
+        entry = (company_id, response, time.time())
+        with self.lock:
+            self._store(key, entry)
+            if self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, company_id, response, created_at) "
+                    "VALUES (?, ?, ?, ?)", (key,) + entry
+                )
+                self.db.commit()
+    
+    def _store(self, key, entry):
+        """Adds an entry to the in-memory LRU, evicting the oldest if full"""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    def invalidate_company(self, company_id):
+        """
+        Removes all cached responses for a company.
+        
+        Args:
+            company_id: Company identifier
+        """
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry[0] == company_id]
+            for key in stale:
+                del self.entries[key]
+            if self.db:
+                self.db.execute("DELETE FROM response_cache WHERE company_id = ?", (company_id,))
+                self.db.commit()
+            self.stats["invalidations"] += 1
+    
+    def get_stats(self):
+        """
+        Returns cache statistics.
+        
+        Returns:
+            dict: Hit/miss counters, entry count and configuration
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        stats["max_entries"] = self.max_entries
+        stats["ttl_seconds"] = self.ttl_seconds
+        stats["disk_tier"] = self.db is not None
+        return stats
+
+
+# Global cache of AI responses shared by all companies
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+
+
+class DataRefresher:
+    """
+    Background thread that periodically refreshes every loaded company's data.
+    
+    Each cycle sleeps for the configured interval plus random jitter so that
+    multiple workers or containers do not refresh in lockstep.
+    """
+    
+    def __init__(self, interval, jitter=0.2):
+        self.interval = interval
+        self.jitter = jitter
+        self.thread = None
+        self.stop_event = threading.Event()
+    
+    def start(self):
+        """Starts the refresher thread if enabled and not already running"""
+        if self.interval <= 0 or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="data-refresher", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Signals the refresher thread to exit"""
+        self.stop_event.set()
+    
+    def _run(self):
+        while not self.stop_event.wait(self.interval * (1 + random.uniform(-self.jitter, self.jitter))):
+            for company_manager in list(company_managers.values()):
+                if company_manager.data_manager.initialization_attempted:
+                    try:
+                        company_manager.data_manager.refresh_data()
+                    except Exception as e:
+                        print(f"Data refresh failed for {company_manager.company_id}: {e}")
+
+
+# Global background refresher for all loaded companies
+data_refresher = DataRefresher(DATA_REFRESH_INTERVAL, DATA_REFRESH_JITTER)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+    
+    The first caller (leader) runs the function; callers arriving while it is
+    in flight (followers) wait for and share its result or exception.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"leaders": 0, "followers": 0, "timeouts": 0}
+    
+    def do(self, key, fn, timeout=None):
+        """
+        Runs fn once per key across concurrent callers.
+        
+        Args:
+            key: Fingerprint identifying identical calls
+            fn: Zero-argument callable to execute
+            timeout: Seconds a follower waits for the leader, or None to wait indefinitely
+            
+        Returns:
+            tuple: (result, shared) where shared is True for followers
+            
+        Raises:
+            TimeoutError: If a follower gives up waiting for the leader
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+        
+        if not is_leader:
+            if not call["done"].wait(timeout):
+                with self.lock:
+                    self.stats["timeouts"] += 1
+                raise TimeoutError("Timed out waiting for an identical request in progress.")
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+        
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+        return call["result"], False
+    
+    def get_stats(self):
+        """Returns leader/follower/timeout counters and the number of calls in flight"""
+        with self.lock:
+            return dict(self.stats, in_flight=len(self.calls))
+
+
+# Coalesces identical concurrent Gemini calls across all request threads
+insight_flights = SingleFlight()
+
+
+class InsightJobQueue:
+    """
+    Runs insight generation on a bounded pool of worker threads.
+    
+    Features:
+    - Bounded queue; submissions beyond capacity are rejected
+    - Job status tracking with results kept for a limited time
+    - Long-polling for completion
+    - Per-job cancellation
+    """
+    
+    def __init__(self, workers=2, max_queue=20, result_ttl=600):
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.pending = queue.Queue(maxsize=max_queue)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+    
+    def submit(self, company_id, fn):
+        """
+        Queues a job.
+        
+        Args:
+            company_id: Company the job belongs to
+            fn: Callable taking an is_cancelled callable and returning the result
+            
+        Returns:
+            dict: Public view of the queued job
+            
+        Raises:
+            queue.Full: If the queue is at capacity
+        """
+        self._start_workers()
+        self._purge_expired()
+        
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "company_id": company_id,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+            "done": threading.Event(),
+            "fn": fn
+        }
+        with self.lock:
+            self.pending.put_nowait(job)
+            self.jobs[job["job_id"]] = job
+        return self._public(job)
+    
+    def get(self, job_id):
+        """
+        Returns the public view of a job, or None if unknown or expired.
+        """
+        job = self.jobs.get(job_id)
+        return self._public(job) if job else None
+    
+    def wait(self, job_id, timeout):
+        """
+        Long-polls a job until it finishes or the timeout elapses.
+        
+        Returns:
+            dict: Public view of the job, or None if unknown
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job["done"].wait(timeout)
+        return self._public(job)
+    
+    def cancel(self, job_id):
+        """
+        Cancels a job.
+        
+        Returns:
+            dict: Public view of the job, or None if unknown
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            if job["status"] in ("queued", "running"):
+                job["status"] = "cancelled"
+                job["finished_at"] = time.time()
+                job["done"].set()
+        return self._public(job)
+    
+    def get_stats(self):
+        """Returns queue depth and job counts by status"""
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"queue_depth": self.pending.qsize(), "max_queue": self.pending.maxsize,
+                "workers": self.workers, "jobs": counts}
+    
+    def _start_workers(self):
+        """Starts worker threads on first use so none are created before forking"""
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"insight-job-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    
+    def _work(self):
+        while True:
+            job = self.pending.get()
+            with self.lock:
+                if job["status"] == "cancelled":
+                    continue
+                job["status"] = "running"
+                job["started_at"] = time.time()
+            
+            try:
+                result = job["fn"](lambda: job["status"] == "cancelled")
+                error = None
+            except Exception as e:
+                result, error = None, str(e)
+            
+            with self.lock:
+                if job["status"] != "cancelled":
+                    job["status"] = "failed" if error else "done"
+                    job["result"] = result
+                    job["error"] = error
+                    job["finished_at"] = time.time()
+                job["fn"] = None
+                job["done"].set()
+    
+    def _purge_expired(self):
+        """Drops finished jobs older than the result TTL"""
+        cutoff = time.time() - self.result_ttl
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job["finished_at"] and job["finished_at"] < cutoff]
+            for job_id in expired:
+                del self.jobs[job_id]
+    
+    def _public(self, job):
+        """Returns the JSON-serializable fields of a job"""
+        return {key: value for key, value in job.items() if key not in ("done", "fn")}
+
+
+# Bounded worker pool for asynchronous /ask requests
+insight_jobs = InsightJobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_RESULT_TTL)
+
+
+class PromptPacker:
+    """
+    Packs prompt sections into a per-model token budget.
+    
+    Tokens are estimated locally (word pieces of up to four characters plus
+    punctuation, close to SentencePiece counts for English and numbers).
+    Every section first receives its minimum share of the budget; the rest
+    is handed out in priority order up to each section's maximum share.
+    Sections over their allocation are trimmed at line boundaries, keeping
+    the head (or the tail, for history).
+    """
+    
+    TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+    
+    # Prompt token budgets; well below the context windows to bound latency and cost
+    MODEL_BUDGETS = {
+        "gemini-1.5-pro": 32000,
+        "gemini-1.5-flash": 24000,
+        "gemini-2.0-flash": 24000
+    }
+    DEFAULT_BUDGET = 16000
+    # Smallest remainder worth filling with a partial line when trimming
+    MIN_CUT_TOKENS = 16
+    
+    # Lower priority values are filled first
+    DEFAULT_POLICY = {
+        "system": {"priority": 0, "min_share": 0.0, "max_share": 1.0, "keep": "head"},
+        "question": {"priority": 0, "min_share": 0.0, "max_share": 1.0, "keep": "head"},
+        "background": {"priority": 1, "min_share": 0.05, "max_share": 0.15, "keep": "head"},
+        "data": {"priority": 2, "min_share": 0.4, "max_share": 0.85, "keep": "head"},
+        "history": {"priority": 3, "min_share": 0.05, "max_share": 0.3, "keep": "tail"}
+    }
+    
+    def __init__(self, budget, model=None, policy=None):
+        self.budget = budget
+        self.model = model
+        self.policy = {name: dict(rules) for name, rules in self.DEFAULT_POLICY.items()}
+        for name, rules in (policy or {}).items():
+            self.policy.setdefault(name, {"priority": 9, "min_share": 0.0, "max_share": 1.0,
+                                          "keep": "head"}).update(rules)
+    
+    @classmethod
+    def for_model(cls, model):
+        """
+        Creates a packer with the configured budget for a model.
+        
+        Args:
+            model: Gemini model name
+            
+        Returns:
+            PromptPacker: Packer for the model
+        """
+        budget = PROMPT_TOKEN_BUDGET or cls.MODEL_BUDGETS.get(model, cls.DEFAULT_BUDGET)
+        return cls(budget, model, PROMPT_SECTION_POLICY)
+    
+    @classmethod
+    def estimate_tokens(cls, text):
+        """
+        Estimates the number of tokens in a text.
+        
+        Args:
+            text: Text to measure
+            
+        Returns:
+            int: Approximate token count
+        """
+        return len(cls.TOKEN_PATTERN.findall(text)) if text else 0
+    
+    def pack(self, sections, budget=None):
+        """
+        Fits sections into the token budget.
+        
+        Args:
+            sections: Ordered mapping of section name to text
+            budget: Tokens available to these sections (defaults to the full budget)
+            
+        Returns:
+            tuple: (ordered mapping of section name to packed text, token breakdown)
+        """
+        budget = self.budget if budget is None else max(budget, 0)
+        requested = {name: self.estimate_tokens(text) for name, text in sections.items()}
+        rules = {name: self.policy.get(name, self.policy["data"]) for name in sections}
+        
+        allocation = {name: min(requested[name], int(rules[name]["min_share"] * budget))
+                      for name in sections}
+        remaining = budget - sum(allocation.values())
+        for name in sorted(sections, key=lambda name: rules[name]["priority"]):
+            limit = min(requested[name], int(rules[name]["max_share"] * budget))
+            extra = max(0, min(limit - allocation[name], remaining))
+            allocation[name] += extra
+            remaining -= extra
+        
+        packed = OrderedDict()
+        truncated = {}
+        for name, text in sections.items():
+            if requested[name] > allocation[name]:
+                text = self._truncate(text, allocation[name], rules[name]["keep"])
+                truncated[name] = requested[name]
+            packed[name] = text
+        
+        tokens = {name: self.estimate_tokens(text) for name, text in packed.items()}
+        breakdown = {
+            "model": self.model,
+            "budget": budget,
+            "total": sum(tokens.values()),
+            "sections": tokens,
+            "truncated": truncated
+        }
+        return packed, breakdown
+    
+    def _truncate(self, text, limit, keep="head"):
+        """Trims text to about limit tokens at line boundaries"""
+        lines = text.split("\n")
+        marker = "[... {} lines omitted to fit the prompt token budget]"
+        available = limit - self.estimate_tokens(marker.format(len(lines)))
+        if available <= 0:
+            return ""
+        
+        costs = np.array([self.estimate_tokens(line) + 1 for line in lines])
+        if keep == "tail":
+            # The first line is the section title and is always kept
+            available -= costs[0]
+            count = int(np.searchsorted(np.cumsum(costs[:0:-1]), available, side='right'))
+            kept = lines[len(lines) - count:] if count else []
+            return "\n".join([lines[0], marker.format(len(lines) - 1 - count)] + kept) if count else ""
+        
+        cumulative = np.cumsum(costs)
+        count = int(np.searchsorted(cumulative, available, side='right'))
+        kept = lines[:count]
+        
+        # An oversized line at the boundary (often one long paragraph) is cut
+        # by characters instead of being dropped with everything after it
+        cut_note = " [... truncated to fit the prompt token budget]"
+        remaining = available - (int(cumulative[count - 1]) if count else 0) - self.estimate_tokens(cut_note)
+        if count < len(lines) and (count == 0 or remaining >= self.MIN_CUT_TOKENS):
+            kept.append(self._cut_line(lines[count], max(remaining, 0)) + cut_note)
+            count += 1
+        
+        if count == len(lines):
+            return "\n".join(kept)
+        return "\n".join(kept + [marker.format(len(lines) - count)])
+    
+    def _cut_line(self, line, tokens):
+        """Returns the longest word-aligned prefix of line within about tokens tokens"""
+        cost = max(self.estimate_tokens(line), 1)
+        cut = line[:int(len(line) * tokens / cost)]
+        while cut and self.estimate_tokens(cut) > tokens:
+            cut = cut[:int(len(cut) * 0.9)]
+        if " " in cut and len(cut) < len(line):
+            cut = cut.rsplit(" ", 1)[0]
+        return cut.rstrip()
+
+
+class PromptPrefixCache:
+    """
+    Memoizes the stable prompt prefix (system instructions, company background
+    and dataset digest) per company, data version, background and model.
+    
+    Modes (GEMINI_CONTEXT_CACHE):
+    - off: the packed prefix is reused locally and sent with every request
+    - local: the prefix is also registered in LocalContextStore, an offline
+      stand-in for Gemini cached contents, so requests carry only the suffix
+    - gemini: the prefix is registered with the Gemini context caching API and
+      requests send only the history and the current question
+    """
+    
+    MODES = ("off", "local", "gemini")
+    
+    def __init__(self, mode="off", ttl_seconds=3600, min_tokens=32768, max_entries=32):
+        self.mode = mode if mode in self.MODES else "off"
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.local_store = LocalContextStore()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.registrations = 0
+        self.registration_errors = 0
+    
+    @staticmethod
+    def make_key(company_id, data_version, background, model):
+        """
+        Builds the memo key for a prefix.
+        
+        Returns:
+            str: Hex digest identifying the prefix inputs
+        """
+        payload = json.dumps([company_id, data_version, background, model])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, company_id, data_version, background, model, build):
+        """
+        Returns the memoized prefix, building and registering it on a miss.
+        
+        Args:
+            company_id: Company identifier
+            data_version: DataManager data version the prefix was built from
+            background: Current company background
+            model: Gemini model name
+            build: Callable returning (prefix text, token breakdown)
+            
+        Returns:
+            tuple: (prefix entry dict, True if the entry was reused)
+        """
+        key = self.make_key(company_id, data_version, background, model)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["expires_at"] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry, True
+            self.misses += 1
+        
+        text, breakdown = build()
+        entry = {
+            "key": key,
+            "company_id": company_id,
+            "model": model,
+            "text": text,
+            "tokens": breakdown["total"],
+            "breakdown": breakdown,
+            "cached_content": self._register(model, text, breakdown["total"]),
+            # Expire the memo before the registered context so it is never referenced stale
+            "expires_at": time.time() + max(self.ttl_seconds - 60, 1)
+        }
+        
+        with self.lock:
+            self.entries[key] = entry
+            evicted = []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[1])
+        for old in evicted:
+            self._release(old)
+        return entry, False
+    
+    def discard(self, entry):
+        """
+        Drops an entry whose registered context is no longer usable.
+        
+        Args:
+            entry: Prefix entry returned by get
+        """
+        with self.lock:
+            self.entries.pop(entry["key"], None)
+        self._release(entry)
+    
+    def _register(self, model, text, tokens):
+        """Registers a prefix as a cached context, returning its name or None"""
+        if self.mode == "off":
+            return None
+        if self.mode == "local":
+            self.registrations += 1
+            return self.local_store.create(model, text, self.ttl_seconds)
+        if genai_caching is None or not GEMINI_API_KEY or tokens < self.min_tokens:
+            return None
+        
+        try:
+            cached = genai_caching.CachedContent.create(
+                model=model,
+                display_name="marketing-insights-prefix",
+                contents=[text],
+                ttl=timedelta(seconds=self.ttl_seconds)
+            )
+            self.registrations += 1
+            return cached.name
+        except Exception as e:
+            # Requests fall back to sending the full prompt
+            self.registration_errors += 1
+            print(f"Context cache registration failed: {str(e)}")
+            return None
+    
+    def _release(self, entry):
+        """Deletes a registered context, ignoring failures (it expires anyway)"""
+        name = entry.get("cached_content")
+        if not name:
+            return
+        if self.mode == "local":
+            self.local_store.delete(name)
+            return
+        try:
+            genai_caching.CachedContent.get(name).delete()
+        except Exception:
+            pass
+    
+    def get_stats(self):
+        """
+        Returns prefix cache statistics.
+        
+        Returns:
+            dict: Mode, entry count, hit/miss counters and registrations
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "registrations": self.registrations,
+                "registration_errors": self.registration_errors
+            }
+
+
+class LocalContextStore:
+    """
+    In-process stand-in for Gemini cached contents.
+    
+    Stores registered prefixes by name with a TTL so the context caching
+    flow can be exercised offline; generation prepends the stored prefix.
+    """
+    
+    def __init__(self):
+        self.contents = {}
+        self.lock = threading.Lock()
+    
+    def create(self, model, text, ttl_seconds):
+        """
+        Registers a prefix.
+        
+        Returns:
+            str: Name of the stored context
+        """
+        name = f"localContents/{uuid.uuid4().hex}"
+        with self.lock:
+            self.contents[name] = (model, text, time.time() + ttl_seconds)
+        return name
+    
+    def get(self, name):
+        """
+        Returns the stored prefix text, or None if unknown or expired.
+        """
+        with self.lock:
+            stored = self.contents.get(name)
+            if stored is None or stored[2] <= time.time():
+                self.contents.pop(name, None)
+                return None
+            return stored[1]
+    
+    def delete(self, name):
+        """Removes a stored prefix"""
+        with self.lock:
+            self.contents.pop(name, None)
+
+
+prompt_prefixes = PromptPrefixCache(GEMINI_CONTEXT_CACHE, GEMINI_CONTEXT_CACHE_TTL, GEMINI_CONTEXT_CACHE_MIN_TOKENS)
+
+
+class GenaiBackend:
+    """
+    Gemini backend using google-generativeai.
+    
+    GenerativeModel instances are created once per model (or cached
+    context) and reused across calls.
+    """
+    
+    requires_api_key = True
+    MAX_MODELS = 32
+    
+    def __init__(self):
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get_model(self, model, cached_content=None):
+        """
+        Returns a reusable GenerativeModel.
+        
+        Args:
+            model: Gemini model name
+            cached_content: Name of a registered cached context, if any
+            
+        Returns:
+            GenerativeModel: Model instance
+        """
+        key = (model, cached_content)
+        with self.lock:
+            instance = self.models.get(key)
+            if instance is not None:
+                self.models.move_to_end(key)
+                return instance
+        
+        if cached_content:
+            instance = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        else:
+            instance = genai.GenerativeModel(model)
+        
+        with self.lock:
+            self.models[key] = instance
+            while len(self.models) > self.MAX_MODELS:
+                self.models.popitem(last=False)
+        return instance
+    
+    def generate(self, model, contents, cached_content=None, stream=False, timeout=None, tools=None):
+        """
+        Calls generate_content.
+        
+        Returns:
+            GenerateContentResponse: Response (iterable of chunks when streaming)
+        """
+        # Optional arguments are only passed when set
+        extra = {}
+        if timeout:
+            extra["request_options"] = {"timeout": timeout}
+        if tools:
+            extra["tools"] = tools
+        return self.get_model(model, cached_content).generate_content(contents, stream=stream, **extra)
+
+
+class FakeGeminiBackend:
+    """
+    Offline stand-in for the Gemini API with latency and error injection.
+    
+    Selected with GEMINI_BACKEND=fake. Answers echo the current question, so
+    the app, benchmarks and failure handling can run without an API key.
+    """
+    
+    requires_api_key = False
+    
+    # Lognormal sigma giving a long tail (p99 around 3x the median)
+    LOGNORMAL_SIGMA = 0.5
+    
+    def __init__(self, latency=0.2, error_rate=0.0, hang_rate=0.0, seed=None, distribution="uniform"):
+        if distribution not in ("uniform", "fixed", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.distribution = distribution
+        self.random = random.Random(seed)
+        self.calls = 0
+    
+    def sample_latency(self):
+        """Draws one call's latency in seconds; every distribution has the configured mean"""
+        if self.latency <= 0 or self.distribution == "fixed":
+            return max(self.latency, 0)
+        if self.distribution == "exponential":
+            return self.random.expovariate(1 / self.latency)
+        if self.distribution == "lognormal":
+            sigma = self.LOGNORMAL_SIGMA
+            return self.random.lognormvariate(math.log(self.latency) - sigma ** 2 / 2, sigma)
+        return self.latency * self.random.uniform(0.5, 1.5)
+    
+    def generate(self, model, contents, cached_content=None, stream=False, timeout=None, tools=None):
+        """
+        Simulates generate_content.
+        
+        With tools, the first turn requests a record count through the first
+        declared function and the next turn answers with the returned rows.
+        
+        Raises:
+            RuntimeError: "500 Internal error" at the configured error rate
+        """
+        self.calls += 1
+        roll = self.random.random()
+        if roll < self.hang_rate:
+            time.sleep((timeout or GEMINI_TIMEOUT) * 2)
+        time.sleep(self.sample_latency())
+        if self.random.random() < self.error_rate:
+            raise RuntimeError("500 Internal error (injected by FakeGeminiBackend)")
+        
+        prompt = contents if isinstance(contents, str) else contents[0]["parts"][0]
+        question = prompt.rsplit("Current Question:", 1)[-1].strip()[:200]
+        answer = f"[{model}] Suggested next steps for: {question}"
+        if tools:
+            results = [part["function_response"]["response"] for content in contents[1:]
+                       for part in content["parts"] if isinstance(part, dict) and "function_response" in part]
+            if not results:
+                name = tools[0]["function_declarations"][0]["name"]
+                return FakeGeminiResponse.function_call(name, {"sql": "SELECT COUNT(*) AS records FROM scans"})
+            answer += f" (from query results: {json.dumps(results[-1].get('rows', results[-1]))[:200]})"
+        
+        response = FakeGeminiResponse(answer)
+        return response.stream() if stream else response
+
+
+class FakeGeminiResponse:
+    """Response object with the attributes the app reads from Gemini responses"""
+    
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text] if text else []
+        self.prompt_feedback = None
+        self.candidates = [types.SimpleNamespace(content={"role": "model", "parts": list(self.parts)})]
+    
+    @classmethod
+    def function_call(cls, name, args):
+        """Returns a response whose only part asks for a function call"""
+        response = cls("")
+        call = types.SimpleNamespace(name=name, args=args)
+        response.parts = [types.SimpleNamespace(function_call=call)]
+        response.candidates[0].content["parts"] = [{"function_call": {"name": name, "args": args}}]
+        return response
+    
+    def stream(self):
+        """Returns a response whose iteration yields word-sized chunks"""
+        words = re.findall(r"\S+\s*", self.text)
+        response = FakeGeminiResponse(self.text)
+        response.chunks = [FakeGeminiResponse(word) for word in words]
+        return response
+    
+    def __iter__(self):
+        return iter(getattr(self, 'chunks', [self]))
+
+
+class CircuitBreaker:
+    """
+    Fails fast while the Gemini API is degraded.
+    
+    Opens after `threshold` consecutive failures, rejects calls for
+    `cooldown` seconds, then lets one trial call through (half-open):
+    success closes the breaker, failure opens it again.
+    """
+    
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+    
+    def allow(self):
+        """
+        Checks whether a call may proceed.
+        
+        Returns:
+            bool: False while the breaker is open
+        """
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+    
+    def record_success(self):
+        """Closes the breaker after a call reached the API"""
+        with self.lock:
+            self.failures = 0
+            self.state = "closed"
+            self.trial_in_flight = False
+    
+    def record_failure(self):
+        """Counts a failed call, opening the breaker at the threshold"""
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    
+    Tokens refill continuously at `rate` per second up to `capacity`, so
+    bursts up to the capacity are allowed while the long-run rate is
+    bounded. A request-per-minute quota of N is TokenBucket(N / 60, N).
+    """
+    
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("Token bucket rate and capacity must be positive")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, tokens=1):
+        """
+        Returns the seconds until tokens will be available, without taking them.
+        """
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            self._refill()
+            return max(0.0, (tokens - self.tokens) / self.rate)
+    
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens if they are available now.
+        
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until
+                they will be available
+        """
+        # Requests larger than the bucket are let through once it is full
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+    
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Blocks until tokens are available.
+        
+        Args:
+            tokens: Number of tokens to take
+            timeout: Maximum seconds to wait, or None to wait indefinitely
+            
+        Returns:
+            bool: True if the tokens were taken, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_seconds = self.try_acquire(tokens)
+            if wait_seconds == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait_seconds = min(wait_seconds, remaining)
+            time.sleep(wait_seconds)
+
+
+class AdmissionController:
+    """
+    Admits Gemini calls under a shared quota with per-company fair sharing.
+    
+    Every call first waits in its company's queue. Whenever the request
+    and token buckets (and the optional concurrency limit) allow another
+    call, the next company is picked by smooth weighted round-robin among
+    companies with waiting calls, so a burst from one company only delays
+    its own queue. Interactive calls are always admitted before batch
+    calls. A call still queued after its timeout is dropped and the caller
+    gets AdmissionTimeoutError.
+    
+    There is no dispatcher thread: waiting callers admit whoever is next
+    when they wake up, on release or once the buckets have refilled.
+    """
+    
+    PRIORITIES = ("interactive", "batch")
+    
+    def __init__(self, rpm=0, tpm=0, max_concurrent=0, queue_timeout=15, max_queued=50, weights=None):
+        self.request_bucket = TokenBucket(rpm / 60, rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm / 60, tpm) if tpm else None
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.max_queued = max_queued
+        self.weights = weights or {}
+        # Per priority: company id -> deque of waiting tickets
+        self.queues = {priority: OrderedDict() for priority in self.PRIORITIES}
+        # Smooth weighted round-robin state per priority: company id -> current weight
+        self.current = {priority: {} for priority in self.PRIORITIES}
+        self.in_flight = 0
+        self.recheck_after = None
+        self.condition = threading.Condition()
+        self.stats = {}
+    
+    @property
+    def enabled(self):
+        return bool(self.request_bucket or self.token_bucket or self.max_concurrent)
+    
+    @contextmanager
+    def admit(self, company_id, tokens=0, priority="interactive", timeout=None):
+        """
+        Holds an admission for the duration of a Gemini call.
+        
+        Args:
+            company_id: Company the call is made for
+            tokens: Estimated tokens the call will use
+            priority: "interactive" or "batch"
+            timeout: Seconds to wait in the queue (queue_timeout when None,
+                wait indefinitely when 0)
+            
+        Raises:
+            AdmissionTimeoutError: If the company's queue is full or the wait timed out
+        """
+        if not self.enabled:
+            yield
+            return
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        
+        timeout = self.queue_timeout if timeout is None else timeout
+        started = time.monotonic()
+        self._wait(company_id, tokens, priority, started + timeout if timeout else None)
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, priority=priority)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self._dispatch()
+                self.condition.notify_all()
+    
+    def _wait(self, company_id, tokens, priority, deadline):
+        """Queues a ticket and blocks until it is admitted or the deadline passes"""
+        ticket = {"company_id": company_id, "tokens": tokens, "admitted": False}
+        with self.condition:
+            stats = self.stats.setdefault(company_id, {"admitted": 0, "timed_out": 0, "rejected": 0,
+                                                       "wait_seconds": 0.0})
+            queue_ = self.queues[priority].setdefault(company_id, deque())
+            if len(queue_) >= self.max_queued:
+                stats["rejected"] += 1
+                ADMISSION_REJECTED.inc(priority=priority, reason="queue_full")
+                raise AdmissionTimeoutError("Too many questions are waiting for this company. "
+                                            "Please try again shortly.", self._retry_after())
+            queue_.append(ticket)
+            started = time.monotonic()
+            
+            while True:
+                self._dispatch()
+                if ticket["admitted"]:
+                    stats["admitted"] += 1
+                    stats["wait_seconds"] += time.monotonic() - started
+                    return
+                
+                wait_seconds = self.recheck_after
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._remove(priority, company_id, ticket)
+                        stats["timed_out"] += 1
+                        ADMISSION_REJECTED.inc(priority=priority, reason="timeout")
+                        raise AdmissionTimeoutError("The Gemini quota is fully used right now. "
+                                                    "Please try again shortly.", self._retry_after())
+                    wait_seconds = remaining if wait_seconds is None else min(wait_seconds, remaining)
+                self.condition.wait(wait_seconds)
+    
+    def _dispatch(self):
+        """Admits waiting tickets while capacity allows (caller holds the condition)"""
+        self.recheck_after = None
+        while True:
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                return
+            priority, company_id = self._next_company()
+            if company_id is None:
+                return
+            ticket = self.queues[priority][company_id][0]
+            
+            wait_seconds = max(self.request_bucket.wait_time(1) if self.request_bucket else 0.0,
+                               self.token_bucket.wait_time(ticket["tokens"]) if self.token_bucket else 0.0)
+            if wait_seconds > 0:
+                self.recheck_after = wait_seconds
+                return
+            if self.request_bucket:
+                self.request_bucket.try_acquire(1)
+            if self.token_bucket:
+                self.token_bucket.try_acquire(ticket["tokens"])
+            
+            self._advance(priority, company_id)
+            self._remove(priority, company_id, ticket)
+            ticket["admitted"] = True
+            self.in_flight += 1
+            self.condition.notify_all()
+    
+    def _next_company(self):
+        """
+        Returns (priority, company id) of the next ticket to admit.
+        
+        Smooth weighted round-robin: the company with the highest current
+        weight plus its weight goes next; _advance applies the update.
+        """
+        for priority in self.PRIORITIES:
+            queues = self.queues[priority]
+            if queues:
+                current = self.current[priority]
+                company_id = max(queues, key=lambda c: current.get(c, 0) + self.weights.get(c, 1))
+                return priority, company_id
+        return None, None
+    
+    def _advance(self, priority, company_id):
+        """Updates the round-robin weights after admitting a company's ticket"""
+        current = self.current[priority]
+        total = 0
+        for active in self.queues[priority]:
+            weight = self.weights.get(active, 1)
+            current[active] = current.get(active, 0) + weight
+            total += weight
+        current[company_id] -= total
+    
+    def _remove(self, priority, company_id, ticket):
+        """Removes a ticket, forgetting the company's turn state once its queue is empty"""
+        queue_ = self.queues[priority][company_id]
+        queue_.remove(ticket)
+        if not queue_:
+            del self.queues[priority][company_id]
+            self.current[priority].pop(company_id, None)
+    
+    def _retry_after(self):
+        """Estimates the seconds until a new question could be admitted (caller holds the condition)"""
+        queued = sum(len(q) for queues in self.queues.values() for q in queues.values())
+        if self.request_bucket:
+            return max(1, math.ceil((queued + 1) / self.request_bucket.rate))
+        return max(1, math.ceil(self.queue_timeout))
+    
+    def get_stats(self):
+        """Returns queue lengths, in-flight calls and per-company counters"""
+        with self.condition:
+            return {
+                "enabled": self.enabled,
+                "in_flight": self.in_flight,
+                "queued": {priority: {company_id: len(q) for company_id, q in queues.items()}
+                           for priority, queues in self.queues.items()},
+                "companies": {company_id: dict(stats, wait_seconds=round(stats["wait_seconds"], 3))
+                              for company_id, stats in self.stats.items()}
+            }
+
+
+class GeminiClient:
+    """
+    Resilient wrapper around a Gemini backend.
+    
+    Features:
+    - Per-call deadline enforced on a bounded thread pool, so a hung call
+      never holds a request thread past GEMINI_TIMEOUT
+    - Exponential backoff with full jitter for retryable errors
+    - Optional hedged request after the observed p95 latency
+    - Circuit breaker that fails fast while the API is degraded
+    """
+    
+    RETRYABLE_MARKERS = ("500", "502", "503", "504", "429", "internal error", "unavailable",
+                         "deadline", "timed out", "timeout", "connection", "resourceexhausted",
+                         "internalservererror", "serviceunavailable", "toomanyrequests")
+    MIN_HEDGE_SAMPLES = 20
+    
+    def __init__(self, backend, timeout=60, max_retries=2, backoff_base=0.5, backoff_max=8,
+                 hedge=False, hedge_min_delay=1.0, breaker=None, workers=16):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemini")
+        self.latencies = deque(maxlen=200)
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                      "timeouts": 0, "failures": 0, "rejected": 0}
+    
+    def generate(self, model, contents, cached_content=None, tools=None):
+        """
+        Generates a response.
+        
+        Args:
+            model: Gemini model name
+            contents: Prompt text, or a list of conversation turns
+            cached_content: Name of a registered cached context, if any
+            tools: Function declarations the model may call
+            
+        Returns:
+            Response object with text, parts and prompt_feedback
+            
+        Raises:
+            GeminiUnavailableError: If the circuit breaker is open
+            GeminiTimeoutError: If the deadline passed
+            Exception: The backend's error once retries are exhausted
+        """
+        return self._call(lambda: self.backend.generate(
+            model, contents, cached_content, stream=False, timeout=self.timeout, tools=tools))
+    
+    def generate_stream(self, model, contents, cached_content=None):
+        """
+        Starts a streaming response; deadline, retries and hedging apply
+        until the first chunk arrives.
+        
+        Returns:
+            tuple: (response object, iterator over chunks)
+        """
+        def start():
+            response = self.backend.generate(model, contents, cached_content, stream=True,
+                                             timeout=self.timeout)
+            chunks = iter(response)
+            return response, next(chunks, None), chunks
+        
+        response, first, chunks = self._call(start)
+        
+        def iterate():
+            if first is None:
+                return
+            yield first
+            yield from chunks
+        
+        return response, iterate()
+    
+    @classmethod
+    def is_retryable(cls, error):
+        """
+        Checks whether an error is transient and worth retrying.
+        
+        Args:
+            error: Exception raised by the backend
+            
+        Returns:
+            bool: True for server errors, rate limits, timeouts and connection errors
+        """
+        if isinstance(error, (GeminiTimeoutError, GeminiUnavailableError)):
+            return False
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        description = f"{type(error).__name__} {error}".lower()
+        return any(marker in description for marker in cls.RETRYABLE_MARKERS)
+    
+    def _call(self, fn):
+        """Runs fn with the breaker, deadline, retries and hedging"""
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise GeminiUnavailableError("Gemini circuit breaker is open")
+        
+        self._count("calls")
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = self._attempt(fn, deadline)
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+                if retryable and attempt <= self.max_retries and deadline - time.monotonic() > delay:
+                    self._count("retries")
+                    time.sleep(delay)
+                    continue
+                
+                if retryable or isinstance(e, GeminiTimeoutError):
+                    self._count("failures")
+                    self.breaker.record_failure()
+                else:
+                    # The API answered (e.g. an invalid or blocked request)
+                    self.breaker.record_success()
+                raise
+            
+            self.breaker.record_success()
+            return result
+    
+    def _attempt(self, fn, deadline):
+        """Runs one attempt, hedging it once if it is slower than the p95 latency"""
+        started = time.monotonic()
+        primary = self.executor.submit(fn)
+        pending = {primary}
+        hedge_delay = self._hedge_delay()
+        error = None
+        
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count("timeouts")
+                raise GeminiTimeoutError(f"Gemini call exceeded the {self.timeout:g}s deadline")
+            
+            can_hedge = hedge_delay is not None and len(pending) == 1 and primary in pending
+            wait_time = remaining
+            if can_hedge:
+                wait_time = min(remaining, max(hedge_delay - (time.monotonic() - started), 0))
+            
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self._count("hedge_wins")
+                    with self.lock:
+                        self.latencies.append(time.monotonic() - started)
+                    return future.result()
+                error = future.exception()
+            
+            if not done and can_hedge:
+                # Slower than usual: race a second request and take the first answer
+                self._count("hedges")
+                pending.add(self.executor.submit(fn))
+                hedge_delay = None
+        
+        raise error
+    
+    def _hedge_delay(self):
+        """Returns the hedging delay (p95 latency), or None when hedging is off"""
+        if not self.hedge:
+            return None
+        with self.lock:
+            if len(self.latencies) < self.MIN_HEDGE_SAMPLES:
+                return None
+            p95 = float(np.percentile(self.latencies, 95))
+        return max(self.hedge_min_delay, p95)
+    
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+    
+    def get_stats(self):
+        """
+        Returns client statistics.
+        
+        Returns:
+            dict: Call counters, latency percentiles and breaker state
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            latencies = list(self.latencies)
+        stats["backend"] = type(self.backend).__name__
+        stats["breaker_state"] = self.breaker.state
+        if latencies:
+            stats["latency_p50"] = round(float(np.percentile(latencies, 50)), 3)
+            stats["latency_p95"] = round(float(np.percentile(latencies, 95)), 3)
+        return stats
+
+
+def create_gemini_backend():
+    """
+    Creates the Gemini backend selected by GEMINI_BACKEND.
+    
+    Returns:
+        GenaiBackend or FakeGeminiBackend
+    """
+    if GEMINI_BACKEND == "fake":
+        return FakeGeminiBackend(FAKE_GEMINI_LATENCY, FAKE_GEMINI_ERROR_RATE, FAKE_GEMINI_HANG_RATE,
+                                 distribution=FAKE_GEMINI_LATENCY_DISTRIBUTION)
+    return GenaiBackend()
+
+
+gemini_client = GeminiClient(
+    create_gemini_backend(),
+    timeout=GEMINI_TIMEOUT,
+    max_retries=GEMINI_MAX_RETRIES,
+    backoff_base=GEMINI_BACKOFF_BASE,
+    backoff_max=GEMINI_BACKOFF_MAX,
+    hedge=GEMINI_HEDGE,
+    hedge_min_delay=GEMINI_HEDGE_MIN_DELAY,
+    breaker=CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN),
+    workers=GEMINI_CALL_WORKERS
+)
+
+
+class ModelRouter:
+    """
+    Routes each question to a Gemini tier by cost and latency needs.
+    
+    Questions are classified by prompt token count, dependence on the
+    conversation history and question type. Reformatting follow-ups, simple
+    lookups and short general questions go to the fast tier; analysis and
+    large prompts go to the most capable tier. Each tier has its own
+    concurrency limit, and quota errors or a saturated tier fall back to
+    another tier.
+    """
+    
+    REFORMAT_PATTERN = re.compile(
+        r"\b(summari[sz]e|rephrase|reword|shorten|shorter|simplify|bullets?|translate|"
+        r"tl;?dr|recap|in \d+ (points|lines|sentences))\b", re.IGNORECASE)
+    FOLLOW_UP_PATTERN = re.compile(
+        r"\b(that|this|it|those|these|above|previous|earlier|again|elaborate|more detail)\b", re.IGNORECASE)
+    LOOKUP_PATTERN = re.compile(
+        r"^\s*(how many|how much|what is|what's|what are|which|list|show|count|total)\b", re.IGNORECASE)
+    ANALYSIS_PATTERN = re.compile(
+        r"\b(why|strateg\w*|recommend\w*|plan\w*|compare|comparison|forecast\w*|predict\w*|"
+        r"optimi[sz]\w*|improve|increase|grow\w*|budget\w*|segment\w*|trend\w*|should)\b", re.IGNORECASE)
+    SHORT_PROMPT_TOKENS = 4000
+    QUOTA_MESSAGE = "API quota exceeded"
+    
+    def __init__(self, tiers, enabled=True, large_prompt_tokens=12000, tier_wait=2.0):
+        self.tiers = OrderedDict((name, dict(config)) for name, config in tiers.items())
+        self.enabled = enabled
+        self.large_prompt_tokens = large_prompt_tokens
+        self.tier_wait = tier_wait
+        self.semaphores = {name: threading.BoundedSemaphore(max(int(config.get("concurrency", 4)), 1))
+                           for name, config in self.tiers.items()}
+        self.default_tier = next((name for name, config in self.tiers.items()
+                                  if config["model"] == GEMINI_MODEL), list(self.tiers)[-1])
+        self.capable_tier = list(self.tiers)[-1]
+        self.fast_tier = list(self.tiers)[0]
+        self.lock = threading.Lock()
+        self.counts = {name: 0 for name in self.tiers}
+        self.fallbacks = 0
+    
+    def classify(self, question, has_history):
+        """
+        Classifies a question.
+        
+        Args:
+            question: User's question
+            has_history: Whether earlier turns exist
+            
+        Returns:
+            tuple: (question type, True if the answer depends on the history)
+        """
+        reformat = bool(self.REFORMAT_PATTERN.search(question))
+        follow_up = has_history and bool(self.FOLLOW_UP_PATTERN.search(question))
+        history_dependent = has_history and (reformat or follow_up)
+        
+        if reformat and history_dependent:
+            return "reformat", history_dependent
+        if self.ANALYSIS_PATTERN.search(question):
+            return "analysis", history_dependent
+        if self.LOOKUP_PATTERN.search(question):
+            return "lookup", history_dependent
+        return "general", history_dependent
+    
+    def route(self, question, prompt_tokens, has_history):
+        """
+        Picks the tier for a question.
+        
+        Args:
+            question: User's question
+            prompt_tokens: Estimated prompt tokens
+            has_history: Whether earlier turns exist
+            
+        Returns:
+            dict: Routing decision (tier, model, reason, question type, tokens)
+        """
+        question_type, history_dependent = self.classify(question, has_history)
+        decision = {"question_type": question_type, "history_dependent": history_dependent,
+                    "prompt_tokens": prompt_tokens}
+        
+        fast_budget = PromptPacker.MODEL_BUDGETS.get(self.tiers[self.fast_tier]["model"],
+                                                     PromptPacker.DEFAULT_BUDGET)
+        if not self.enabled:
+            tier, reason = self.default_tier, "routing disabled"
+        elif prompt_tokens >= self.large_prompt_tokens or prompt_tokens > fast_budget:
+            tier, reason = self.capable_tier, "large prompt"
+        elif question_type == "reformat":
+            tier, reason = self.fast_tier, "reformatting of a previous answer"
+        elif question_type == "lookup":
+            tier, reason = self.fast_tier, "simple lookup"
+        elif question_type == "analysis":
+            tier, reason = self.capable_tier, "analysis question"
+        elif prompt_tokens < self.SHORT_PROMPT_TOKENS:
+            tier, reason = self.fast_tier, "short general question"
+        else:
+            tier, reason = self.capable_tier, "general question with a large context"
+        
+        decision.update(tier=tier, model=self.tiers[tier]["model"], reason=reason)
+        return decision
+    
+    def call(self, decision, fn):
+        """
+        Runs fn(model) within the chosen tier's concurrency limit.
+        
+        Falls back to the other tiers when the chosen tier stays saturated
+        or returns a quota error. The decision is updated in place with the
+        tier actually used.
+        
+        Args:
+            decision: Routing decision from route
+            fn: Callable taking a model name and returning the insights text
+            
+        Returns:
+            str: Insights text
+            
+        Raises:
+            TimeoutError: If every tier stayed saturated
+        """
+        result = None
+        for tier in self._attempt_order(decision):
+            if not self._acquire(tier, decision):
+                continue
+            try:
+                self._record(decision, tier)
+                result = fn(self.tiers[tier]["model"])
+            finally:
+                self.semaphores[tier].release()
+            if not result.startswith(self.QUOTA_MESSAGE):
+                return result
+        if result is None:
+            raise TimeoutError("All model tiers are busy. Please try again shortly.")
+        return result
+    
+    def stream(self, decision, fn):
+        """
+        Streaming counterpart of call; fallback happens only before the
+        first chunk is produced.
+        
+        Args:
+            decision: Routing decision from route
+            fn: Callable taking a model name and returning an iterator of text chunks
+            
+        Yields:
+            str: Text chunks
+            
+        Raises:
+            InsightsError: If generation failed or every tier stayed saturated
+        """
+        error = None
+        for tier in self._attempt_order(decision):
+            if not self._acquire(tier, decision):
+                continue
+            produced = False
+            try:
+                self._record(decision, tier)
+                for text_chunk in fn(self.tiers[tier]["model"]):
+                    produced = True
+                    yield text_chunk
+                return
+            except InsightsError as e:
+                if produced or not str(e).startswith(self.QUOTA_MESSAGE):
+                    raise
+                error = e
+            finally:
+                self.semaphores[tier].release()
+        raise error or InsightsError("All model tiers are busy. Please try again shortly.")
+    
+    def _attempt_order(self, decision):
+        """Returns the chosen tier followed by the fallback tiers"""
+        return [decision["tier"]] + [tier for tier in self.tiers if tier != decision["tier"]]
+    
+    def _acquire(self, tier, decision):
+        """Takes a concurrency slot, waiting only for the chosen tier"""
+        if tier == decision["tier"]:
+            return self.semaphores[tier].acquire(timeout=self.tier_wait)
+        return self.semaphores[tier].acquire(blocking=False)
+    
+    def _record(self, decision, tier):
+        """Marks the tier used in the decision and the routing counters"""
+        with self.lock:
+            self.counts[tier] += 1
+            if tier != decision["tier"]:
+                self.fallbacks += 1
+        if tier != decision["tier"]:
+            decision.setdefault("fallback_from", decision["tier"])
+            decision.update(tier=tier, model=self.tiers[tier]["model"])
+    
+    def get_stats(self):
+        """
+        Returns routing statistics.
+        
+        Returns:
+            dict: Calls per tier, fallbacks and the model table
+        """
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "tiers": {name: dict(config, calls=self.counts[name]) for name, config in self.tiers.items()},
+                "fallbacks": self.fallbacks
+            }
+
+
+model_router = ModelRouter(MODEL_TIERS, MODEL_ROUTING, ROUTER_LARGE_PROMPT_TOKENS, ROUTER_TIER_WAIT)
+admission_controller = AdmissionController(ADMISSION_RPM, ADMISSION_TPM, ADMISSION_MAX_CONCURRENT,
+                                           ADMISSION_QUEUE_TIMEOUT, ADMISSION_MAX_QUEUED, ADMISSION_WEIGHTS)
+
+
+class MetricsRegistry:
+    """
+    Registry of Prometheus-style metrics, rendered in the text exposition
+    format by /metrics.
+    
+    Each metric guards its own values with a lock, so updates from request,
+    job and loader threads stay cheap and consistent.
+    """
+    
+    def __init__(self):
+        self.metrics = OrderedDict()
+    
+    def counter(self, name, help_text, labelnames=()):
+        """Registers and returns a Counter"""
+        return self._register(Counter(name, help_text, labelnames))
+    
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        """Registers and returns a Gauge; function, if given, supplies values at scrape time"""
+        return self._register(Gauge(name, help_text, labelnames, function))
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=None):
+        """Registers and returns a Histogram"""
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+    
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+    
+    def render(self):
+        """
+        Renders every metric.
+        
+        Returns:
+            str: Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{_escape_label(val)}"' for key, val in labels)
+                lines.append(f"{metric.name}{suffix}{{{label_text}}} {_format_metric_value(value)}"
+                             if label_text else f"{metric.name}{suffix} {_format_metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Metric:
+    """Base class holding labelled values of one metric"""
+    
+    kind = "untyped"
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+    
+    def samples(self):
+        """Returns (name suffix, label pairs, value) tuples"""
+        with self.lock:
+            items = list(self.values.items())
+        return [("", list(zip(self.labelnames, key)), value) for key, value in sorted(items)]
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    
+    kind = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, or is computed at scrape time"""
+    
+    kind = "gauge"
+    
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+    
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        values = self.function()
+        return [("", list(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets"""
+    
+    kind = "histogram"
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=None):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets or self.LATENCY_BUCKETS))
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self.values.items()]
+        
+        samples = []
+        for key, (counts, total, count) in sorted(items):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_metric_value(bound)
+                samples.append(("_bucket", labels + [("le", le)], cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+def _escape_label(value):
+    """Escapes a label value for the text exposition format"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_metric_value(value):
+    """Formats a sample value"""
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+metrics = MetricsRegistry()
+COMPANY_INIT_SECONDS = metrics.histogram(
+    "insights_company_manager_init_seconds", "Time to create a company manager", ["company"])
+LOAD_DATA_SECONDS = metrics.histogram(
+    "insights_load_data_seconds", "Time to load a company's data", ["company", "outcome"])
+PROMPT_BUILD_SECONDS = metrics.histogram(
+    "insights_prompt_build_seconds", "Time to build a question prompt")
+PROMPT_CHARACTERS = metrics.histogram(
+    "insights_prompt_characters", "Characters sent to Gemini per prompt",
+    buckets=(1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000))
+PROMPT_TOKENS = metrics.histogram(
+    "insights_prompt_tokens", "Estimated prompt tokens, including any cached prefix",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000))
+GEMINI_SECONDS = metrics.histogram(
+    "insights_gemini_request_seconds", "Gemini request latency", ["model", "mode", "outcome"])
+GEMINI_ERRORS = metrics.counter(
+    "insights_gemini_errors_total", "Gemini failures by category", ["category"])
+DB_CONNECTS = metrics.counter(
+    "insights_db_connects_total", "New database connections opened", ["company", "outcome"])
+DB_CONNECT_SECONDS = metrics.histogram(
+    "insights_db_connect_seconds", "Time to open a database connection", ["company"])
+REQUESTS_IN_FLIGHT = metrics.gauge(
+    "insights_requests_in_flight", "HTTP requests being processed", ["endpoint"])
+HTTP_REQUESTS = metrics.counter(
+    "insights_http_requests_total", "HTTP requests handled", ["endpoint", "status"])
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "insights_admission_wait_seconds", "Time questions waited for Gemini admission", ["priority"])
+ADMISSION_REJECTED = metrics.counter(
+    "insights_admission_rejected_total", "Questions refused admission to Gemini", ["priority", "reason"])
+ADMISSION_QUEUED = metrics.gauge(
+    "insights_admission_queued", "Questions waiting for Gemini admission", ["priority"],
+    function=lambda: {(priority, ): sum(len(q) for q in list(queues.values()))
+                      for priority, queues in admission_controller.queues.items()})
+CONVERSATION_TURNS = metrics.gauge(
+    "insights_conversation_history_turns", "Turns kept in each company's conversation history", ["company"],
+    function=lambda: {(company_id, ): len(manager.conversation_manager.history)
+                      for company_id, manager in list(company_managers.items())})
+
+
+class RequestTrace:
+    """
+    Wall-clock spans for the stages of one request.
+    
+    Spans are recorded with trace_span() on the request thread and reported
+    in the Server-Timing response header. Nested spans are kept as separate
+    entries, so a stage and its sub-steps both show up.
+    """
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+    
+    @contextmanager
+    def span(self, name):
+        """Records the time spent in the block under the given stage name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append((name, time.perf_counter() - started))
+    
+    def to_dict(self):
+        """
+        Returns stage timings in milliseconds.
+        
+        Returns:
+            dict: Stage name to milliseconds (repeated stages are summed),
+                plus the request's total so far
+        """
+        timings = {}
+        with self.lock:
+            for name, seconds in self.spans:
+                timings[name] = timings.get(name, 0) + seconds * 1000
+        timings = {name: round(ms, 2) for name, ms in timings.items()}
+        timings["total"] = round((time.perf_counter() - self.started) * 1000, 2)
+        return timings
+    
+    def server_timing(self):
+        """Formats the timings as a Server-Timing header value"""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.to_dict().items())
+
+
+@contextmanager
+def trace_span(name):
+    """
+    Times a block as a stage of the current request's trace.
+    
+    A no-op outside a request (warm-up, background jobs and worker threads).
+    """
+    trace = g.get('trace') if has_request_context() else None
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+class RequestProfiler:
+    """
+    Opt-in profiling of individual requests.
+    
+    A request is profiled when it sends an X-Profile header matching
+    PROFILE_TOKEN (header profiling is off while no token is set) or is
+    picked at PROFILE_SAMPLE_RATE. Profiles are written to PROFILE_DIR,
+    keeping the newest max_files, and the file name is returned in the
+    X-Profile-File response header. One request is profiled at a time per
+    process; others arriving meanwhile run unprofiled.
+    """
+    
+    def __init__(self, directory, sample_rate=0.0, token=None, backend="cprofile", max_files=50):
+        if backend == "pyinstrument" and pyinstrument is None:
+            print("PROFILER=pyinstrument but pyinstrument is not installed; using cProfile")
+            backend = "cprofile"
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.backend = backend
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.profiles_written = 0
+    
+    def should_profile(self, header_value):
+        """
+        Decides whether to profile a request.
+        
+        Args:
+            header_value: The request's X-Profile header, or None
+        
+        Returns:
+            bool: True if the request should be profiled
+        """
+        if header_value:
+            return bool(self.token) and hmac.compare_digest(header_value, self.token)
+        return self.sample_rate > 0 and self.random.random() < self.sample_rate
+    
+    def start(self):
+        """
+        Starts profiling the current thread.
+        
+        Returns:
+            Profiler object, or None if another request is being profiled
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if self.backend == "pyinstrument":
+                profiler = pyinstrument.Profiler()
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            return profiler
+        except Exception:
+            self.lock.release()
+            raise
+    
+    def stop(self, profiler, label):
+        """
+        Stops a profiler and writes its report.
+        
+        Args:
+            profiler: Object returned by start()
+            label: Short name included in the file name (e.g. the endpoint)
+        
+        Returns:
+            str: Path of the written profile, or None if it could not be saved
+        """
+        try:
+            extension = "html" if self.backend == "pyinstrument" else "prof"
+            filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:8]}.{extension}"
+            path = os.path.join(self.directory, filename)
+            if self.backend == "pyinstrument":
+                profiler.stop()
+            else:
+                profiler.disable()
+            os.makedirs(self.directory, exist_ok=True)
+            if self.backend == "pyinstrument":
+                with open(path, "w") as f:
+                    f.write(profiler.output_html())
+            else:
+                profiler.dump_stats(path)
+            self.profiles_written += 1
+            self._prune()
+            return path
+        except Exception as e:
+            print(f"Could not save request profile: {e}")
+            return None
+        finally:
+            self.lock.release()
+    
+    def _prune(self):
+        """Deletes the oldest profiles beyond max_files"""
+        profiles = [entry for entry in os.scandir(self.directory)
+                    if entry.is_file() and entry.name.endswith((".prof", ".html"))]
+        profiles.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[:max(len(profiles) - self.max_files, 0)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+request_profiler = RequestProfiler(PROFILE_DIR, PROFILE_SAMPLE_RATE, PROFILE_TOKEN, PROFILER, PROFILE_MAX_FILES)
+
+
+# Helper Functions
+
+# System instructions for AI behavior
+SYSTEM_PROMPT = (
+    "You are a professional marketing analyst specializing in data-driven strategies. "
+    "Provide actionable, specific marketing recommendations based on the provided data. "
+    "Focus on India and USA markets. Be concise and practical."
+)
+
+def get_company_manager(company_id):
+    """
+    Retrieves or creates a company manager instance.
+    
+    Args:
+        company_id: Unique company identifier
+        
+    Returns:
+        CompanyDataManager: Manager instance or None if invalid ID
+    """
+    if company_id not in COMPANY_CONFIG:
+        return None
+    
+    company_manager = company_managers.get(company_id)
+    if company_manager is None:
+        with company_manager_locks[company_id]:
+            company_manager = company_managers.get(company_id)
+            if company_manager is None:
+                with COMPANY_INIT_SECONDS.time(company=company_id), trace_span("company-init"):
+                    company_manager = CompanyDataManager(company_id)
+                    # Initialize data on first access
+                    company_manager.data_manager.start_background_load()
+                company_managers[company_id] = company_manager
+    
+    # Answer once partial data is available
+    with trace_span("data-wait"):
+        company_manager.data_manager.wait_for_data()
+    return company_manager
+
+
+def warm_up_company_managers():
+    """
+    Initializes every configured company in parallel and marks the app ready.
+    
+    Each company's background query, connection test and full data load run
+    on a thread pool, so user requests find managers already populated.
+    """
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="warmup") as pool:
+        futures = {pool.submit(_warm_up_company, company_id): company_id for company_id in COMPANY_CONFIG}
+        for future in as_completed(futures):
+            company_id = futures[future]
+            try:
+                state = future.result()
+                print(f"Warm-up for {company_id} finished: {state}")
+            except Exception as e:
+                print(f"Warm-up for {company_id} failed: {e}")
+    
+    app_ready.set()
+    print(f"Warm-up completed in {time.time() - started:.1f}s")
+
+
+def _warm_up_company(company_id):
+    """Creates a company manager and waits for its data load to finish"""
+    company_manager = get_company_manager(company_id)
+    company_manager.data_manager.wait_for_load()
+    return company_manager.data_manager.load_progress["state"]
+
+
+def start_background_services():
+    """
+    Starts warm-up and the data refresher in the current process.
+    
+    Called once per worker (see gunicorn.conf.py) or when running app.py
+    directly. Warm-up runs on a background thread so startup is not blocked;
+    readiness is reported by /ready.
+    """
+    global warm_up_thread
+    
+    with warm_up_lock:
+        if warm_up_thread is None:
+            if WARMUP_ON_START:
+                warm_up_thread = threading.Thread(target=warm_up_company_managers, name="warmup", daemon=True)
+                warm_up_thread.start()
+            else:
+                warm_up_thread = False
+                app_ready.set()
+    
+    data_refresher.start()
+
+
+def create_efficient_prompt(current_data, current_background, user_prompt, conversation_manager):
+    """
+    Creates an optimized prompt for the AI model.
+    
+    Args:
+        current_data: Company data digest (or status message if unavailable)
+        current_background: Company background information
+        user_prompt: User's question
+        conversation_manager: ConversationManager instance
+        
+    Returns:
+        str: Complete prompt for AI model
+    """
+    prompt, _ = build_prompt(current_data, current_background, user_prompt, conversation_manager)
+    return prompt
+
+
+def build_prompt(current_data, current_background, user_prompt, conversation_manager, model=GEMINI_MODEL):
+    """
+    Creates the prompt for the AI model, packed into the model's token budget.
+    
+    Args:
+        current_data: Company data digest (or status message if unavailable)
+        current_background: Company background information
+        user_prompt: User's question
+        conversation_manager: ConversationManager instance
+        model: Gemini model the prompt is sized for
+        
+    Returns:
+        tuple: (complete prompt, token breakdown per section)
+    """
+    sections = OrderedDict([
+        ("system", SYSTEM_PROMPT),
+        ("background", f"Company Background:\n{current_background}"),
+        ("data", f"Dataset:\n{current_data}"),
+        ("history", build_history_section(conversation_manager, user_prompt)),
+        ("question", build_question_section(user_prompt))
+    ])
+    packed, breakdown = PromptPacker.for_model(model).pack(sections)
+    
+    # Construct final prompt
+    final_prompt = "\n\n".join(text for text in packed.values() if text) + "\n"
+    return final_prompt, breakdown
+
+
+def build_prompt_prefix(current_data, current_background, model=GEMINI_MODEL):
+    """
+    Creates the stable part of the prompt shared by every question.
+    
+    Args:
+        current_data: Company data digest (or status message if unavailable)
+        current_background: Company background information
+        model: Gemini model the prompt is sized for
+        
+    Returns:
+        tuple: (prefix text, token breakdown per section)
+    """
+    sections = OrderedDict([
+        ("system", SYSTEM_PROMPT),
+        ("background", f"Company Background:\n{current_background}"),
+        ("data", f"Dataset:\n{current_data}")
+    ])
+    packed, breakdown = PromptPacker.for_model(model).pack(sections)
+    return "\n\n".join(text for text in packed.values() if text), breakdown
+
+
+def build_prompt_suffix(prefix, question_data, user_prompt, conversation_manager, model=GEMINI_MODEL):
+    """
+    Creates the question-specific part of the prompt that follows a memoized prefix.
+    
+    Args:
+        prefix: Prefix entry from PromptPrefixCache
+        question_data: Rows/summary retrieved for the question, or None
+        user_prompt: User's question
+        conversation_manager: ConversationManager instance
+        model: Gemini model the prompt is sized for
+        
+    Returns:
+        tuple: (suffix text, token breakdown covering prefix and suffix)
+    """
+    sections = OrderedDict()
+    if question_data:
+        sections["question_data"] = f"Data relevant to this question:\n{question_data}"
+    sections["history"] = build_history_section(conversation_manager, user_prompt)
+    sections["question"] = build_question_section(user_prompt)
+    
+    packer = PromptPacker.for_model(model)
+    packed, suffix_breakdown = packer.pack(sections, budget=packer.budget - prefix["tokens"])
+    
+    breakdown = dict(prefix["breakdown"])
+    breakdown["budget"] = packer.budget
+    breakdown["total"] = prefix["tokens"] + suffix_breakdown["total"]
+    breakdown["sections"] = dict(prefix["breakdown"]["sections"], **suffix_breakdown["sections"])
+    breakdown["truncated"] = dict(prefix["breakdown"]["truncated"], **suffix_breakdown["truncated"])
+    return "\n\n".join(text for text in packed.values() if text) + "\n", breakdown
+
+
+def build_history_section(conversation_manager, user_prompt):
+    """
+    Formats the conversation turns relevant to a question.
+    
+    Turns evicted from history appear as the running summary; older turns
+    still in history carry their compacted answers.
+    
+    Args:
+        conversation_manager: ConversationManager instance
+        user_prompt: User's question
+        
+    Returns:
+        str: History section text, empty if there is no history
+    """
+    relevant_history = conversation_manager.get_relevant_history(user_prompt)
+    summary = conversation_manager.get_summary()
+    if not relevant_history and not summary:
+        return ""
+    
+    history_text = "--- Previous Conversation Context ---\n"
+    data_context_note = conversation_manager.get_data_context_note()
+    if data_context_note:
+        history_text += f"{data_context_note}\n\n"
+    if summary:
+        history_text += f"Summary of earlier exchanges:\n{summary}\n\n"
+    
+    for i, (q, a) in enumerate(relevant_history[-3:]):
+        history_text += f"Previous Q{i+1}: {q}\nPrevious A{i+1}: {a}\n\n"
+    return history_text.rstrip()
+
+
+def build_question_section(user_prompt):
+    """Formats the closing instruction and the current question"""
+    return f"Provide specific, actionable marketing recommendations.\nCurrent Question: {user_prompt}"
+
+
+def get_insights(prompt, context=None, model=GEMINI_MODEL, sql_tool=None):
+    """
+    Generates insights using Google's Gemini AI model.
+    
+    Args:
+        prompt: Complete prompt for the AI model, or only the suffix when
+            context is given
+        context: Prefix entry from PromptPrefixCache with a registered context
+        model: Gemini model to use
+        sql_tool: AggregateQueryTool the model may call for data (function-calling mode)
+        
+    Returns:
+        str: AI-generated insights or error message
+    """
+    if gemini_client.backend.requires_api_key and not GEMINI_API_KEY:
+        return "Error: Gemini API key is not configured."
+    
+    if not prompt or not isinstance(prompt, str):
+        return "Error: Invalid prompt provided."
+    
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        try:
+            if sql_tool is not None:
+                response = run_sql_tool_conversation(prompt, model, sql_tool)
+            else:
+                response = gemini_client.generate(*resolve_generation(prompt, context, model))
+        except Exception as e:
+            if context is None or not can_resend_without_context(e):
+                raise
+            # The registered context expired or was rejected; resend the full prompt
+            prompt_prefixes.discard(context)
+            response = gemini_client.generate(
+                *resolve_generation(context["text"] + "\n\n" + prompt, None, model))
+        
+        if response.parts and response.text:
+            outcome = "success"
+            return response.text
+        else:
+            # Handle blocked responses
+            feedback = getattr(response, 'prompt_feedback', None)
+            if feedback and hasattr(feedback, 'block_reason'):
+                GEMINI_ERRORS.inc(category="blocked")
+                return f"Response blocked: {feedback.block_reason}. Please rephrase your question."
+            GEMINI_ERRORS.inc(category="empty")
+            return "No response generated. Please try rephrasing your question."
+    
+    except Exception as e:
+        return describe_gemini_error(e)
+    finally:
+        GEMINI_SECONDS.observe(time.perf_counter() - started, model=model, mode="sync", outcome=outcome)
+
+
+def get_insights_stream(prompt, context=None, model=GEMINI_MODEL):
+    """
+    Streams insights from Google's Gemini AI model as they are generated.
+    
+    Args:
+        prompt: Complete prompt for the AI model, or only the suffix when
+            context is given
+        context: Prefix entry from PromptPrefixCache with a registered context
+        model: Gemini model to use
+        
+    Yields:
+        str: Text chunks of the AI response
+        
+    Raises:
+        InsightsError: If the API key is missing, the response is blocked or the API call fails
+    """
+    if gemini_client.backend.requires_api_key and not GEMINI_API_KEY:
+        raise InsightsError("Error: Gemini API key is not configured.")
+    
+    if not prompt or not isinstance(prompt, str):
+        raise InsightsError("Error: Invalid prompt provided.")
+    
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        try:
+            try:
+                response, chunks = gemini_client.generate_stream(*resolve_generation(prompt, context, model))
+            except Exception as e:
+                if context is None or not can_resend_without_context(e):
+                    raise
+                # The registered context expired or was rejected; resend the full prompt
+                prompt_prefixes.discard(context)
+                response, chunks = gemini_client.generate_stream(
+                    *resolve_generation(context["text"] + "\n\n" + prompt, None, model))
+            
+            produced_text = False
+            for chunk in chunks:
+                if chunk.parts and chunk.text:
+                    produced_text = True
+                    yield chunk.text
+        except Exception as e:
+            raise InsightsError(describe_gemini_error(e)) from e
+        
+        if not produced_text:
+            # Handle blocked responses
+            feedback = getattr(response, 'prompt_feedback', None)
+            if feedback and hasattr(feedback, 'block_reason'):
+                GEMINI_ERRORS.inc(category="blocked")
+                raise InsightsError(f"Response blocked: {feedback.block_reason}. Please rephrase your question.")
+            GEMINI_ERRORS.inc(category="empty")
+            raise InsightsError("No response generated. Please try rephrasing your question.")
+        outcome = "success"
+    finally:
+        GEMINI_SECONDS.observe(time.perf_counter() - started, model=model, mode="stream", outcome=outcome)
+
+
+def resolve_generation(prompt, context, model=GEMINI_MODEL):
+    """
+    Picks the model, request contents and cached context for a prompt.
+    
+    Args:
+        prompt: Complete prompt, or the suffix following a registered context
+        context: Prefix entry from PromptPrefixCache, or None
+        model: Gemini model to use
+        
+    Returns:
+        tuple: (model name, contents to send, cached context name or None)
+    """
+    if context is None or not context.get("cached_content"):
+        return model, prompt, None
+    
+    if prompt_prefixes.mode == "gemini":
+        if context["model"] == model:
+            return model, prompt, context["cached_content"]
+        # Cached contents belong to one model; other tiers get the full prompt
+        return model, context["text"] + "\n\n" + prompt, None
+    
+    # Local stub: the stored prefix is prepended before calling the model
+    prefix_text = prompt_prefixes.local_store.get(context["cached_content"])
+    if prefix_text is None:
+        raise LookupError("Cached context expired")
+    return model, prefix_text + "\n\n" + prompt, None
+
+
+def run_sql_tool_conversation(prompt, model, sql_tool):
+    """
+    Lets Gemini query the scans table before answering.
+    
+    Each function call from the model is validated and executed by the tool
+    and its result is sent back, until the model answers in text. Calls
+    beyond SQL_TOOL_MAX_QUERIES get an error result asking for an answer.
+    
+    Args:
+        prompt: Complete prompt, with the table schema as its data section
+        model: Gemini model to use
+        sql_tool: Company's AggregateQueryTool
+        
+    Returns:
+        Response object holding the model's final answer
+        
+    Raises:
+        RuntimeError: If the model keeps calling functions without answering
+    """
+    contents = [{"role": "user", "parts": [prompt]}]
+    tools = [{"function_declarations": [AggregateQueryTool.DECLARATION]}]
+    queries = 0
+    
+    for _ in range(SQL_TOOL_MAX_QUERIES + 2):
+        response = gemini_client.generate(model, contents, tools=tools)
+        calls = [part.function_call for part in response.parts
+                 if getattr(part, "function_call", None) and part.function_call.name]
+        if not calls:
+            return response
+        
+        results = []
+        for call in calls:
+            queries += 1
+            if call.name != AggregateQueryTool.NAME:
+                result = {"error": f"Unknown function {call.name}."}
+            elif queries > SQL_TOOL_MAX_QUERIES:
+                result = {"error": "Query limit reached. Answer from the results you already have."}
+            else:
+                with trace_span("sql-tool"):
+                    result = sql_tool.run(str(dict(call.args).get("sql", "")))
+            results.append({"function_response": {"name": call.name, "response": result}})
+        
+        contents.append(response.candidates[0].content)
+        contents.append({"role": "user", "parts": results})
+    
+    raise RuntimeError("Gemini kept requesting queries without answering")
+
+
+def can_resend_without_context(error):
+    """
+    Checks whether a failed call with a cached context should be resent in full.
+    
+    Transient failures (outages, timeouts, an open breaker) would fail again,
+    so only errors about the context itself qualify.
+    """
+    return not isinstance(error, (GeminiTimeoutError, GeminiUnavailableError)) \
+        and not GeminiClient.is_retryable(error)
+
+
+# Prefixes of the user-facing messages get_insights returns instead of answers
+INSIGHTS_ERROR_PREFIXES = (
+    "Error:",
+    "Response blocked",
+    "No response generated",
+    "Gemini API is temporarily unavailable",
+    "Gemini API did not respond in time",
+    "API quota exceeded",
+    "API error occurred"
+)
+
+
+def describe_gemini_error(error):
+    """
+    Converts a Gemini API exception into a user-facing message.
+    
+    Args:
+        error: Exception raised by the Gemini client
+        
+    Returns:
+        str: Error message suitable for display
+    """
+    if isinstance(error, GeminiUnavailableError):
+        GEMINI_ERRORS.inc(category="circuit_open")
+        return "Gemini API is temporarily unavailable. Please try again in a moment."
+    if isinstance(error, GeminiTimeoutError):
+        GEMINI_ERRORS.inc(category="timeout")
+        return "Gemini API did not respond in time. Please try again."
+    
+    error_str = str(error).lower()
+    if "500" in error_str or "internal error" in error_str:
+        GEMINI_ERRORS.inc(category="unavailable")
+        return "Gemini API is temporarily unavailable. Please try again in a moment."
+    elif "quota" in error_str or "limit" in error_str:
+        GEMINI_ERRORS.inc(category="quota")
+        return "API quota exceeded. Please try again later."
+    elif "safety" in error_str:
+        GEMINI_ERRORS.inc(category="safety")
+        return "Response blocked for safety reasons. Please rephrase your question."
+    else:
+        GEMINI_ERRORS.inc(category="other")
+        return f"API error occurred. Please try again. ({str(error)[:50]}...)"
+
+
+def prepare_question(payload):
+    """
+    Validates an /ask request and prepares the company manager for answering.
+    
+    Args:
+        payload: Parsed JSON request body
+        
+    Returns:
+        tuple: (company_manager, user_prompt, error_response); error_response is
+            a (JSON, status) tuple when validation fails, otherwise None
+    """
+    company_id = payload.get('company_id')
+    if not company_id:
+        return None, None, (jsonify({"error": "No company ID provided"}), 400)
+    
+    company_manager = get_company_manager(company_id)
+    if not company_manager:
+        return None, None, (jsonify({"error": "Invalid company ID"}), 400)
+    
+    user_prompt = payload.get('prompt', '').strip()
+    custom_background = payload.get('background', '').strip()
+    
+    if not user_prompt:
+        return None, None, (jsonify({"error": "No prompt provided."}), 400)
+    
+    if len(user_prompt) > 500:
+        return None, None, (jsonify({"error": "Prompt too long. Please keep it under 500 characters."}), 400)
+    
+    # Update background if provided
+    if custom_background:
+        company_manager.background_manager.update_background(custom_background)
+    
+    # Load data if not initialized
+    if not company_manager.data_manager.initialization_attempted:
+        company_manager.data_manager.start_background_load()
+        with trace_span("data-wait"):
+            company_manager.data_manager.wait_for_data()
+    
+    return company_manager, user_prompt, None
+
+
+def build_question_prompt(company_manager, user_prompt, use_sql_tool=False):
+    """
+    Builds the full AI prompt for a question using the company's current state.
+    
+    Args:
+        company_manager: CompanyDataManager instance
+        user_prompt: User's question
+        use_sql_tool: Describe the scans table instead of including data, for
+            the function-calling mode
         
-        except mysql.connector.Error as e:
-            error_msg = f"MySQL connection error for {self.company_manager.get_company_name()}: {e}"
-            self.connection_error = error_msg
-            return False
-        except Exception as e:
-            error_msg = f"Database connection test failed for {self.company_manager.get_company_name()}: {e}"
-            self.connection_error = error_msg
-            return False
+    Returns:
+        tuple: (prompt for AI model, token breakdown, context); context is
+            the registered prefix entry when the prompt holds only the suffix,
+            otherwise None and the prompt is complete
+    """
+    started = time.perf_counter()
+    data_manager = company_manager.data_manager
+    background = company_manager.background_manager.get_background()
+    question_data = None if use_sql_tool else data_manager.get_question_data(user_prompt)
     
-    def get_engine(self):
-        """
-        Creates SQLAlchemy engine for database operations.
+    if use_sql_tool:
+        # The model fetches the aggregates it needs, so only the schema is sent
+        prompt, breakdown = build_prompt(company_manager.sql_tool.describe_schema(), background, user_prompt,
+                                         company_manager.conversation_manager)
+        context = None
+    elif question_data is not None and prompt_prefixes.mode == "off":
+        # Without context caching the retrieved subset replaces the full digest
+        prompt, breakdown = build_prompt(question_data, background, user_prompt,
+                                         company_manager.conversation_manager)
+        context = None
+    else:
+        prefix, reused = prompt_prefixes.get(
+            company_manager.company_id, data_manager.data_version, background, GEMINI_MODEL,
+            lambda: build_prompt_prefix(data_manager.get_prompt_data(), background)
+        )
+        suffix, breakdown = build_prompt_suffix(prefix, question_data, user_prompt,
+                                                company_manager.conversation_manager)
+        breakdown["prefix"] = {"tokens": prefix["tokens"], "reused": reused,
+                               "context_cache": bool(prefix["cached_content"])}
         
-        Returns:
-            Engine: SQLAlchemy engine instance
-        """
-        try:
-            def get_conn():
-                return mysql.connector.connect(
-                    user=MYSQL_USER,
-                    password=MYSQL_PASSWORD,
-                    database=self.company_manager.mysql_db,
-                    unix_socket=f"/cloudsql/{INSTANCE_CONNECTION_NAME}",
-                    connect_timeout=15,
-                    autocommit=True
-                )
-            return create_engine("mysql+mysqlconnector://", creator=get_conn)
-        except Exception as e:
-            raise
+        if prefix["cached_content"]:
+            prompt, context = suffix, prefix
+        else:
+            prompt, context = prefix["text"] + "\n\n" + suffix, None
     
-    def load_data(self):
-        """
-        Loads data from the database.
+    PROMPT_BUILD_SECONDS.observe(time.perf_counter() - started)
+    PROMPT_CHARACTERS.observe(len(prompt))
+    PROMPT_TOKENS.observe(breakdown["total"])
+    return prompt, breakdown, context
+
+
+def estimate_call_tokens(prompt_tokens):
+    """
+    Estimates the tokens a Gemini call will count against the quota.
+    
+    Args:
+        prompt_tokens: Token breakdown from build_question_prompt
         
-        Returns:
-            bool: True if data loaded successfully, False otherwise
-        """
-        try:
-            # Test connection first
-            if not self.test_database_connection():
-                self.initialization_attempted = True
-                return False
-            
-            engine = self.get_engine()
-            
-            # Check if table exists
-            table_check_query = "SHOW TABLES LIKE 'scans'"
-            table_exists = pd.read_sql(table_check_query, engine)
-            
-            if table_exists.empty:
-                error_msg = f"Table 'scans' does not exist in database for {self.company_manager.get_company_name()}"
-                self.data = error_msg
-                self.initialization_attempted = True
-                return False
-            
-            # Load data with row limit for performance
-            query = "SELECT * FROM scans LIMIT 5000"
-            data_df = pd.read_sql(query, engine)
-            
-            if data_df.empty:
-                self.data = f"No data available in database table 'scans' for {self.company_manager.get_company_name()}."
-                self.initialization_attempted = True
-                return False
-            
-            # Convert to CSV format for AI processing
-            self.data = data_df.to_csv(index=False)
-            self.raw_data_df = data_df
-            self.initialization_attempted = True
-            self.connection_error = None
-            return True
+    Returns:
+        int: Prompt tokens plus the expected response length
+    """
+    return prompt_tokens["total"] + ADMISSION_OUTPUT_TOKENS
+
+
+def answer_question(company_manager, user_prompt, is_cancelled=None, priority="interactive"):
+    """
+    Answers a validated question, using the response cache and single-flight
+    coalescing, and records the turn in the conversation history.
+    
+    Args:
+        company_manager: CompanyDataManager instance
+        user_prompt: User's question
+        is_cancelled: Optional callable; when it returns True the answer is
+            not recorded in the conversation history
+        priority: Admission priority, "interactive" or "batch"
         
-        except Exception as e:
-            error_msg = f"Error loading data for {self.company_manager.get_company_name()}: {str(e)}"
-            self.data = f"Data unavailable due to error: {str(e)[:200]}"
-            self.connection_error = str(e)
-            self.initialization_attempted = True
-            return False
+    Returns:
+        dict: /ask response body (insights and metadata)
+        
+    Raises:
+        TimeoutError: If waiting on an identical in-flight request timed out
+        AdmissionTimeoutError: If the question was not admitted to Gemini in time
+    """
+    # Serve identical questions against unchanged inputs from cache
+    with trace_span("cache"):
+        cache_key = build_response_cache_key(company_manager, user_prompt)
+        insights = response_cache.get(cache_key)
+    cached = insights is not None
     
-    def get_data_info(self):
-        """
-        Returns information about loaded data.
+    coalesced = False
+    prompt_tokens = None
+    routing = None
+    if not cached:
+        # Create prompt for AI
+        with trace_span("prompt"):
+            full_prompt, prompt_tokens, context = build_question_prompt(company_manager, user_prompt, SQL_TOOL)
+        flight_key = (context["key"] if context else "") + full_prompt
+        routing = route_question(company_manager, user_prompt, prompt_tokens)
+        sql_tool = company_manager.sql_tool if SQL_TOOL else None
         
-        Returns:
-            dict: Data statistics and error information
-        """
-        if self.raw_data_df is not None:
-            return {
-                "total_records": len(self.raw_data_df),
-                "columns": list(self.raw_data_df.columns),
-                "connection_error": self.connection_error
-            }
-        return {
-            "total_records": 0,
-            "columns": [],
-            "connection_error": self.connection_error
-        }
-
+        def generate():
+            with admission_controller.admit(company_manager.company_id,
+                                            estimate_call_tokens(prompt_tokens), priority):
+                insights = model_router.call(routing, lambda model: get_insights(full_prompt, context, model, sql_tool))
+            return insights, routing
+        
+        # Generate insights, sharing one Gemini call among identical concurrent requests
+        with trace_span("gemini"):
+            (insights, routing), coalesced = insight_flights.do(
+                hashlib.sha256(flight_key.encode('utf-8')).hexdigest(),
+                generate,
+                timeout=SINGLE_FLIGHT_TIMEOUT
+            )
+        
+        if is_successful_answer(insights) and not coalesced:
+            response_cache.set(cache_key, company_manager.company_id, insights)
+    
+    if is_cancelled and is_cancelled():
+        return {"insights": insights, "cached": cached, "coalesced": coalesced,
+                "prompt_tokens": prompt_tokens, "routing": routing}
+    
+    # Add to conversation history if successful; the leader of a coalesced
+    # call already recorded this identical turn in the shared conversation
+    if not coalesced and not insights.startswith("Error:") and not insights.startswith("Response blocked"):
+        company_manager.conversation_manager.add_turn(user_prompt, insights)
+    
+    # Prepare response
+    response_data = {"insights": insights, "cached": cached, "coalesced": coalesced,
+                     "prompt_tokens": prompt_tokens, "routing": routing}
+    response_data.update(build_answer_metadata(company_manager))
+    return response_data
 
-# Helper Functions
 
-def get_company_manager(company_id):
+def parse_kpi_filters(value):
     """
-    Retrieves or creates a company manager instance.
+    Parses the /kpis filters parameter.
     
     Args:
-        company_id: Unique company identifier
+        value: "dim:value|value,dim:value" or a JSON object of dim -> value(s)
         
     Returns:
-        CompanyDataManager: Manager instance or None if invalid ID
+        dict: Dimension to list of values
+        
+    Raises:
+        ValueError: If the parameter is malformed
     """
-    if company_id not in COMPANY_CONFIG:
-        return None
-    
-    if company_id not in company_managers:
-        company_managers[company_id] = CompanyDataManager(company_id)
-        # Initialize data on first access
-        company_managers[company_id].data_manager.load_data()
+    value = value.strip()
+    if not value:
+        return {}
+    if value.startswith('{'):
+        parsed = json.loads(value)
+        if not isinstance(parsed, dict):
+            raise ValueError("filters must be a JSON object")
+        return {str(name): [str(v) for v in (values if isinstance(values, list) else [values])]
+                for name, values in parsed.items()}
     
-    return company_managers[company_id]
+    filters = {}
+    for item in value.split(','):
+        name, separator, values = item.partition(':')
+        if not separator or not name.strip():
+            raise ValueError(f"expected dim:value, got '{item}'")
+        filters.setdefault(name.strip(), []).extend(v.strip() for v in values.split('|'))
+    return filters
 
 
-def create_efficient_prompt(current_data, current_background, user_prompt, conversation_manager):
+def route_question(company_manager, user_prompt, prompt_tokens):
     """
-    Creates an optimized prompt for the AI model.
+    Picks the Gemini tier for a question.
     
     Args:
-        current_data: Company data in CSV format
-        current_background: Company background information
+        company_manager: CompanyDataManager instance
         user_prompt: User's question
-        conversation_manager: ConversationManager instance
+        prompt_tokens: Token breakdown from build_question_prompt
         
     Returns:
-        str: Complete prompt for AI model
+        dict: Routing decision from ModelRouter.route
     """
-    relevant_history = conversation_manager.get_relevant_history(user_prompt)
-    data_context_note = conversation_manager.get_data_context_note()
+    return model_router.route(user_prompt, prompt_tokens["total"],
+                              bool(company_manager.conversation_manager.history))
+
+
+def build_response_cache_key(company_manager, user_prompt):
+    """
+    Builds the response cache key for a question.
     
-    # System instructions for AI behavior
-    system_prompt = (
-        "You are a professional marketing analyst specializing in data-driven strategies. "
-        "Provide actionable, specific marketing recommendations based on the provided data. "
-        "Focus on India and USA markets. Be concise and practical."
+    The key covers the data fingerprint, current background, normalized
+    question and the history turns and running summary
+    create_efficient_prompt will include.
+    
+    Args:
+        company_manager: CompanyDataManager instance
+        user_prompt: User's question
+        
+    Returns:
+        str: Cache key
+    """
+    conversation_manager = company_manager.conversation_manager
+    return ResponseCache.make_key(
+        company_manager.company_id,
+        company_manager.data_manager.data_fingerprint,
+        company_manager.background_manager.get_background(),
+        user_prompt,
+        [conversation_manager.get_summary(), conversation_manager.get_relevant_history(user_prompt)[-3:]]
     )
+
+
+def is_successful_answer(insights):
+    """
+    Checks whether get_insights returned an answer rather than an error message.
     
-    # Limit data size to prevent API errors
-    if len(current_data) > 50000:  # Limit to ~50KB
-        lines = current_data.split('\n')
-        header = lines[0] if lines else ""
-        data_sample = '\n'.join(lines[:500])  # First 500 rows
-        data_section = f"Dataset Sample (showing first 500 records):\n{header}\n{data_sample}\n\n[Note: Full dataset contains more records but showing sample for analysis]"
-    else:
-        data_section = f"Complete Dataset:\n{current_data}"
+    Args:
+        insights: Text returned by get_insights
+        
+    Returns:
+        bool: True if the text is a real answer
+    """
+    return not insights.startswith(INSIGHTS_ERROR_PREFIXES)
+
+
+def build_answer_metadata(company_manager):
+    """
+    Builds the metadata returned alongside an answer.
     
-    # Build conversation history section
-    history_text = ""
-    if relevant_history:
-        history_text = "\n--- Previous Conversation Context ---\n"
-        if data_context_note:
-            history_text += f"{data_context_note}\n\n"
+    Args:
+        company_manager: CompanyDataManager instance
         
-        for i, (q, a) in enumerate(relevant_history[-3:]):
-            history_text += f"Previous Q{i+1}: {q}\nPrevious A{i+1}: {a}\n\n"
+    Returns:
+        dict: Record count, conversation length, background info and any warning
+    """
+    data_info = company_manager.data_manager.get_data_info()
     
-    # Construct final prompt
-    final_prompt = (
-        f"{system_prompt}\n\n"
-        f"Company Background:\n{current_background}\n\n"
-        f"{data_section}\n"
-        f"{history_text}"
-        f"Provide specific, actionable marketing recommendations."
-        f"Current Question: {user_prompt}\n\n"
-    )
+    metadata = {
+        "total_records": data_info["total_records"],
+        "conversation_length": len(company_manager.conversation_manager.history),
+        "background_info": company_manager.background_manager.get_background_info()
+    }
+    
+    # Add warning if database connection failed
+    if data_info.get("connection_error"):
+        metadata["warning"] = f"Database connection issue: {data_info['connection_error']}"
     
-    return final_prompt
+    return metadata
 
 
-def get_insights(prompt):
+def format_sse(event, data):
     """
-    Generates insights using Google's Gemini AI model.
+    Formats a Server-Sent Events message.
     
     Args:
-        prompt: Complete prompt for the AI model
+        event: Event name
+        data: JSON-serializable payload
         
     Returns:
-        str: AI-generated insights or error message
+        str: Encoded SSE message
     """
-    if not GEMINI_API_KEY:
-        return "Error: Gemini API key is not configured."
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Flask Routes
+
+@app.before_request
+def track_request_start():
+    """Counts the request as in flight and starts its trace (and profile, if requested)"""
+    g.in_flight_endpoint = request.endpoint or "unknown"
+    REQUESTS_IN_FLIGHT.inc(endpoint=g.in_flight_endpoint)
     
-    if not prompt or not isinstance(prompt, str):
-        return "Error: Invalid prompt provided."
+    g.trace = RequestTrace()
+    if request_profiler.should_profile(request.headers.get("X-Profile")):
+        g.profiler = request_profiler.start()
+
+
+@app.after_request
+def track_request_status(response):
+    """Counts handled requests and reports the trace in Server-Timing"""
+    HTTP_REQUESTS.inc(endpoint=request.endpoint or "unknown", status=response.status_code)
     
-    try:
-        model = genai.GenerativeModel("gemini-1.5-pro")
-        
-        response = model.generate_content(prompt)
-        
-        if response.parts and response.text:
-            return response.text
-        else:
-            # Handle blocked responses
-            feedback = getattr(response, 'prompt_feedback', None)
-            if feedback and hasattr(feedback, 'block_reason'):
-                return f"Response blocked: {feedback.block_reason}. Please rephrase your question."
-            return "No response generated. Please try rephrasing your question."
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        path = request_profiler.stop(profiler, request.endpoint or "unknown")
+        if path:
+            response.headers["X-Profile-File"] = os.path.basename(path)
     
-    except Exception as e:
-        # Handle various API errors gracefully
-        error_str = str(e).lower()
-        if "500" in error_str or "internal error" in error_str:
-            return "Gemini API is temporarily unavailable. Please try again in a moment."
-        elif "quota" in error_str or "limit" in error_str:
-            return "API quota exceeded. Please try again later."
-        elif "safety" in error_str:
-            return "Response blocked for safety reasons. Please rephrase your question."
-        else:
-            return f"API error occurred. Please try again. ({str(e)[:50]}...)"
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
 
 
-# Flask Routes
+@app.teardown_request
+def track_request_end(error=None):
+    """Removes the request from the in-flight gauge"""
+    # Streamed responses can tear down more than once; only the first counts
+    endpoint = g.pop('in_flight_endpoint', None)
+    if endpoint is not None:
+        REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+    
+    # Requests that failed before after_request still release the profiler
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        request_profiler.stop(profiler, request.endpoint or "unknown")
+
 
 @app.route('/')
 def index():
@@ -704,7 +6188,11 @@ def test_endpoint():
                     else background_info["current_background"],
                 "background_is_edited": background_info["is_edited"],
                 "connection_error": company_manager.data_manager.connection_error,
-                "data_info": company_manager.data_manager.get_data_info()
+                "connection_pool": company_manager.get_engine().pool.status(),
+                "database_health": company_manager.db_health.get_status(),
+                "data_info": company_manager.data_manager.get_data_info(),
+                "sql_tool": dict(company_manager.sql_tool.get_stats(), enabled=SQL_TOOL),
+                "conversation": company_manager.conversation_manager.get_stats()
             })
         else:
             # General system test
@@ -715,8 +6203,17 @@ def test_endpoint():
                     "MYSQL_USER": bool(MYSQL_USER),
                     "MYSQL_PASSWORD": bool(MYSQL_PASSWORD),
                     "INSTANCE_CONNECTION_NAME": bool(INSTANCE_CONNECTION_NAME),
-                    "GEMINI_API_KEY": bool(GEMINI_API_KEY)
-                }
+                    "DATABASE_URL_TEMPLATE": bool(DATABASE_URL_TEMPLATE),
+                    "GEMINI_API_KEY": bool(GEMINI_API_KEY),
+                    "GEMINI_BACKEND": GEMINI_BACKEND
+                },
+                "response_cache": response_cache.get_stats(),
+                "single_flight": insight_flights.get_stats(),
+                "prompt_prefix": prompt_prefixes.get_stats(),
+                "gemini": gemini_client.get_stats(),
+                "model_routing": model_router.get_stats(),
+                "jobs": insight_jobs.get_stats(),
+                "admission": admission_controller.get_stats()
             })
     except Exception as e:
         return jsonify({
@@ -725,77 +6222,273 @@ def test_endpoint():
         }), 500
 
 
+@app.route('/ready')
+def readiness():
+    """
+    Readiness probe reporting whether startup warm-up has finished.
+    
+    Returns:
+        JSON: Readiness flag and per-company load state (503 until ready)
+    """
+    companies = {
+        company_id: company_manager.data_manager.load_progress["state"]
+        for company_id, company_manager in list(company_managers.items())
+    }
+    status_code = 200 if app_ready.is_set() else 503
+    return jsonify({"ready": app_ready.is_set(), "companies": companies}), status_code
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint.
+    
+    Returns:
+        Response: Metrics in the Prometheus text exposition format
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/ask', methods=['POST'])
 def ask_question():
     """
     Main API endpoint for generating marketing insights.
     
+    With "async": true in the request body, the question is queued and a job
+    id is returned immediately; poll GET /jobs/<job_id> for the result.
+    With "timings": true, per-stage timings (also sent in the Server-Timing
+    header) are included in the body. "priority": "batch" queues the question
+    behind interactive ones for Gemini admission.
+    
     Returns:
-        JSON: AI-generated insights and metadata
+        JSON: AI-generated insights and metadata, the queued job (202), or
+        429 with Retry-After if the question was not admitted in time
     """
     try:
-        company_id = request.json.get('company_id')
-        if not company_id:
-            return jsonify({"error": "No company ID provided"}), 400
+        with trace_span("validate"):
+            company_manager, user_prompt, error_response = prepare_question(request.json)
+        if error_response:
+            return error_response
         
-        company_manager = get_company_manager(company_id)
-        if not company_manager:
-            return jsonify({"error": "Invalid company ID"}), 400
+        priority = request.json.get('priority', 'interactive')
+        if priority not in AdmissionController.PRIORITIES:
+            return jsonify({"error": "Priority must be \"interactive\" or \"batch\""}), 400
         
-        user_prompt = request.json.get('prompt', '').strip()
-        custom_background = request.json.get('background', '').strip()
+        if request.json.get('async'):
+            try:
+                job = insight_jobs.submit(
+                    company_manager.company_id,
+                    lambda is_cancelled: answer_question(company_manager, user_prompt, is_cancelled, priority)
+                )
+            except queue.Full:
+                response = jsonify({"error": "Too many questions in progress. Please try again shortly."})
+                response.headers["Retry-After"] = "5"
+                return response, 429
+            
+            job["status_url"] = url_for('get_job', job_id=job["job_id"])
+            return jsonify(job), 202
         
-        if not user_prompt:
-            return jsonify({"error": "No prompt provided."}), 400
+        try:
+            response_data = answer_question(company_manager, user_prompt, priority=priority)
+        except TimeoutError as e:
+            return jsonify({"error": str(e)}), 504
+        except AdmissionTimeoutError as e:
+            response = jsonify({"error": str(e)})
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response, 429
         
-        if len(user_prompt) > 500:
-            return jsonify({"error": "Prompt too long. Please keep it under 500 characters."}), 400
+        if request.json.get('timings'):
+            response_data["timings"] = g.trace.to_dict()
+        with trace_span("serialize"):
+            return jsonify(response_data)
+    
+    except Exception as e:
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    API endpoint to check an asynchronous question.
+    
+    Query parameters:
+        wait: Seconds to long-poll for completion (at most 30)
+    
+    Returns:
+        JSON: Job status, with the /ask response as "result" once done
+    """
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), 30)
+    except ValueError:
+        return jsonify({"error": "Invalid wait parameter"}), 400
+    
+    job = insight_jobs.wait(job_id, wait) if wait else insight_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    API endpoint to cancel an asynchronous question.
+    
+    Queued jobs never run; running jobs finish their Gemini call but the
+    result is discarded and not added to the conversation.
+    
+    Returns:
+        JSON: Updated job status
+    """
+    job = insight_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_question_stream():
+    """
+    Streaming variant of /ask using Server-Sent Events.
+    
+    Events:
+        chunk: {"text": ...} with the next piece of the answer
+        done: Answer metadata (same fields as /ask, without insights)
+        error: {"error": ...} if generation failed
+    
+    The Server-Timing header covers the work done before the first event.
+    Answers always use the data digest; SQL tool mode applies to /ask only.
+    
+    Returns:
+        Response: text/event-stream response
+    """
+    try:
+        with trace_span("validate"):
+            company_manager, user_prompt, error_response = prepare_question(request.json)
+        if error_response:
+            return error_response
         
-        # Update background if provided
-        if custom_background:
-            company_manager.background_manager.update_background(custom_background)
+        with trace_span("cache"):
+            cache_key = build_response_cache_key(company_manager, user_prompt)
+            cached_insights = response_cache.get(cache_key)
+        with trace_span("prompt"):
+            full_prompt, prompt_tokens, context = (None, None, None) if cached_insights is not None \
+                else build_question_prompt(company_manager, user_prompt)
+        routing = None if cached_insights is not None \
+            else route_question(company_manager, user_prompt, prompt_tokens)
+    except Exception as e:
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+    
+    def generate():
+        if cached_insights is not None:
+            company_manager.conversation_manager.add_turn(user_prompt, cached_insights)
+            yield format_sse("chunk", {"text": cached_insights})
+            yield format_sse("done", dict(build_answer_metadata(company_manager), cached=True))
+            return
         
-        # Load data if not initialized
-        if not company_manager.data_manager.initialization_attempted:
-            company_manager.data_manager.load_data()
+        chunks = []
+        try:
+            with admission_controller.admit(company_manager.company_id, estimate_call_tokens(prompt_tokens)):
+                stream = model_router.stream(routing, lambda model: get_insights_stream(full_prompt, context, model))
+                for text in stream:
+                    chunks.append(text)
+                    yield format_sse("chunk", {"text": text})
+        except InsightsError as e:
+            yield format_sse("error", {"error": str(e)})
+            return
+        except AdmissionTimeoutError as e:
+            yield format_sse("error", {"error": str(e), "retry_after": e.retry_after})
+            return
+        except Exception as e:
+            yield format_sse("error", {"error": f"Internal server error: {str(e)}"})
+            return
         
-        # Get current background
-        current_background = company_manager.background_manager.get_background()
+        # Commit the turn only once the full answer has arrived
+        insights = "".join(chunks)
+        response_cache.set(cache_key, company_manager.company_id, insights)
+        company_manager.conversation_manager.add_turn(user_prompt, insights)
+        yield format_sse("done", dict(build_answer_metadata(company_manager), cached=False,
+                                      prompt_tokens=prompt_tokens, routing=routing))
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route('/kpis')
+def get_kpis():
+    """
+    API endpoint for standard aggregates, answered from the KPI cube without Gemini.
+    
+    Query parameters:
+        company_id: Company identifier
+        dims: Comma-separated dimensions to group by (omit for totals)
+        filters: dim:value|value,dim:value or a JSON object of dim -> values
+        limit: Maximum groups returned, largest first (default 100)
+    
+    Returns:
+        JSON: Aggregated groups, or the available dimensions on a bad request
+    """
+    try:
+        company_id = request.args.get('company_id')
+        if not company_id:
+            return jsonify({"error": "No company ID provided"}), 400
         
-        # Create prompt for AI
-        full_prompt = create_efficient_prompt(
-            company_manager.data_manager.data,
-            current_background,
-            user_prompt,
-            company_manager.conversation_manager
-        )
+        company_manager = get_company_manager(company_id)
+        if not company_manager:
+            return jsonify({"error": "Invalid company ID"}), 400
         
-        # Generate insights
-        insights = get_insights(full_prompt)
+        data_manager = company_manager.data_manager
+        cube = data_manager.get_kpi_cube()
+        if cube is None:
+            error = "KPI cube is disabled." if not KPI_CUBE else \
+                (data_manager.connection_error or data_manager.kpi_cube_error or "No data loaded yet.")
+            return jsonify({"error": error}), 503
         
-        # Add to conversation history if successful
-        if not insights.startswith("Error:") and not insights.startswith("Response blocked"):
-            company_manager.conversation_manager.add_turn(user_prompt, insights)
+        dims = [name.strip() for name in request.args.get('dims', '').split(',') if name.strip()]
+        try:
+            filters = parse_kpi_filters(request.args.get('filters', ''))
+            limit = int(request.args.get('limit', 100))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid filters or limit: {e}"}), 400
         
-        # Prepare response
-        data_info = company_manager.data_manager.get_data_info()
-        background_info = company_manager.background_manager.get_background_info()
+        started = time.perf_counter()
+        try:
+            result = cube.query(dims, filters, limit)
+        except ValueError as e:
+            return jsonify({"error": str(e), "cube": cube.describe()}), 400
         
-        response_data = {
-            "insights": insights,
-            "total_records": data_info["total_records"],
-            "conversation_length": len(company_manager.conversation_manager.history),
-            "background_info": background_info
-        }
+        result.update({"company_id": company_id, "data_version": data_manager.data_version,
+                       "query_ms": round((time.perf_counter() - started) * 1000, 3)})
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/refresh_data', methods=['POST'])
+def refresh_data():
+    """
+    API endpoint to refresh company data on demand.
+    
+    Fetches only new or changed rows unless "full" is set in the request body.
+    
+    Returns:
+        JSON: Refresh status and current data version
+    """
+    try:
+        company_id = request.json.get('company_id')
+        if not company_id:
+            return jsonify({"error": "No company ID provided"}), 400
         
-        # Add warning if database connection failed
-        if data_info.get("connection_error"):
-            response_data["warning"] = f"Database connection issue: {data_info['connection_error']}"
+        company_manager = get_company_manager(company_id)
+        if not company_manager:
+            return jsonify({"error": "Invalid company ID"}), 400
         
-        return jsonify(response_data)
-    
+        result = company_manager.data_manager.refresh_data(full=bool(request.json.get('full')))
+        return jsonify(result)
     except Exception as e:
-        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+        return jsonify({"error": str(e)}), 500
 
 
 @app.route('/clear_history', methods=['POST'])
@@ -837,5 +6530,6 @@ def not_found(error):
 
 if __name__ == "__main__":
     # Run the application
+    start_background_services()
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,281 @@
+"""
+Marketing Insights Bot - Batch Runner
+
+Answers a fixed set of questions for every company offline, without the
+web UI. Questions are read from a JSONL file, one object per line:
+
+    {"id": "weekly-top-cities", "question": "Which city had the most scans last week?"}
+    {"question": "How is the festive campaign doing?", "companies": ["company1", "company3"]}
+
+`id` defaults to the line number and `companies` to every company in
+COMPANY_CONFIG. Each (company, question) pair is answered with the app's
+own CompanyDataManager, create_efficient_prompt and get_insights on a
+bounded thread pool. A token-bucket limiter keeps the run within the
+Gemini quota (requests and, optionally, tokens per minute).
+
+Results stream to a JSONL file as they finish. That file is also the
+checkpoint: rerunning the same command skips pairs that already succeeded
+and retries the ones that failed. With a .parquet output, results are
+checkpointed to <output>.partial.jsonl and written to Parquet at the end
+(requires pyarrow).
+
+Usage:
+    python batch_insights.py questions.jsonl --output results.jsonl --workers 4 --rpm 30
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+import app
+
+
+def read_questions(path):
+    """
+    Reads the questions file.
+
+    Args:
+        path: JSONL file with "question" and optional "id"/"companies" fields
+
+    Returns:
+        list: Question dicts with id, question and companies
+
+    Raises:
+        ValueError: If a line is not valid or names an unknown company
+    """
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e})") from e
+
+            question = str(entry.get("question", "")).strip()
+            if not question:
+                raise ValueError(f"{path}:{line_number}: missing \"question\"")
+            companies = entry.get("companies") or list(app.COMPANY_CONFIG)
+            unknown = [company_id for company_id in companies if company_id not in app.COMPANY_CONFIG]
+            if unknown:
+                raise ValueError(f"{path}:{line_number}: unknown companies {', '.join(unknown)}")
+
+            questions.append({"id": str(entry.get("id", line_number)), "question": question,
+                              "companies": companies})
+    return questions
+
+
+def read_checkpoint(path):
+    """
+    Returns the (company_id, question_id) pairs already answered successfully.
+
+    Args:
+        path: Results JSONL written by a previous run (may not exist)
+
+    Returns:
+        set: Completed pairs
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line
+                continue
+            if record.get("status") == "ok":
+                done.add((record["company_id"], record["question_id"]))
+    return done
+
+
+class BatchRunner:
+    """
+    Answers (company, question) pairs concurrently under a rate limit.
+
+    Attributes:
+        request_bucket: Limits Gemini requests per minute
+        token_bucket: Limits prompt tokens per minute (None when unlimited)
+        model: Gemini model used for every question
+    """
+
+    def __init__(self, output_path, workers=4, rpm=60, tpm=0, model=app.GEMINI_MODEL):
+        self.output_path = output_path
+        self.workers = workers
+        self.request_bucket = app.TokenBucket(rpm / 60, max(1, min(rpm, workers)))
+        self.token_bucket = app.TokenBucket(tpm / 60, tpm) if tpm else None
+        self.model = model
+        self.write_lock = threading.Lock()
+        self.counts = {"ok": 0, "error": 0}
+
+    def prepare_companies(self, company_ids):
+        """
+        Loads every company's data in parallel.
+
+        Returns:
+            dict: Company id to CompanyDataManager, for companies with data
+        """
+        def load(company_id):
+            company_manager = app.get_company_manager(company_id)
+            company_manager.data_manager.wait_for_load()
+            return company_manager
+
+        managers = {}
+        with ThreadPoolExecutor(max_workers=len(company_ids) or 1) as pool:
+            for company_id, company_manager in zip(company_ids, pool.map(load, company_ids)):
+                data_manager = company_manager.data_manager
+                if data_manager.raw_data_df is None:
+                    print(f"Skipping {company_id}: {data_manager.connection_error or data_manager.data}")
+                    continue
+                print(f"Loaded {company_id}: {len(data_manager.raw_data_df):,} records")
+                managers[company_id] = company_manager
+        return managers
+
+    def answer(self, company_manager, question):
+        """
+        Answers one question for one company.
+
+        Each question gets an empty conversation, so answers do not depend
+        on the order in which the batch runs.
+
+        Returns:
+            dict: Result record
+        """
+        started = time.perf_counter()
+        data_manager = company_manager.data_manager
+        prompt = app.create_efficient_prompt(
+            data_manager.get_prompt_data(question["question"]),
+            company_manager.background_manager.get_background(),
+            question["question"],
+            app.ConversationManager()
+        )
+        prompt_tokens = app.PromptPacker.estimate_tokens(prompt)
+
+        self.request_bucket.acquire()
+        if self.token_bucket is not None:
+            self.token_bucket.acquire(prompt_tokens)
+        # Within this process, companies share the app's admission limits fairly
+        with app.admission_controller.admit(company_manager.company_id,
+                                            prompt_tokens + app.ADMISSION_OUTPUT_TOKENS, "batch", timeout=0):
+            insights = app.get_insights(prompt, model=self.model)
+
+        return {
+            "company_id": company_manager.company_id,
+            "company_name": company_manager.get_company_name(),
+            "question_id": question["id"],
+            "question": question["question"],
+            "status": "ok" if app.is_successful_answer(insights) else "error",
+            "insights": insights,
+            "model": self.model,
+            "prompt_tokens": prompt_tokens,
+            "data_version": data_manager.data_version,
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+            "finished_at": datetime.now().isoformat(timespec="seconds")
+        }
+
+    def write(self, record):
+        """Appends a result to the output file and flushes it"""
+        with self.write_lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.counts[record["status"]] += 1
+
+    def run(self, questions):
+        """
+        Answers every pending (company, question) pair.
+
+        Args:
+            questions: Question dicts from read_questions
+
+        Returns:
+            dict: Number of ok, error and skipped pairs
+        """
+        done = read_checkpoint(self.output_path)
+        tasks = [(company_id, question) for question in questions for company_id in question["companies"]
+                 if (company_id, question["id"]) not in done]
+        skipped = sum(len(question["companies"]) for question in questions) - len(tasks)
+        print(f"{len(tasks)} questions to answer, {skipped} already done")
+        if not tasks:
+            return dict(self.counts, skipped=skipped)
+
+        managers = self.prepare_companies(sorted({company_id for company_id, _ in tasks}))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as pool:
+            futures = {pool.submit(self.answer, managers[company_id], question): (company_id, question)
+                       for company_id, question in tasks if company_id in managers}
+            for future in as_completed(futures):
+                company_id, question = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {"company_id": company_id, "question_id": question["id"],
+                              "question": question["question"], "status": "error",
+                              "insights": f"Error: {e}", "finished_at": datetime.now().isoformat(timespec="seconds")}
+                self.write(record)
+                print(f"[{sum(self.counts.values())}/{len(futures)}] {company_id} {question['id']}: {record['status']}")
+
+        return dict(self.counts, skipped=skipped, unavailable=len(tasks) - len(futures))
+
+
+def write_parquet(checkpoint_path, output_path):
+    """Writes the latest result for each (company, question) pair to Parquet"""
+    records = []
+    with open(checkpoint_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    results = pd.DataFrame(records).drop_duplicates(["company_id", "question_id"], keep="last")
+    results.to_parquet(output_path, index=False)
+    print(f"Wrote {len(results)} results to {output_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a file of questions for every company.")
+    parser.add_argument("questions", help="JSONL file of questions")
+    parser.add_argument("--output", default="batch_results.jsonl", help="results file (.jsonl or .parquet)")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent questions")
+    parser.add_argument("--rpm", type=float, default=60, help="Gemini requests per minute")
+    parser.add_argument("--tpm", type=float, default=0, help="Gemini prompt tokens per minute (0 for no limit)")
+    parser.add_argument("--model", default=app.GEMINI_MODEL, help="Gemini model")
+    args = parser.parse_args(argv)
+
+    if app.gemini_client.backend.requires_api_key and not app.GEMINI_API_KEY:
+        print("GEMINI_API_KEY is not set.")
+        return 2
+
+    try:
+        questions = read_questions(args.questions)
+    except (OSError, ValueError) as e:
+        print(e)
+        return 2
+
+    parquet = args.output.endswith(".parquet")
+    checkpoint_path = args.output + ".partial.jsonl" if parquet else args.output
+
+    runner = BatchRunner(checkpoint_path, args.workers, args.rpm, args.tpm, args.model)
+    summary = runner.run(questions)
+    print(f"Finished: {summary}")
+
+    if parquet:
+        try:
+            write_parquet(checkpoint_path, args.output)
+        except ImportError as e:
+            print(f"Could not write Parquet ({e}); results are in {checkpoint_path}")
+            return 1
+
+    return 0 if not summary["error"] and not summary.get("unavailable") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Shared setup for the offline benchmarks.
+
+Builds SQLite stand-ins for each company's MySQL database (the `scans` and
+`company-background` tables) and points the app at them through
+DATABASE_URL_TEMPLATE, with Gemini answered by the fake backend. The
+environment must be prepared before `app` is imported, because the app
+reads its configuration at import time.
+"""
+
+import math
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CITIES = ["Mumbai", "Delhi", "Bengaluru", "Pune", "Chennai", "New York", "London", "Dubai"]
+PRODUCTS = ["Scanner X", "Scanner Pro", "Label Kit", "Tag Pack", "Reader Mini", "Reader Max"]
+CHANNELS = ["online", "retail", "partner"]
+CAMPAIGNS = ["spring_sale", "festive", "launch", "retargeting", "none"]
+
+BACKGROUND = ("We sell barcode scanners and tagging kits to retailers in India, "
+              "the UK, the US and the UAE, mostly through online channels.")
+
+QUESTIONS = [
+    "Which city had the most scans last month?",
+    "How did online scans compare with retail in Mumbai?",
+    "What are the top products by scans this year?",
+    "Which campaign drove the most scans in Delhi?",
+    "Suggest ways to grow partner channel scans in London.",
+    "How are Scanner Pro scans trending over time?",
+    "Where should we focus the festive campaign budget?",
+    "What changed in scans for Dubai over the last quarter?",
+]
+
+
+def make_scans(rows, seed=0):
+    """
+    Generates a synthetic scans table.
+
+    Args:
+        rows: Number of rows
+        seed: Random seed, so runs are comparable
+
+    Returns:
+        DataFrame: Scans with ids, timestamps, categorical and numeric columns
+    """
+    rng = np.random.default_rng(seed)
+    created = pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 540 * 86400, rows), unit="s")
+    return pd.DataFrame({
+        "id": np.arange(1, rows + 1),
+        "created_at": created,
+        "updated_at": created,
+        "city": rng.choice(CITIES, rows),
+        "product": rng.choice(PRODUCTS, rows),
+        "channel": rng.choice(CHANNELS, rows, p=[0.6, 0.3, 0.1]),
+        "campaign": rng.choice(CAMPAIGNS, rows),
+        "device_id": rng.integers(1, max(rows // 20, 2), rows),
+        "scan_count": rng.poisson(3, rows) + 1,
+        "order_value": np.round(rng.gamma(2.0, 40.0, rows), 2),
+    })
+
+
+def create_company_database(path, rows, seed=0, chunk_size=100000):
+    """
+    Writes a SQLite database with the tables a company's MySQL database has.
+
+    Args:
+        path: Database file to (re)create
+        rows: Number of scans rows
+        seed: Random seed for the generated rows
+        chunk_size: Rows generated and written per batch
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE "company-background" (background TEXT)')
+        conn.execute('INSERT INTO "company-background" VALUES (?)', (BACKGROUND,))
+        for start in range(0, rows, chunk_size):
+            chunk = make_scans(min(chunk_size, rows - start), seed=seed + start)
+            chunk["id"] += start
+            for column in ("created_at", "updated_at"):
+                chunk[column] = chunk[column].dt.strftime("%Y-%m-%d %H:%M:%S")
+            chunk.to_sql("scans", conn, if_exists="append", index=False)
+        conn.execute("CREATE INDEX scans_updated_at ON scans (updated_at)")
+
+
+def prepare_environment(workdir, rows, companies=None, latency=0.2, distribution="uniform",
+                        error_rate=0.0, hang_rate=0.0, extra=None):
+    """
+    Creates the stand-in databases and sets the app's environment variables.
+
+    Must be called before `load_app`.
+
+    Args:
+        workdir: Directory for the SQLite files
+        rows: Scans rows per company
+        companies: Company ids to create (all configured companies when None)
+        latency: Mean fake Gemini latency in seconds
+        distribution: Fake Gemini latency distribution
+        error_rate: Fraction of fake Gemini calls that fail
+        hang_rate: Fraction of fake Gemini calls that hang past the timeout
+        extra: Additional environment overrides
+
+    Returns:
+        list: Company ids with a stand-in database
+    """
+    os.makedirs(workdir, exist_ok=True)
+    if companies is None:
+        companies = ["company1", "company2", "company3", "company4"]
+
+    for index, company_id in enumerate(companies):
+        database = f"bench_{company_id}_{rows}"
+        path = os.path.join(workdir, f"{database}.db")
+        if not os.path.exists(path):
+            create_company_database(path, rows, seed=index)
+        os.environ[f"MYSQL_DB_{company_id.upper()}"] = database
+
+    os.environ.update({
+        "DATABASE_URL_TEMPLATE": "sqlite:///" + os.path.join(os.path.abspath(workdir), "{database}.db"),
+        "GEMINI_BACKEND": "fake",
+        "FAKE_GEMINI_LATENCY": str(latency),
+        "FAKE_GEMINI_LATENCY_DISTRIBUTION": distribution,
+        "FAKE_GEMINI_ERROR_RATE": str(error_rate),
+        "FAKE_GEMINI_HANG_RATE": str(hang_rate),
+        "WARMUP_ON_START": "false",
+        "DATA_REFRESH_INTERVAL": "0",
+        "SNAPSHOT_DIR": "",
+        "RESPONSE_CACHE_DB": "",
+    })
+    os.environ.update(extra or {})
+    return companies
+
+
+def load_app():
+    """Imports the app module from the repository root"""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import app
+    return app
+
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile (0-100) using linear interpolation.
+
+    Args:
+        values: Sorted list of numbers
+        q: Percentile
+
+    Returns:
+        float: Percentile value, or NaN for an empty list
+    """
+    if not values:
+        return math.nan
+    position = (len(values) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(latencies):
+    """
+    Summarizes latencies in seconds.
+
+    Returns:
+        dict: count, mean, p50, p95, p99 and max in milliseconds
+    """
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 2) if ordered else math.nan,
+        "p50_ms": round(1000 * percentile(ordered, 50), 2),
+        "p95_ms": round(1000 * percentile(ordered, 95), 2),
+        "p99_ms": round(1000 * percentile(ordered, 99), 2),
+        "max_ms": round(1000 * ordered[-1], 2) if ordered else math.nan,
+    }
+
+
+def timed(fn, repeat=5):
+    """
+    Calls fn repeatedly.
+
+    Returns:
+        tuple: (latencies in seconds, last return value)
+    """
+    latencies, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - started)
+    return latencies, result
@@ -0,0 +1,170 @@
+"""
+Offline load test for the Flask app.
+
+Drives /ask, /get_background and /update_background at a fixed concurrency
+through Flask's test client, with Gemini replaced by the fake backend and
+each company's MySQL database by a SQLite stand-in. Reports throughput and
+p50/p95/p99 latency per endpoint.
+
+Example:
+    python benchmarks/load_test.py --rows 100000 --concurrency 16 --requests 500 \\
+        --latency 0.3 --distribution lognormal --error-rate 0.02
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import QUESTIONS, load_app, prepare_environment, summarize
+
+
+def parse_mix(value):
+    """Parses "ask=8,get_background=1,update_background=1" into endpoint weights"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ("ask", "get_background", "update_background"):
+            raise argparse.ArgumentTypeError(f"Unknown endpoint in mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def make_request(client, endpoint, company_id, sequence, unique_questions):
+    """
+    Sends one request.
+
+    Returns:
+        int: HTTP status code
+    """
+    if endpoint == "get_background":
+        response = client.get("/get_background", query_string={"company_id": company_id})
+    elif endpoint == "update_background":
+        response = client.post("/update_background", json={
+            "company_id": company_id,
+            "background": f"We sell barcode scanners to retailers (revision {sequence})."
+        })
+    else:
+        question = QUESTIONS[sequence % len(QUESTIONS)]
+        if unique_questions:
+            # Defeats the response cache so every request reaches Gemini
+            question = f"{question} (request {sequence})"
+        response = client.post("/ask", json={"company_id": company_id, "prompt": question})
+    response.get_data()
+    return response.status_code
+
+
+def run(args):
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "marketing-insights-bench")
+    companies = prepare_environment(
+        workdir, args.rows, companies=args.companies, latency=args.latency, distribution=args.distribution,
+        error_rate=args.error_rate, hang_rate=args.hang_rate,
+        extra={"GEMINI_TIMEOUT": str(args.gemini_timeout)}
+    )
+    app = load_app()
+
+    # Load every company up front so the measured phase excludes cold starts
+    started = time.perf_counter()
+    app.warm_up_company_managers()
+    warm_up_seconds = time.perf_counter() - started
+
+    endpoints = list(args.mix)
+    weights = [args.mix[name] for name in endpoints]
+    plan_random = random.Random(args.seed)
+    plan = [(plan_random.choices(endpoints, weights)[0], plan_random.choice(companies), sequence)
+            for sequence in range(args.requests)]
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+    local = threading.local()
+
+    def worker(item):
+        endpoint, company_id, sequence = item
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        request_started = time.perf_counter()
+        try:
+            status = make_request(local.client, endpoint, company_id, sequence, args.unique_questions)
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - request_started
+        with lock:
+            latencies[endpoint].append(elapsed)
+            statuses[endpoint][status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, plan))
+    wall_seconds = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "rows": args.rows,
+        "companies": companies,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "warm_up_seconds": round(warm_up_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(args.requests / wall_seconds, 2),
+        "overall": summarize(all_latencies),
+        "endpoints": {
+            endpoint: dict(summarize(values), statuses={str(k): v for k, v in statuses[endpoint].items()})
+            for endpoint, values in sorted(latencies.items())
+        },
+        "gemini": app.gemini_client.get_stats(),
+        "response_cache": app.response_cache.get_stats(),
+    }
+
+
+def print_report(report):
+    print(f"{report['requests']} requests, concurrency {report['concurrency']}, "
+          f"{report['rows']} rows x {len(report['companies'])} companies")
+    print(f"warm-up {report['warm_up_seconds']}s, run {report['wall_seconds']}s, "
+          f"{report['throughput_rps']} req/s")
+    header = f"{'endpoint':<20}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  statuses"
+    print(header)
+    print("-" * len(header))
+    rows = list(report["endpoints"].items()) + [("overall", report["overall"])]
+    for name, stats in rows:
+        print(f"{name:<20}{stats['count']:>7}{stats['mean_ms']:>10}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}  {stats.get('statuses', '')}")
+    print("(latencies in ms)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=10000, help="scans rows per company")
+    parser.add_argument("--companies", nargs="+", help="company ids (default: all)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("ask=8,get_background=1,update_background=1"),
+                        help="endpoint weights, e.g. ask=8,get_background=1,update_background=1")
+    parser.add_argument("--latency", type=float, default=0.2, help="mean fake Gemini latency (s)")
+    parser.add_argument("--distribution", default="uniform",
+                        choices=["uniform", "fixed", "exponential", "lognormal"])
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-timeout", type=float, default=5.0)
+    parser.add_argument("--unique-questions", action="store_true", help="bypass the response cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the SQLite stand-ins (reused across runs)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, default=str)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
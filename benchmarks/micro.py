@@ -0,0 +1,103 @@
+"""
+Micro-benchmarks for the data and prompt hot paths.
+
+Times DataManager.load_data, the first prompt data build after a load
+(digest and retrieval index), create_efficient_prompt and
+ConversationManager.get_relevant_history across dataset sizes, against
+SQLite stand-ins for the company database.
+
+Example:
+    python benchmarks/micro.py --sizes 1000 10000 100000 1000000 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from harness import QUESTIONS, create_company_database, load_app, prepare_environment, summarize, timed
+
+COMPANY_ID = "company1"
+
+
+def fill_history(app, turns):
+    """Returns a ConversationManager holding the given number of turns"""
+    conversation_manager = app.ConversationManager(max_history=turns)
+    for index in range(turns):
+        question = QUESTIONS[index % len(QUESTIONS)]
+        conversation_manager.add_turn(f"{question} #{index}",
+                                      f"Focus on {question.split()[-1].rstrip('?.')} with campaign {index % 7}.")
+    return conversation_manager
+
+
+def bench_size(app, workdir, rows, repeat, history_turns):
+    """
+    Runs the micro-benchmarks for one dataset size.
+
+    Returns:
+        dict: Latency summaries keyed by benchmark name
+    """
+    database = f"micro_{rows}"
+    path = os.path.join(workdir, f"{database}.db")
+    if not os.path.exists(path):
+        create_company_database(path, rows)
+    os.environ[f"MYSQL_DB_{COMPANY_ID.upper()}"] = database
+
+    company_manager = app.CompanyDataManager(COMPANY_ID)
+    data_manager = company_manager.data_manager
+    results = {}
+
+    latencies, loaded = timed(lambda: data_manager.load_data(use_snapshot=False), repeat)
+    if not loaded:
+        raise RuntimeError(f"load_data failed for {rows} rows: {data_manager.connection_error or data_manager.data}")
+    results["load_data"] = summarize(latencies)
+
+    question = QUESTIONS[0]
+    latencies, current_data = timed(lambda: data_manager.get_prompt_data(question), 1)
+    results["prompt_data_cold"] = summarize(latencies)
+
+    conversation_manager = fill_history(app, history_turns)
+    background = company_manager.background_manager.get_background()
+    latencies, prompt = timed(lambda: app.create_efficient_prompt(
+        data_manager.get_prompt_data(question), background, question, conversation_manager), repeat)
+    results["create_efficient_prompt"] = dict(summarize(latencies), prompt_chars=len(prompt))
+
+    latencies, _ = timed(lambda: conversation_manager.get_relevant_history(question), repeat * 20)
+    results["get_relevant_history"] = dict(summarize(latencies), turns=history_turns)
+
+    company_manager.get_engine().dispose()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--history", type=int, default=200, help="conversation turns for history ranking")
+    parser.add_argument("--workdir", help="directory for the SQLite stand-ins (reused across runs)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), "marketing-insights-bench")
+    prepare_environment(workdir, rows=0, companies=[], extra={"SCANS_MAX_ROWS": "0"})
+    app = load_app()
+
+    report = {rows: bench_size(app, workdir, rows, args.repeat, args.history) for rows in args.sizes}
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+
+    header = f"{'rows':>9}  {'benchmark':<26}{'p50':>11}{'p95':>11}{'max':>11}"
+    print(header)
+    print("-" * len(header))
+    for rows, results in report.items():
+        for name, stats in results.items():
+            print(f"{rows:>9}  {name:<26}{stats['p50_ms']:>11}{stats['p95_ms']:>11}{stats['max_ms']:>11}")
+    print("(latencies in ms)")
+
+
+if __name__ == "__main__":
+    main()
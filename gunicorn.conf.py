@@ -0,0 +1,13 @@
+"""
+Gunicorn configuration for the Marketing Insights Bot.
+
+Gunicorn loads this file automatically from the working directory. The hook
+below starts per-worker background services (company warm-up and the data
+refresher) once the application has been loaded in each worker process.
+"""
+
+
+def post_worker_init(worker):
+    """Warm up all companies in the background as soon as a worker starts"""
+    from app import start_background_services
+    start_background_services()
@@ -32,6 +32,9 @@ let originalBackgroundText = '';
 // Get company ID from window object (set by template)
 const COMPANY_ID = window.COMPANY_ID || '';
 
+// Stream answers via Server-Sent Events when the browser can read response bodies
+const STREAMING_SUPPORTED = Boolean(window.ReadableStream && window.TextDecoder);
+
 /**
  * Initialize application on page load
  */
@@ -351,69 +354,195 @@ form.addEventListener('submit', async (e) => {
   chatBox.appendChild(botMessageDiv);
   chatBox.scrollTop = chatBox.scrollHeight;
 
+  // Prepare request body
+  const requestBody = { 
+    prompt,
+    company_id: COMPANY_ID
+  };
+  
+  // Include edited background if applicable
+  if (currentBackgroundInfo && currentBackgroundInfo.is_edited) {
+    requestBody.background = currentBackgroundInfo.current_background;
+  }
+
   try {
-    // Prepare request body
-    const requestBody = { 
-      prompt,
-      company_id: COMPANY_ID
-    };
-    
-    // Include edited background if applicable
-    if (currentBackgroundInfo && currentBackgroundInfo.is_edited) {
-      requestBody.background = currentBackgroundInfo.current_background;
+    if (STREAMING_SUPPORTED) {
+      await streamAnswer(requestBody, botBubble);
+    } else {
+      await fetchAnswer(requestBody, botBubble);
     }
+  } catch (err) {
+    if (err.name === 'AbortError') return;
+    console.error("Fetch error:", err);
+    botBubble.classList.remove('loading-dots');
+    botBubble.textContent = `❌ Error: ${err.message}`;
+    stopButton.style.display = 'none';
+    currentTypingController = null;
+    setProcessingState(false);
+  }
+});
+
+/**
+ * Build an Error from a failed response, preferring the server's message
+ * @param {Response} response - Failed fetch response
+ * @returns {Promise<Error>} Error with a readable message
+ */
+async function responseError(response) {
+  let errorMsg = `HTTP error! Status: ${response.status}`;
+  try {
+    const errData = await response.json();
+    errorMsg = errData.error || errData.message || errorMsg;
+  } catch {
+    errorMsg = response.statusText || errorMsg;
+  }
+  return new Error(errorMsg);
+}
+
+/**
+ * Apply answer metadata returned by the server
+ * @param {Object} data - Metadata from /ask or the stream's "done" event
+ */
+function applyAnswerMetadata(data) {
+  // Update background info if provided
+  if (data.background_info) {
+    currentBackgroundInfo = data.background_info;
+    updateBackgroundDisplay();
+  }
+}
+
+/**
+ * Request a complete answer from /ask and type it out
+ * @param {Object} requestBody - Request payload
+ * @param {HTMLElement} botBubble - Bubble element to render into
+ */
+async function fetchAnswer(requestBody, botBubble) {
+  const response = await fetch('/ask', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(requestBody)
+  });
+
+  if (!response.ok) throw await responseError(response);
+
+  const data = await response.json();
+
+  // Remove loading animation
+  botBubble.classList.remove('loading-dots');
+  botBubble.innerHTML = '';
+
+  if (data.insights) {
+    // Cancel any existing typing animation
+    if (currentTypingController) currentTypingController.cancel();
     
-    // Send request to server
-    const response = await fetch('/ask', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(requestBody)
-    });
+    // Start typing animation for response
+    currentTypingController = typeMarkdownText(data.insights, botBubble, 10);
+    applyAnswerMetadata(data);
+  } else if (data.error) {
+    botBubble.textContent = `❌ ${data.error}`;
+    setProcessingState(false);
+  } else {
+    botBubble.textContent = "Unexpected response format.";
+    setProcessingState(false);
+  }
+}
 
-    if (!response.ok) {
-      let errorMsg = `HTTP error! Status: ${response.status}`;
-      try {
-        const errData = await response.json();
-        errorMsg = errData.error || errData.message || errorMsg;
-      } catch {
-        errorMsg = response.statusText || errorMsg;
-      }
-      throw new Error(errorMsg);
+/**
+ * Stream an answer from /ask/stream (Server-Sent Events) and render it as it arrives
+ * @param {Object} requestBody - Request payload
+ * @param {HTMLElement} botBubble - Bubble element to render into
+ */
+async function streamAnswer(requestBody, botBubble) {
+  const abortController = new AbortController();
+  let markdown = '';
+  let renderScheduled = false;
+
+  function finish() {
+    stopButton.style.display = 'none';
+    currentTypingController = null;
+    setProcessingState(false);
+  }
+
+  // Stop button aborts the stream and keeps what has arrived so far
+  currentTypingController = {
+    cancel() {
+      abortController.abort();
+      finish();
     }
+  };
+  stopButton.style.display = 'inline-block';
 
-    const data = await response.json();
+  function render() {
+    renderScheduled = false;
+    botBubble.innerHTML = marked.parse(markdown);
 
-    // Remove loading animation
-    botBubble.classList.remove('loading-dots');
-    botBubble.innerHTML = '';
+    // Auto-scroll if near bottom
+    const nearBottom = chatBox.scrollHeight - chatBox.scrollTop <= chatBox.clientHeight + 50;
+    if (nearBottom) chatBox.scrollTop = chatBox.scrollHeight;
+  }
 
-    if (data.insights) {
-      // Cancel any existing typing animation
-      if (currentTypingController) currentTypingController.cancel();
-      
-      // Start typing animation for response
-      currentTypingController = typeMarkdownText(data.insights, botBubble, 10);
-      
-      // Update background info if provided
-      if (data.background_info) {
-        currentBackgroundInfo = data.background_info;
-        updateBackgroundDisplay();
+  function handleEvent(event, data) {
+    if (event === 'chunk') {
+      if (!markdown) {
+        // Remove loading animation on first token
+        botBubble.classList.remove('loading-dots');
       }
-    } else if (data.error) {
+      markdown += data.text;
+      if (!renderScheduled) {
+        renderScheduled = true;
+        requestAnimationFrame(render);
+      }
+    } else if (event === 'done') {
+      render();
+      applyAnswerMetadata(data);
+      finish();
+    } else if (event === 'error') {
+      botBubble.classList.remove('loading-dots');
       botBubble.textContent = `❌ ${data.error}`;
-      setProcessingState(false);
-    } else {
-      botBubble.textContent = "Unexpected response format.";
-      setProcessingState(false);
+      finish();
     }
-  } catch (err) {
-    console.error("Fetch error:", err);
-    botBubble.classList.remove('loading-dots');
-    botBubble.textContent = `❌ Error: ${err.message}`;
-    stopButton.style.display = 'none';
-    setProcessingState(false);
   }
-});
+
+  const response = await fetch('/ask/stream', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(requestBody),
+    signal: abortController.signal
+  });
+
+  if (!response.ok) throw await responseError(response);
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // SSE messages are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const message = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = 'message';
+      let data = '';
+      for (const line of message.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      }
+      if (data) handleEvent(event, JSON.parse(data));
+    }
+  }
+
+  // Stream closed without a final event
+  if (currentTypingController) {
+    if (markdown) render();
+    else throw new Error('Connection closed before a response was received.');
+    finish();
+  }
+}
 
 // Clear conversation history
 clearHistoryBtn.addEventListener('click', async () => {
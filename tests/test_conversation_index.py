@@ -0,0 +1,46 @@
+"""
+Regression tests for the BM25 conversation index.
+
+The app reads its configuration at import time, so the environment is set
+for an offline run (fake Gemini backend, no warm-up) before importing it.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+os.environ.setdefault("WARMUP_ON_START", "false")
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("SNAPSHOT_DIR", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_index_survives_compaction_past_1000_turns():
+    conversation_manager = app.ConversationManager(recent_turns=10**6)
+    for turn in range(1200):
+        conversation_manager.add_turn(f"How did campaign {turn} do in city {turn % 7}?", f"Answer {turn}")
+        assert len(conversation_manager.index.doc_vectors) == len(conversation_manager.history)
+
+    assert len(conversation_manager.history) == app.CONVERSATION_MAX_HISTORY
+    relevant = conversation_manager.get_relevant_history("campaign 1199")
+    assert relevant[-1][0] == "How did campaign 1199 do in city 2?"
+
+
+def test_search_matches_rebuilt_index():
+    index = app.ConversationIndex()
+    texts = [f"scans for product {turn % 13} in region {turn % 5}" for turn in range(1100)]
+    for position, text in enumerate(texts):
+        index.add(text)
+        if position >= 150:
+            index.remove_oldest()
+
+    rebuilt = app.ConversationIndex()
+    for text in texts[-len(index.doc_vectors):]:
+        rebuilt.add(text)
+
+    query = "product 4 region 2"
+    np.testing.assert_allclose(index.search(query), rebuilt.search(query), rtol=1e-5)
@@ -0,0 +1,40 @@
+"""
+Regression tests for classifying database errors as connection failures.
+
+The app reads its configuration at import time, so the environment is set
+for an offline run (fake Gemini backend, no warm-up) before importing it.
+"""
+
+import os
+import sys
+
+import mysql.connector
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+os.environ.setdefault("WARMUP_ON_START", "false")
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("SNAPSHOT_DIR", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_query_errors_are_not_connection_errors():
+    engine = create_engine("sqlite://")
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE scans (created_at TEXT)"))
+        with pytest.raises(OperationalError) as excinfo:
+            conn.execute(text("SELECT DATE_FORMAT(created_at, '%Y') FROM scans"))
+    assert not app.DatabaseHealth.is_connection_error(excinfo.value)
+
+
+def test_lost_connections_are_connection_errors():
+    lost = mysql.connector.errors.OperationalError(msg="Lost connection", errno=2013)
+    assert app.DatabaseHealth.is_connection_error(OperationalError("SELECT 1", {}, lost))
+    refused = mysql.connector.errors.DatabaseError(msg="Connection refused", sqlstate="08S01")
+    assert app.DatabaseHealth.is_connection_error(OperationalError("SELECT 1", {}, refused))
+    timeout = mysql.connector.errors.DatabaseError(msg="Query execution was interrupted", errno=3024)
+    assert not app.DatabaseHealth.is_connection_error(OperationalError("SELECT 1", {}, timeout))
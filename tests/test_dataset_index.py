@@ -0,0 +1,43 @@
+"""
+Regression tests for question-aware retrieval over a loaded dataset.
+
+The app reads its configuration at import time, so the environment is set
+for an offline run (fake Gemini backend, no warm-up) before importing it.
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+os.environ.setdefault("WARMUP_ON_START", "false")
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("SNAPSHOT_DIR", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def make_index():
+    data_df = pd.DataFrame({
+        "city": ["Mumbai", "Delhi", "Mumbai", "Pune"] * 25,
+        "created_at": pd.date_range("2024-01-01", periods=100, freq="D").strftime("%Y-%m-%d"),
+        "scan_count": range(100),
+    })
+    return app.DatasetIndex(data_df)
+
+
+def test_impossible_iso_dates_are_ignored():
+    index = make_index()
+    for question in ("What happened on 2024-13-01 in Mumbai?", "What happened on 2024-02-30 in Mumbai?"):
+        rows, _, filters = index.search(question)
+        # The bare year still applies; the impossible day is dropped
+        assert len(rows) == 50
+        assert "city = Mumbai" in filters
+
+
+def test_valid_iso_dates_still_filter():
+    index = make_index()
+    rows, _, _ = index.search("Scans between 2024-01-10 and 2024-13-01 and 2024-01-19?")
+    assert len(rows) == 10
@@ -0,0 +1,46 @@
+"""
+Regression tests for KPI cube queries.
+
+The app reads its configuration at import time, so the environment is set
+for an offline run (fake Gemini backend, no warm-up) before importing it.
+"""
+
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+os.environ.setdefault("WARMUP_ON_START", "false")
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("SNAPSHOT_DIR", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def make_cube():
+    data_df = pd.DataFrame({
+        "city": ["Mumbai", "Delhi", "Mumbai", "Pune"] * 25,
+        "channel": ["online", "retail"] * 50,
+        "scan_count": range(100),
+    })
+    return app.KpiCube(data_df)
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_limit_below_one_is_rejected(limit):
+    with pytest.raises(ValueError, match="limit"):
+        make_cube().query(["city"], limit=limit)
+
+
+def test_repeated_dimensions_are_rejected():
+    with pytest.raises(ValueError, match="Repeated dimension"):
+        make_cube().query(["city", "channel", "city"])
+
+
+def test_valid_query_is_limited():
+    result = make_cube().query(["city"], limit=2)
+    assert len(result["rows"]) == 2
+    assert result["groups"] == 3
@@ -0,0 +1,42 @@
+"""
+Regression tests for the memory-mapped dataset snapshots.
+
+The app reads its configuration at import time, so the environment is set
+for an offline run (fake Gemini backend, no warm-up) before importing it.
+"""
+
+import os
+import sys
+
+import pandas as pd
+
+os.environ.setdefault("GEMINI_BACKEND", "fake")
+os.environ.setdefault("WARMUP_ON_START", "false")
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("SNAPSHOT_DIR", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_high_cardinality_text_stays_out_of_the_manifest(tmp_path):
+    rows = 5000
+    data_df = pd.DataFrame({
+        "created_at": pd.date_range("2024-01-01", periods=rows, freq="min").strftime("%Y-%m-%d %H:%M:%S"),
+        "note": [f"note é {i}" if i % 7 else None for i in range(rows)],
+        "city": ["Mumbai", "Delhi", "Pune", None] * (rows // 4),
+    })
+    store = app.DatasetSnapshotStore(str(tmp_path))
+    store.publish("company1", data_df, None, {})
+    version, manifest = store.current_version("company1")
+
+    assert os.path.getsize(tmp_path / "company1" / version / "manifest.json") < 2048
+    specs = {spec["name"]: spec for spec in manifest["data"]}
+    assert "categories" not in specs["created_at"] and "categories" not in specs["note"]
+    assert specs["city"]["categories"] == ["Delhi", "Mumbai", "Pune"]
+
+    loaded_df, _ = store.load("company1", version, manifest)
+    assert (loaded_df["created_at"] == pd.to_datetime(data_df["created_at"])).all()
+    assert loaded_df["note"].isna().equals(data_df["note"].isna())
+    assert loaded_df["note"].dropna().tolist() == data_df["note"].dropna().tolist()
+    assert loaded_df["city"].astype(object).isna().equals(data_df["city"].isna())